@@ -15,6 +15,7 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 from donutlib.donutengine import donutengine
 from donutlib.donututil import loadImage
 from donutlib.donututil import calcStarting, Zer56Rot, Zer78Rot, Zer910Rot
+from donutlib.donutlmfit import lmfit
 # from donutlib.decamutil import decaminfo
 
 class donutfit(object):
@@ -23,6 +24,19 @@ class donutfit(object):
     Aaron Roodman (C) SLAC National Accelerator Laboratory, Stanford University 2012.
     """
 
+    # output header cards for the engine's timers (TW=wall-clock, TC=CPU seconds) and counters
+    timerCards = [("pupilMask","PMASK"),("pupilFunc","PFUNC"),("optics","OPTICS"),("tiltShift","TILTSH"),("atmos","ATMOS"),
+                  ("convolute","CONV"),("pixelate","PIXEL"),("derivatives0","DERIV0"),
+                  ("derivatives1","DERIV1"),("derivatives2","DERIV2"),("jacobian","JACOB")]
+    counterCards = [("pupilMaskCalc","NCPMASK"),("pupilMaskSkip","NSPMASK"),
+                    ("pupilFuncCalc","NCPFUNC"),("pupilFuncSkip","NSPFUNC"),("tiltShift","NTILTSH"),
+                    ("atmosCalc","NCATMOS"),("atmosSkip","NSATMOS"),
+                    ("convoluteCalc","NCCONV"),("convoluteSkip","NSCONV"),
+                    ("pupilMaskCacheHits","NHPMASK"),("pupilMaskCacheMisses","NMPMASK"),
+                    ("atmosCacheHits","NHATMOS"),("atmosCacheMisses","NMATMOS"),
+                    ("imageMemoHits","NHMEMO"),("imageMemoMisses","NMMEMO"),
+                    ("derivativeMemoHits","NHDMEMO"),("derivativeMemoMisses","NMDMEMO")]
+
     def __init__(self,**inputDict):
         # init contains all initializations which are done only once for all fits
         # parameters in fixParamArray1 are nEle,rzero,bkgd,Z2,Z3,Z4,....Z11
@@ -36,13 +50,31 @@ class donutfit(object):
                           "outputChi2":False,
                           "printLevel":1,
                           "maxIterations":1000,
-                          "calcRzeroDerivative":True}
+                          "fitter":"minuit",   # or "lm" for the Levenberg-Marquardt fit in donutlmfit
+                          "calcRzeroDerivative":True,
+                          "nThreads":1,
+                          "wisdomDir":"",
+                          "zernikeCacheDir":"",
+                          "compactZernike":-1,   # compact unless the basis is shared, see DonutEngine
+                          "compactZernikeFloat":False,
+                          "shareContext":False,
+                          "contextShm":"",
+                          "fftwPatient":False,
+                          "analyticAtmos":False,
+                          "singlePrecision":False,
+                          "autoGrid":False}   # choose nbin and pixelOverSample for the data stamp, see setupFit
 
         # search for key in inputDict, change defaults
         self.paramDict.update(inputDict)
 
+        # with autoGrid the model stamp must stay the data stamp, so the engine only picks nbin and pixelOverSample
+        if self.paramDict["autoGrid"]:
+            self.paramDict["autoGridKeepPixels"] = True
+
         # setup the fit engine
         self.gFitFunc = donutengine(**self.paramDict)
+        self.autoGridSetup = (self.gFitFunc._nPixels,self.paramDict.get("autoGridZ4"))
+        self.autoGridZ4Given = "autoGridZ4" in inputDict
         
         # need dummy versions before calling self.chisq
         self.imgarray = numpy.zeros(1)
@@ -211,6 +243,22 @@ class donutfit(object):
             extname = 'None'
             self.imgarray = inputImageArray.astype(numpy.float64)
             self.weight = 1.0/numpy.sqrt(self.imgarray)
+
+        # with autoGrid rebuild the engine for this stamp size and starting Z4, as makedonut does, if they changed
+        if self.paramDict["autoGrid"]:
+            inputZernikeArray = self.fitDict["inputZernikeDict"][extname]
+            if not self.autoGridZ4Given and len(inputZernikeArray)>2:
+                self.paramDict["autoGridZ4"] = float(inputZernikeArray[2])
+            self.paramDict["nPixels"] = self.imgarray.shape[0]
+            autoGridSetup = (self.paramDict["nPixels"],self.paramDict.get("autoGridZ4"))
+            if autoGridSetup != self.autoGridSetup:
+                self.gFitFunc = donutengine(**self.paramDict)
+                self.autoGridSetup = autoGridSetup
+
+        # inverse variances for chi2 and its gradient, and the buffers calcChi2 fills in place
+        self.invSigmaSq = numpy.ones(self.imgarray.shape)/self.sigmasq
+        self.pullsq = numpy.zeros(self.imgarray.shape)
+        self.dChi2dpar = numpy.zeros(self.gFitFunc.npar)
        
         # setup starting Zernike array
         # take this from the inputZernikeDict keyed by the value of extname in the header
@@ -288,6 +336,7 @@ class donutfit(object):
 
         # do the Fit, and repeat as desired with different parameters fixed
         postfix = {0:"first",1:"second",2:"third",3:"fourth"}
+        self.lmResult = None
         for iFit in range(self.paramDict["nFits"]):
 
             # fix parameters as desired
@@ -309,49 +358,43 @@ class donutfit(object):
                     self.gMinuit.FixParameter(ipar)                    
             self.paramStatusArray[ipar] = fixParamArray[ipar]
 
+        # only the floating parameters need derivatives
+        self.gFitFunc.setFixedPar(numpy.array(self.paramStatusArray[:self.gFitFunc.npar],dtype=numpy.int32))
+
         # set x,y DECam values
         self.gFitFunc.setXYDECam(xDECam,yDECam)
 
-        # reset counters
-        self.gFitFunc.nCallsCalcAll = 0
-        self.gFitFunc.nCallsCalcDerivative = 0
+        # reset counters and timers
+        self.gFitFunc.resetCounters()
+        self.gFitFunc.resetTimers()
 
 
     def chisq(self,npar, gin, f, par, iflag ):
 
         # convert par to a numpy array
-        parArr = numpy.zeros(self.gFitFunc.npar)
-        for ipar in range(self.gFitFunc.npar):
-            parArr[ipar] = par[ipar]
+        parArr = numpy.fromiter(par,dtype=numpy.float64,count=self.gFitFunc.npar)
         
-        # call donutengine to calculate image
-        self.gFitFunc.calcAll(parArr)
-
-        # compare to calculated image
-        diff = self.imgarray - self.gFitFunc.getvImage()
-        self.pullsq = diff*diff/self.sigmasq   
-        chisquared = self.pullsq.sum()
+        # call donutengine to calculate the image, chi2, the pulls and if needed the derivatives, 
+        # this also saves the parameters for the next iteration
+        if iflag==2 :
+            chisquared = self.gFitFunc.calcChi2(parArr,self.imgarray,self.invSigmaSq,self.dChi2dpar,self.pullsq)
+        else:
+            chisquared = self.gFitFunc.calcChi2(parArr,self.imgarray,self.invSigmaSq,None,self.pullsq)
 
         # printout
         if self.paramDict["printLevel"]>=2:
             print('donutfit: Chi2 = ',chisquared)
 
-        # save parameters for next iteration
-        self.gFitFunc.savePar()
-
         # return result    
         f[0] = chisquared
 
         if iflag==2 :
 
-            # not currently called in calcAll
-            self.gFitFunc.calcDerivatives(self.imgarray,self.weight)
-            dChi2dpar = self.gFitFunc.getDerivatives()
-            
             gin.SetSize(self.gFitFunc.npar)  # need to handle root bug
             #
             # fill gin with Derivatives
             #            
+            dChi2dpar = self.dChi2dpar
             for i in range(self.gFitFunc.npar):
                 gin[i] = dChi2dpar[i]
 
@@ -361,6 +404,10 @@ class donutfit(object):
         #    print "                ",dChi2dpar
 
     def doFit(self):
+
+        if self.paramDict["fitter"]=="lm":
+            self.doFitLM()
+            return
         
         # arglist is for the parameters in Minuit commands
         arglist = array( 'd', 10*[0.] )
@@ -382,14 +429,14 @@ class donutfit(object):
         self.gMinuit.mnexcm( "SET STRATEGY", arglist, 1, ierflg )
                 
         # start timer
-        self.startingtime = time.clock()
+        self.startingtime = time.perf_counter()
 
         # Now ready for minimization step
         self.gMinuit.SetMaxIterations(self.paramDict["maxIterations"])
         self.gMinuit.Migrad()
 
         # done, check elapsed time
-        firsttime = time.clock()
+        firsttime = time.perf_counter()
         self.deltatime = firsttime - self.startingtime
         if self.paramDict["printLevel"]>=1:
             print('donutfit: Elapsed time fit = ',self.deltatime)
@@ -399,12 +446,44 @@ class donutfit(object):
             print('donutfit: Number of CalcAll calls = ',self.gFitFunc.nCallsCalcAll)
             print('donutfit: Number of CalcDerivative calls = ',self.gFitFunc.nCallsCalcDerivative)
 
+    def doFitLM(self):
+
+        # Levenberg-Marquardt fit using the engine's image Jacobian, starting from the previous fit if there was one
+        self.gFitFunc.setCalcRzeroDerivativeTrue()
+        if self.paramStatusArray[self.gFitFunc.ipar_rzero]==1 :
+            self.gFitFunc.setCalcRzeroDerivativeFalse()
+        if self.lmResult is None:
+            startingParam = self.startingParam
+        else:
+            startingParam = self.lmResult["par"]
+
+        self.startingtime = time.perf_counter()
+        # the same inverse variances as chisq, so both fitters minimize the same chi2
+        self.lmResult = lmfit(self.gFitFunc,self.imgarray,self.invSigmaSq,startingParam,self.paramStatusArray,
+                              self.loParam,self.hiParam,maxIterations=self.paramDict["maxIterations"],
+                              printLevel=self.paramDict["printLevel"])
+        firsttime = time.perf_counter()
+        self.deltatime = firsttime - self.startingtime
+        if self.paramDict["printLevel"]>=1:
+            print('donutfit: Elapsed time fit = ',self.deltatime)
+            print('donutfit: Number of CalcAll calls = ',self.gFitFunc.nCallsCalcAll)
+            print('donutfit: Number of CalcJacobian calls = ',self.gFitFunc.nCallsCalcJacobian)
+
     def outFit(self,postfix,identifier=""):
 
         # get more fit details from MINUIT
         amin, edm, errdef = ctypes.c_double(0.18), ctypes.c_double(0.19), ctypes.c_double(0.20)
         nvpar, nparx, icstat = ctypes.c_int(1983), ctypes.c_int(1984), ctypes.c_int(1985)
-        self.gMinuit.mnstat( amin, edm, errdef, nvpar, nparx, icstat )
+        if self.paramDict["fitter"]=="lm":
+            # FITSTAT as in MINUIT: 3 = converged, 0 = not converged
+            amin.value = self.lmResult["chi2"]
+            edm.value = 0.0
+            errdef.value = 1.0
+            nvpar.value = int((self.paramStatusArray==0).sum())
+            nparx.value = self.gFitFunc.npar
+            icstat.value = 3 if self.lmResult["status"]==0 else 0
+        else:
+            self.gMinuit.mnstat( amin, edm, errdef, nvpar, nparx, icstat )
         dof = pow(self.gFitFunc._nPixels,2) - nvpar.value
         if self.paramDict["printLevel"]>=1:
             mytxt = "amin = %.3f, edm = %.3f,   effdef = %.3f,   nvpar = %.3f,  nparx = %.3f, icstat = %.3f " % (amin.value,edm.value,errdef.value,nvpar.value,nparx.value,icstat.value)   
@@ -416,6 +495,10 @@ class donutfit(object):
         self.paramArray = numpy.zeros(self.gFitFunc.npar)
         self.paramErrArray = numpy.zeros(self.gFitFunc.npar)
         for ipar in range(self.gFitFunc.npar):
+            if self.paramDict["fitter"]=="lm":
+                self.paramArray[ipar] = self.lmResult["par"][ipar]
+                self.paramErrArray[ipar] = self.lmResult["parErr"][ipar]
+                continue
             self.gMinuit.GetParameter(ipar,aVal,errVal)
             self.paramArray[ipar] = aVal.value
             if errVal.value < 1e9 :
@@ -459,6 +542,18 @@ class donutfit(object):
         outputDict["CLKTIME"] = self.deltatime
         outputDict["NCALCALL"] = self.gFitFunc.nCallsCalcAll
         outputDict["NCALCDER"] = self.gFitFunc.nCallsCalcDerivative
+        outputDict["NCALCJAC"] = self.gFitFunc.nCallsCalcJacobian
+
+        # where the fit time went: wall-clock and CPU time per stage, and how often
+        # each step of the engine's state machine was recalculated or skipped
+        timers = dict(self.gFitFunc.getTimers())
+        counters = dict(self.gFitFunc.getCounters())
+        for stage,card in self.timerCards:
+            outputDict["TW"+card] = float(timers[stage+"Wall"])
+            outputDict["TC"+card] = float(timers[stage+"Cpu"])
+        for counter,card in self.counterCards:
+            outputDict[card] = int(counters[counter])
+        outputDict["MEMMB"] = float(dict(self.gFitFunc.getMemory())["total"])
         #outputDict["DOF"] = dof #commented by Ting (repeated from the DOF above)
 
         for ipar in range(self.gFitFunc.npar):
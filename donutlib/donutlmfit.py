@@ -0,0 +1,140 @@
+#
+# Levenberg-Marquardt fit of a donut, using the image Jacobian from donutengine
+#
+#     Aaron Roodman (C) SLAC National Accelerator Laboratory, Stanford University 2012.
+#
+from __future__ import print_function
+import numpy
+
+#
+# declare the functions in this file
+#
+__all__ = ["lmfit"]
+
+
+def lmfit(engine,image,weight,par,fixed,lo=None,hi=None,maxIterations=100,tolerance=0.01,lambdaStart=1.e-3,printLevel=0):
+    """ damped Gauss-Newton (Levenberg-Marquardt) fit of the engine's image to image, minimizing
+        chi2 = sum weight*(image-model)**2 over the parameters with fixed==0
+
+        engine    - a DonutEngine, calcJacobian gives d model/d par for its floating parameters
+        lo,hi     - limits as in MINUIT, a parameter is only limited if lo<hi
+        tolerance - stop once an iteration lowers chi2 by less than this
+
+        floating parameters that do not change the image (an all-zero column of the Jacobian, eg. rzero
+        without calcRzeroDerivative) are held at their starting value and reported in degenerate
+
+        returns a dictionary with par, parErr (from the pseudo-inverse of J^T W J at the final par, 0 for degenerate
+        parameters and for parameters at a limit), chi2, nIterations, nCalcAll, degenerate (the indices of the
+        degenerate parameters), atLimit (the indices of the parameters at a limit)
+        and status: 0 converged, 1 reached maxIterations, 2 no step lowered chi2
+    """
+
+    npar = engine.npar
+    par = numpy.array(par,dtype=numpy.float64)
+    engine.setFixedPar(numpy.array(fixed,dtype=numpy.int32))
+    floating = numpy.array(engine.getFloatingPar(),dtype=numpy.int64)
+    if lo is None:
+        lo = numpy.zeros(npar)
+    if hi is None:
+        hi = numpy.zeros(npar)
+    lo = numpy.array(lo,dtype=numpy.float64)
+    hi = numpy.array(hi,dtype=numpy.float64)
+    limited = lo<hi
+
+    y = numpy.array(image,dtype=numpy.float64).flatten()
+    w = numpy.array(weight,dtype=numpy.float64).flatten()
+
+    def calcResidual(p):
+        engine.calcAll(p)
+        r = y - engine.getvImage().flatten()
+        return (w*r*r).sum(),r
+
+    chi2,resid = calcResidual(par)
+    nCalcAll = 1
+    lam = lambdaStart
+    lambdaMax = 1.e10
+    status = 1
+    active = None
+    degenerate = []
+    nIterations = 0
+    for iteration in range(maxIterations):
+        nIterations = iteration + 1
+
+        # normal equations at the current parameters
+        engine.calcJacobian()
+        jac = numpy.array(engine.getvJacobian(),dtype=numpy.float64)
+
+        # only step the parameters that change the image
+        active = numpy.any(jac!=0.,axis=0)
+        for ipar in floating[~active]:
+            if ipar not in degenerate:
+                degenerate.append(int(ipar))
+                print('lmfit: WARNING parameter ',ipar,' does not change the image, it is held at ',par[ipar])
+        if not active.any():
+            status = 2
+            break
+        jac = jac[:,active]
+        jw = jac * w[:,numpy.newaxis]
+        jtwj = numpy.dot(jac.T,jw)
+        jtwr = numpy.dot(jw.T,resid)
+        scale = numpy.diag(jtwj).copy()
+        scale[scale<=0.] = 1.0
+
+        # raise the damping until a step lowers chi2
+        improved = False
+        while lam<lambdaMax:
+            try:
+                step = numpy.linalg.solve(jtwj + lam*numpy.diag(scale),jtwr)
+            except numpy.linalg.LinAlgError:
+                lam = lam*10.
+                continue
+            trial = par.copy()
+            trial[floating[active]] = trial[floating[active]] + step
+            trial[limited] = numpy.clip(trial[limited],lo[limited],hi[limited])
+            chi2Trial,residTrial = calcResidual(trial)
+            nCalcAll = nCalcAll + 1
+            if chi2Trial<chi2:
+                improved = True
+                break
+            lam = lam*10.
+
+        if not improved:
+            status = 2
+            break
+
+        chi2Change = chi2 - chi2Trial
+        par,chi2,resid = trial,chi2Trial,residTrial
+        lam = max(lam/10.,1.e-7)
+        if printLevel>=2:
+            print('lmfit: iteration ',iteration,' chi2 = ',chi2,' lambda = ',lam)
+        if chi2Change<tolerance:
+            status = 0
+            break
+
+    # leave the engine at the best parameters, and get the errors from the Jacobian there
+    if status==2:
+        chi2,resid = calcResidual(par)
+        nCalcAll = nCalcAll + 1
+    parErr = numpy.zeros(npar)
+    atLimit = []
+    if active is not None and active.any():
+        engine.calcJacobian()
+        jac = numpy.array(engine.getvJacobian(),dtype=numpy.float64)
+
+        # as MINUIT does, a parameter stopped at its limit has no error and is left out of the covariance
+        free = numpy.any(jac!=0.,axis=0)
+        for i,ipar in enumerate(floating):
+            if limited[ipar] and (par[ipar]<=lo[ipar] or par[ipar]>=hi[ipar]):
+                free[i] = False
+                atLimit.append(int(ipar))
+                print('lmfit: WARNING parameter ',ipar,' is at its limit ',par[ipar],', its error is set to 0')
+        if free.any():
+            jac = jac[:,free]
+            jtwj = numpy.dot(jac.T,jac * w[:,numpy.newaxis])
+            parErr[floating[free]] = numpy.sqrt(numpy.abs(numpy.diag(numpy.linalg.pinv(jtwj))))
+
+    if printLevel>=1:
+        print('lmfit: chi2 = ',chi2,' after ',nIterations,' iterations and ',nCalcAll,' calcAll calls, status = ',status)
+
+    return {"par":par,"parErr":parErr,"chi2":chi2,"nIterations":nIterations,"nCalcAll":nCalcAll,"status":status,
+            "degenerate":degenerate,"atLimit":atLimit}
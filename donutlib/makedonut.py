@@ -48,6 +48,7 @@ class makedonut(object):
                           "nPixels":64,
                           "gridCalcMode":True,
                           "pixelOverSample":8,
+                          "autoGrid":False,
                           "scaleFactor":1.,                 
                           "rzero":0.125,
                           "nEle":1.0e6,
@@ -60,8 +61,12 @@ class makedonut(object):
 
         self.paramDict.update(inputDict)
 
+        # with autoGrid the engine picks nbin, nPixels and pixelOverSample from the starting Z4 (ZernikeArray starts at Z1)
+        if self.paramDict["autoGrid"] and "autoGridZ4" not in self.paramDict and len(self.paramDict["ZernikeArray"])>3:
+            self.paramDict["autoGridZ4"] = float(self.paramDict["ZernikeArray"][3])
+
         # check parameters are ok
-        if self.paramDict["nbin"] != self.paramDict["nPixels"]*self.paramDict["pixelOverSample"]:
+        if not self.paramDict["autoGrid"] and self.paramDict["nbin"] != self.paramDict["nPixels"]*self.paramDict["pixelOverSample"]:
             print("makedonut:  nbin must = nPixels * pixelOverSample !!!")
             sys.exit(1)
 
@@ -79,7 +84,7 @@ class makedonut(object):
             F = 3.66
             pixelSize = 9.e-6
 
-        if self.paramDict["pixelOverSample"] * self.paramDict["scaleFactor"] * (self.paramDict["waveLength"] * F / pixelSize) < 1. :
+        if not self.paramDict["autoGrid"] and self.paramDict["pixelOverSample"] * self.paramDict["scaleFactor"] * (self.paramDict["waveLength"] * F / pixelSize) < 1. :
             print("makedonut:  ERROR pupil doesn't fit!!!")
             print("            value = ",self.paramDict["pixelOverSample"] * self.paramDict["scaleFactor"] * (self.paramDict["waveLength"] * F / pixelSize))
             #sys.exit(2)
@@ -10,11 +10,17 @@
 #include <fftw3.h>
 #include "Array.h"
 
+// the single precision engine is built with -DDONUT_FLOAT
+#ifdef DONUT_FLOAT
+typedef float Real;
+#else
 typedef double Real;
-typedef std::complex<double> Complex;
+#endif
+typedef std::complex<Real> Complex;
 typedef Array::array1<Real> Vector;
 typedef Array::array2<Real> Matrix;
 typedef Array::array2<Complex> MatrixC;
 typedef Array::array3<Real> AofMatrix;
+typedef Array::array3<Complex> AofMatrixC;
 
 #endif
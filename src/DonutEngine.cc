@@ -8,12 +8,35 @@
 #include <iostream>
 #include <cmath>
 #include <string>
+#include <sstream>
+#include <algorithm>
+#include <limits>
 #include <time.h>
+#include <sys/resource.h>
 
 // Class header files
 #include "fitsio.h"
 #include "DonutEngine.h"
 #include "FFTWClass.h"
+#ifdef DONUT_USE_BLAS
+extern "C" {
+#include <cblas.h>
+}
+#ifdef DONUT_FLOAT
+#define cblas_gemv cblas_sgemv
+#else
+#define cblas_gemv cblas_dgemv
+#endif
+#endif
+
+// fits image and data types matching Real
+#ifdef DONUT_FLOAT
+static const int fitsImgReal = FLOAT_IMG;
+static const int fitsTypeReal = TFLOAT;
+#else
+static const int fitsImgReal = DOUBLE_IMG;
+static const int fitsTypeReal = TDOUBLE;
+#endif
 
 // Constructors
 
@@ -82,8 +105,31 @@ DonutEngine::~DonutEngine(){
       fits_report_error(stderr, status);
     }
   }
+  // a shared (non-compact) Zernike basis belongs to the context
+  if (_context==0 || _compactZernike){
+    delete _zernikeObject;
+  }
+  EngineContext::release(_context);
   delete _fft2PlanC;
   delete _ifft2PlanC;
+  if (_halfSpectrum){
+    delete _fft2PlanR;
+    delete _ifft2PlanR;
+  }
+  if (_decimatedFFT){
+    delete _fft2PlanSmall;
+    delete _ifft2PlanSmall;
+  }
+  if (_batchReady){
+    delete _ifft2PlanBatch;
+    if (_halfSpectrum){
+      delete _fft2PlanBatchR;
+      delete _ifft2PlanBatchR;
+    } else {
+      delete _fft2PlanBatch;
+    }
+  }
+  delete _anotherDonutEngine;
 }
 
 void DonutEngine::closeFits(){
@@ -103,6 +149,9 @@ void DonutEngine::fillOptions(MapStoS inputMapS, MapStoI inputMapI, MapStoD inpu
   MapStoS defaultMapS;
   defaultMapS["outputPrefix"] = "test";
   defaultMapS["inputPupilMask"] = "";
+  defaultMapS["wisdomDir"] = "";     // directory for the fftw wisdom cache, "" turns the cache off
+  defaultMapS["zernikeCacheDir"] = "";     // directory for the memory mapped Zernike basis cache, "" turns the cache off
+  defaultMapS["contextShm"] = "";    // name prefix of a POSIX shared memory object for the engine context, implies shareContext
 
   MapStoI defaultMapI;
   defaultMapI["iTelescope"] = 0;
@@ -115,10 +164,33 @@ void DonutEngine::fillOptions(MapStoS inputMapS, MapStoI inputMapI, MapStoD inpu
   defaultMapI["gridCalcMode"] = 1;
   defaultMapI["zemaxToDECamSignFlip"] = 1;   //CHANGED DEFAULT to positive 1 on 10/4/2012 AJR
   defaultMapI["calcRzeroDerivative"] =0;
+  defaultMapI["halfSpectrum"] = 0;   // =1 use r2c/c2r FFTs and keep the Fourier arrays as Hermitian half-spectra
+  defaultMapI["nThreads"] = 1;       // number of threads used by the fftw plans and the OpenMP loops
+  defaultMapI["fftwPatient"] = 0;    // =1 plan with FFTW_PATIENT, only used with the wisdom cache
+  defaultMapI["analyticAtmos"] = 0;  // =1 build the atmosphere's OTF directly in the Fourier domain
+  defaultMapI["atmosCacheSize"] = 8; // number of analytic atmosphere OTFs kept, keyed by rzero
+  defaultMapI["decimatedFFT"] = 0;   // =1 fold the spectrum to nPixels x nPixels and use small FFTs for the image and Q
+  defaultMapI["checkerboard"] = 0;   // =1 replace the per-call fftShifts by (-1)^(ix+iy) factors in existing loops
+  defaultMapI["batchSize"] = 8;      // number of images per batched FFT in calcAllBatch
+  defaultMapI["autoGrid"] = 0;       // =1 choose nbin, nPixels and pixelOverSample from autoGridZ4, see chooseGridSize
+  defaultMapI["autoGridKeepPixels"] = 0;  // =1 with autoGrid keep nPixels (eg. the data stamp of a fit), choose only nbin and pixelOverSample
+  defaultMapI["compactZernike"] = -1; // =1 build Zernike terms on first use, stored only over the aperture, =0 full basis,
+                                      // -1 compact unless the full basis is shared (zernikeCacheDir, shareContext or contextShm)
+  defaultMapI["compactZernikeFloat"] = 0; // =1 store the compact Zernike terms as float
+  defaultMapI["shareContext"] = 0;   // =1 share the read-only grid, Zernike, atmosphere and pixel arrays with other engines
+  defaultMapI["tiltShift"] = 1;      // =1 apply a change of only Z2,Z3 as a phase ramp on the optics FT, see calcTiltShift
+  defaultMapI["fastSinCos"] = 1;     // =1 make the pupil function with the polynomial sinCosTwoPi instead of the complex exp
+  defaultMapI["compactMemory"] = 1;  // =1 allocate the debug-only psfOptics and psfAtmos arrays only with debugFlag
+  defaultMapI["imageMemoSize"] = 8;  // number of images and derivatives kept, keyed by the exact parameters, 0 turns it off
+  defaultMapI["pupilMaskCacheSize"] = 16; // number of pupil masks kept, keyed by field position, 0 turns the cache off
 
   MapStoD defaultMapD;
   defaultMapD["waveLength"] = 700.0e-9;
   defaultMapD["scaleFactor"] = 2.0;
+  defaultMapD["atmosRzeroStep"] = 1.0e-7;  // [m] rzero is rounded to this step in the analytic atmosphere
+  defaultMapD["autoGridZ4"] = 0.0;        // [waves] the (starting) defocus used by autoGrid
+  defaultMapD["autoGridRzero"] = 0.10;     // [m] smallest rzero expected, sets the seeing margin used by autoGrid
+  defaultMapD["pupilMaskStep"] = 0.0;      // [mm] field position is rounded to this step for the pupil mask cache, 0 = exact
 
   // loop over maps and insert input values
   MapStoS optionMapS;
@@ -170,12 +242,43 @@ void DonutEngine::fillOptions(MapStoS inputMapS, MapStoI inputMapI, MapStoD inpu
   _gridCalcMode = bool(optionMapI["gridCalcMode"]);
   _zemaxToDECamSignFlip = optionMapI["zemaxToDECamSignFlip"];
   _calcRzeroDerivative = optionMapI["calcRzeroDerivative"];
+  _halfSpectrum = bool(optionMapI["halfSpectrum"]);
+  _nThreads = optionMapI["nThreads"];
+  _fftwPatient = bool(optionMapI["fftwPatient"]);
+  _analyticAtmos = bool(optionMapI["analyticAtmos"]);
+  _atmosCacheSize = optionMapI["atmosCacheSize"];
+  _pupilMaskCacheSize = optionMapI["pupilMaskCacheSize"];
+  _checkerboard = bool(optionMapI["checkerboard"]);
+  _decimatedFFT = bool(optionMapI["decimatedFFT"]);
+  _batchSize = optionMapI["batchSize"];
+  _autoGrid = bool(optionMapI["autoGrid"]);
+  _autoGridKeepPixels = bool(optionMapI["autoGridKeepPixels"]);
+  _autoGridZ4 = optionMapD["autoGridZ4"];
+  _autoGridRzero = optionMapD["autoGridRzero"];
+  _compactZernikeFloat = bool(optionMapI["compactZernikeFloat"]);
+  _shareContext = bool(optionMapI["shareContext"]);
+  _tiltShift = bool(optionMapI["tiltShift"]);
+  _imageMemoSize = optionMapI["imageMemoSize"];
+  _fastSinCos = bool(optionMapI["fastSinCos"]);
+  _compactMemory = bool(optionMapI["compactMemory"]);
 
   _waveLength = optionMapD["waveLength"];
   _scaleFactor = optionMapD["scaleFactor"];
+  _atmosRzeroStep = optionMapD["atmosRzeroStep"];
+  _pupilMaskStep = optionMapD["pupilMaskStep"];
 
   _outputPrefix = optionMapS["outputPrefix"];
   _inputPupilMask = optionMapS["inputPupilMask"];
+  _wisdomDir = optionMapS["wisdomDir"];
+  _zernikeCacheDir = optionMapS["zernikeCacheDir"];
+  _contextShm = optionMapS["contextShm"];
+
+  // the full nTerms x nbin x nbin basis is only worth keeping if other engines share it
+  if (optionMapI["compactZernike"]<0){
+    _compactZernike = (_zernikeCacheDir=="" && !_shareContext && _contextShm=="");
+  } else {
+    _compactZernike = bool(optionMapI["compactZernike"]);
+  }
 
   // always initialize xDECam,yDECam to zero, change with setXYDECam
   _xDECam = 0.0;
@@ -202,6 +305,31 @@ void DonutEngine::printOptions(){
     std::cout << "inputPupilMask = " << _inputPupilMask << std::endl; 
     std::cout << "zemaxToDECamSignFlip = " << _zemaxToDECamSignFlip << std::endl; 
     std::cout << "calcRzeroDerivative = " << _calcRzeroDerivative << std::endl; 
+    std::cout << "halfSpectrum = " << _halfSpectrum << std::endl; 
+    std::cout << "nThreads = " << _nThreads << std::endl; 
+    std::cout << "wisdomDir = " << _wisdomDir << std::endl; 
+    std::cout << "zernikeCacheDir = " << _zernikeCacheDir << std::endl; 
+    std::cout << "fftwPatient = " << _fftwPatient << std::endl; 
+    std::cout << "analyticAtmos = " << _analyticAtmos << std::endl; 
+    std::cout << "atmosCacheSize = " << _atmosCacheSize << std::endl; 
+    std::cout << "atmosRzeroStep = " << _atmosRzeroStep << std::endl; 
+    std::cout << "pupilMaskCacheSize = " << _pupilMaskCacheSize << std::endl; 
+    std::cout << "pupilMaskStep = " << _pupilMaskStep << std::endl; 
+    std::cout << "checkerboard = " << _checkerboard << std::endl; 
+    std::cout << "decimatedFFT = " << _decimatedFFT << std::endl; 
+    std::cout << "batchSize = " << _batchSize << std::endl; 
+    std::cout << "autoGrid = " << _autoGrid << std::endl; 
+    std::cout << "autoGridKeepPixels = " << _autoGridKeepPixels << std::endl; 
+    std::cout << "autoGridZ4 = " << _autoGridZ4 << std::endl; 
+    std::cout << "autoGridRzero = " << _autoGridRzero << std::endl; 
+    std::cout << "compactZernike = " << _compactZernike << std::endl; 
+    std::cout << "compactZernikeFloat = " << _compactZernikeFloat << std::endl; 
+    std::cout << "shareContext = " << _shareContext << std::endl; 
+    std::cout << "contextShm = " << _contextShm << std::endl; 
+    std::cout << "tiltShift = " << _tiltShift << std::endl; 
+    std::cout << "imageMemoSize = " << _imageMemoSize << std::endl; 
+    std::cout << "fastSinCos = " << _fastSinCos << std::endl; 
+    std::cout << "compactMemory = " << _compactMemory << std::endl; 
   }
 
 
@@ -212,9 +340,9 @@ void DonutEngine::init(){
   _M_PI = 3.1415926535897931;  //replace with math.h ??
   _M_PI_4 = _M_PI/4.;
 
-  // used for alignment of arrays
-  alignR=sizeof(Real);
-  alignC=sizeof(Complex);
+  // used for alignment of arrays (posix_memalign needs at least sizeof(void*), for the float engine)
+  alignR=std::max(sizeof(Real),sizeof(void*));
+  alignC=std::max(sizeof(Complex),sizeof(void*));
 
   // if debug is on, open a fits file
   if (_debugFlag){
@@ -228,7 +356,9 @@ void DonutEngine::init(){
   }
     
   // setup arrays, parameters for DonutEngine  
+  _batchReady = false;
   calcParameters(_iTelescope);
+  acquireContext();
   setupArrays();
   setupStuff();
   initStateMachine();
@@ -236,10 +366,10 @@ void DonutEngine::init(){
 
   // internal diagnostics
   resetTimers();
-  nCallsCalcAll = 0;
-  nCallsCalcDerivative = 0;
+  resetCounters();
 
   // we may want to calculate the Rzero Derivative, so make another DonutEngine to aid this calculation
+  _anotherDonutEngine = 0;
   if (_calcRzeroDerivative) {
     MapStoS inS = _inputMapS;
     MapStoI inI = _inputMapI;
@@ -339,6 +469,15 @@ void DonutEngine::calcParameters(int iT){
 
   Real F =  _zLength/(2.* _outerRadius);
   Real lambdaF =  F * _waveLength;
+
+  // pick the grid and stamp sizes for this donut, instead of the nbin, nPixels, pixelOverSample options
+  if (_autoGrid){
+    if (_gridCalcMode){
+      chooseGridSize();
+    } else {
+      std::cout << "DonutEngine: autoGrid needs gridCalcMode, using nbin = " << _nbin << std::endl;
+    }
+  }
   
   if (_gridCalcMode){    
     _ngridperPixel =  _pixelOverSample;
@@ -360,6 +499,15 @@ void DonutEngine::calcParameters(int iT){
   _Lf = 1./ _deltaX;
   _nhalfPixels =  _nPixels/2;
 
+  // the decimatedFFT mode needs the pixel centers to be every stride-th grid point of the full grid
+  if (_decimatedFFT){
+    int stride = (int) _ngridperPixel;
+    if (!_gridCalcMode || stride!=_ngridperPixel || _nbin!=_nPixels*stride || _nPixels%2!=0){
+      std::cout << "DonutEngine: decimatedFFT needs gridCalcMode, an integer pixelOverSample, nbin = nPixels*pixelOverSample and an even nPixels, turned off" << std::endl;
+      _decimatedFFT = false;
+    }
+  }
+
   // print output
   if (_printLevel>=2){
     std::cout << "ngridperPixel = " << _ngridperPixel << std::endl;
@@ -435,12 +583,97 @@ void DonutEngine::makeXPsf(int nbin,Real lambdaz){
     
 }
 
+// true if n = 2^a 3^b 5^c, the sizes where fftw is fastest
+static bool isFFTFriendly(int n){
+  if (n<1){
+    return false;
+  }
+  int factors[3] = {2,3,5};
+  for (int i=0;i<3;i++){
+    while (n%factors[i]==0){
+      n = n/factors[i];
+    }
+  }
+  return (n==1);
+}
+
+void DonutEngine::chooseGridSize(){
+
+  // With gridCalcMode the grid spacing on the focal plane is pixelSize/pixelOverSample, and nbin = nPixels*pixelOverSample.
+  //  1) the pupil must fit in the pupil plane, Lu >= 2*outerRadius, ie. pixelOverSample*scaleFactor*lambda*F/pixelSize >= 1
+  //  2) the stamp must contain the donut: the geometric radius for Z4 (Noll, in waves) is 8 sqrt(3) F lambda |Z4|,
+  //     plus a margin of twice the seeing FWHM (0.98 lambda/rzero) and 2 pixels.  This is also the band-limit
+  //     of the wavefront on the pupil grid, since nbin > 16 sqrt(3) |Z4| pupilscale is the same condition.
+  //  3) among those, use the smallest nbin = 2^a 3^b 5^c (nPixels even, for fftShift)
+  // With autoGridKeepPixels nPixels is the given stamp (a fit compares to the data stamp), so only 1) and 3) apply
+  Real F =  _zLength/(2.* _outerRadius);
+  Real lambdaF =  F * _waveLength;
+
+  int minOverSample = int(ceil(_pixelSize/(lambdaF*_scaleFactor) - 1.0e-6));
+  if (minOverSample<1){
+    minOverSample = 1;
+  }
+
+  Real radiusPixels = 8.0*sqrt(3.0)*lambdaF*fabs(_autoGridZ4)/_pixelSize;
+  Real seeingPixels = 0.98*_waveLength/_autoGridRzero * _fLength/_pixelSize;
+  int minPixels = int(ceil(2.0*(radiusPixels + 2.0*seeingPixels + 2.0)));
+  if (minPixels%2!=0){
+    minPixels++;
+  }
+
+  // the next 2^a 3^b 5^c is at most ~25% away, so a small search is enough
+  int bestNbin(0);
+  int bestPixels(0);
+  int bestOverSample(0);
+  int firstPixels(minPixels);
+  int lastPixels(2*minPixels);
+  if (_autoGridKeepPixels){
+    if (minPixels>_nPixels){
+      std::cout << "DonutEngine: autoGrid the donut (" << minPixels << " pixels across) is larger than nPixels = " 
+		<< _nPixels << ", keeping nPixels" << std::endl;
+    }
+    firstPixels = _nPixels;
+    lastPixels = _nPixels;
+  }
+  for (int nPix=firstPixels;nPix<=lastPixels;nPix=nPix+2){
+    for (int nOver=minOverSample;nOver<=2*minOverSample;nOver++){
+      int nbin = nPix*nOver;
+      if ((bestNbin==0 || nbin<bestNbin) && isFFTFriendly(nbin)){
+	bestNbin = nbin;
+	bestPixels = nPix;
+	bestOverSample = nOver;
+      }
+    }
+  }
+
+  // a kept nPixels with a prime factor above 5 never gives 2^a 3^b 5^c, use the smallest grid that holds the pupil
+  if (bestNbin==0){
+    bestPixels = firstPixels;
+    bestOverSample = minOverSample;
+    bestNbin = bestPixels*bestOverSample;
+  }
+
+  _nbin = bestNbin;
+  _nPixels = bestPixels;
+  _pixelOverSample = bestOverSample;
+
+  if (_printLevel>=1){
+    std::cout << "DonutEngine: autoGrid for Z4 = " << _autoGridZ4 << " rzero = " << _autoGridRzero 
+	      << " donut radius = " << radiusPixels << " pixels, using nbin = " << _nbin 
+	      << " nPixels = " << _nPixels << " pixelOverSample = " << _pixelOverSample << std::endl;
+  }
+
+}
+
 void DonutEngine::setupArrays(){
 
   // pupil Mask
   _pupilMask.Dimension(_nbin,_nbin);
   _pupilMask.Activate(alignR);
   _pupilSNorm = 0.0;
+  _pupilSupportChanged = true;
+  _tiltShiftExact = false;
+  _opticsStale = false;
 
   // pupilWave array
   _pupilWaveZernike.Dimension(_nbin,_nbin);
@@ -454,17 +687,26 @@ void DonutEngine::setupArrays(){
   // set dimensionality of pupil arrays
   _pupilFunc.Dimension(_nbin,_nbin);
   _pupilFunc.Activate(alignC);
-  _pupilFuncStar.Dimension(_nbin,_nbin);
-  _pupilFuncStar.Activate(alignC);
 
   // Psf array
   _calcG.Dimension(_nbin,_nbin);
   _calcG.Activate(alignC);
-  _calcGstar.Dimension(_nbin,_nbin);
-  _calcGstar.Activate(alignC);
-  _psfOptics.Dimension(_nbin,_nbin);
-  _psfOptics.Activate(alignR);
-  _ftsOptics.Dimension(_nbin,_nbin);
+  // psfOptics and psfAtmos are only filled with debugFlag
+  if (_debugFlag || !_compactMemory){
+    _psfOptics.Dimension(_nbin,_nbin);
+    _psfOptics.Activate(alignR);
+    _psfAtmos.Dimension(_nbin,_nbin);
+    _psfAtmos.Activate(alignR);
+  }
+
+  // in halfSpectrum mode all of the Fourier arrays are Hermitian half-spectra
+  _nbinHalf = (_nbin/2) + 1;
+  int nbinFts = _nbin;
+  if (_halfSpectrum){
+    nbinFts = _nbinHalf;
+  }
+
+  _ftsOptics.Dimension(_nbin,nbinFts);
   _ftsOptics.Activate(alignC);
 
   // Atmos
@@ -472,13 +714,15 @@ void DonutEngine::setupArrays(){
   _rAtmos.Activate(alignR);
   _shftrAtmos.Dimension(_nbin,_nbin);
   _shftrAtmos.Activate(alignR);
-  _psfAtmos.Dimension(_nbin,_nbin);
-  _psfAtmos.Activate(alignR);
-  _ftsAtmos.Dimension(_nbin,_nbin);
+  _ftsAtmos.Dimension(_nbin,nbinFts);
   _ftsAtmos.Activate(alignC);
+  if (_analyticAtmos){
+    _atmosR53.Dimension(_nbin,nbinFts);
+    _atmosR53.Activate(alignR);
+  }
 
   // arrays for Pixelization
-  _ftsPixel.Dimension(_nbin,_nbin);
+  _ftsPixel.Dimension(_nbin,nbinFts);
   _ftsPixel.Activate(alignC);
 
   // arrays for convolution
@@ -490,6 +734,13 @@ void DonutEngine::setupArrays(){
   _valPixelCenters.Activate(alignR);
   _calcImage.Dimension(_nPixels,_nPixels);
   _calcImage.Activate(alignR);
+
+  // workspace for the per-call temporaries, sized for calcDerivatives:
+  //   Qpixels, Q, imag(conj(pupilFunc)*QQQtilde) on the pupil support (at most nbin*nbin), and 2 Zernike vectors,
+  //   or for fillPupilFunc with fastSinCos the sin and cos of the wavefront on the support
+  size_t workReals = _nPixels*_nPixels + 2*_nbin*_nbin + 2*_nZernikeTerms;
+  size_t workBytes = std::max(workReals*sizeof(Real),(size_t) 2*_nbin*_nbin*sizeof(double));
+  _workspace.reserve(workBytes + 8*64);
     
 }
 
@@ -502,50 +753,254 @@ void DonutEngine::setupStuff(){
   _fftOutputArray.Dimension(_nbin,_nbin);
   _ifftInputArray.Dimension(_nbin,_nbin);
   _ifftOutputArray.Dimension(_nbin,_nbin);
-  _fftrtcInputArray.Dimension(_nbin,_nbin);
-  _fftrtcTempArray.Dimension(_nbin,(_nbin/2) + 1);
-  _fftrtcOutputArray.Dimension(_nbin,_nbin);
 
   _fftInputArray.Activate(alignC);
   _fftOutputArray.Activate(alignC);
   _ifftInputArray.Activate(alignC);
   _ifftOutputArray.Activate(alignC);
-  _fftrtcInputArray.Activate(alignR);
-  _fftrtcTempArray.Activate(alignC);
-  _fftrtcOutputArray.Activate(alignC);
 
-  
+  // the fftw planner is shared by all engines in the process, so plan while holding its lock
+  {
+    fftwPlannerLock plannerLock;
+
+    // all plans for this engine are made with _nThreads threads
+    fftwSetThreads(_nThreads);
+
+    // with a wisdom cache, planning is fast once the cache is warm, and 
+    // then the more expensive FFTW_PATIENT planning is also affordable
+    _planFlags = FFTW_MEASURE;
+    _wisdomFile = "";
+    if (_wisdomDir!=""){
+      std::ostringstream wisdomName;
+      wisdomName << _wisdomDir << "/donutengine-nbin" << _nbin << "-nthreads" << _nThreads << (sizeof(Real)==sizeof(float) ? "-float" : "") << ".wisdom";
+      _wisdomFile = wisdomName.str();
+      bool warmCache = fftwImportWisdom(_wisdomFile);
+      if (_printLevel>=1){
+        std::cout << "DonutEngine: fftw wisdom " << _wisdomFile << (warmCache ? " imported" : " not found, cold start") << std::endl;
+      }
+      if (_fftwPatient){
+        _planFlags = FFTW_PATIENT;
+      }
+    } else if (_fftwPatient) {
+      std::cout << "DonutEngine: fftwPatient needs a wisdomDir, using FFTW_MEASURE" << std::endl;
+    }
 
-  // need for debugging
-  //_fftrtcInputArray.AtIndex(1,1);
-  //_fftrtcOutputArray.AtIndex(1,1);
+    _fft2PlanC =  new fftw2dctc(_fftInputArray,_fftOutputArray,-1,_planFlags);
+    _ifft2PlanC = new fftw2dctc(_ifftInputArray,_ifftOutputArray,1,_planFlags);
 
-  _fft2PlanC =  new fftw2dctc(_fftInputArray,_fftOutputArray,-1);
-  _ifft2PlanC = new fftw2dctc(_ifftInputArray,_ifftOutputArray,1);
-  _fft2rtcPlanC = new fftw2drtc(_fftrtcInputArray,_fftrtcTempArray,_fftrtcOutputArray);
+    // r2c and c2r plans on Hermitian half-spectra
+    if (_halfSpectrum){
+      _fftHalfInputArray.Dimension(_nbin,_nbin);
+      _fftHalfOutputArray.Dimension(_nbin,_nbinHalf);
+      _ifftHalfInputArray.Dimension(_nbin,_nbinHalf);
+      _ifftHalfOutputArray.Dimension(_nbin,_nbin);
 
-  // setup the Pupil function and PSF arrays here
-  makePupilArrays(_nbin,-_Lu/2.0,_Lu/2.0,_outerRadius);
-  makeXPsf(_nbin,_scaleFactor*_lambdaz);
+      _fftHalfInputArray.Activate(alignR);
+      _fftHalfOutputArray.Activate(alignC);
+      _ifftHalfInputArray.Activate(alignC);
+      _ifftHalfOutputArray.Activate(alignR);
 
-  // make Zernike basis
-  _zernikeObject = new Zernike(_rho,_theta,_nZernikeTerms);
+      _fft2PlanR = new fftw2drtcHalf(_fftHalfInputArray,_fftHalfOutputArray,_planFlags);
+      _ifft2PlanR = new fftw2dctrHalf(_ifftHalfInputArray,_ifftHalfOutputArray,_planFlags);
+    }
 
-  // FT of Pixel-sized box - just need this once
-  calcFTPixel();
+    // small plans for the folded spectra of the decimatedFFT mode
+    if (_decimatedFFT){
+      _fftSmallInputArray.Dimension(_nPixels,_nPixels);
+      _fftSmallOutputArray.Dimension(_nPixels,_nPixels);
 
-  // arrays for Atmosphere
-  Matrix xAtmos,yAtmos;
-  itricksMGrid(_nbin,-_Lf/2.,_Lf/2.,xAtmos,yAtmos);
+      _fftSmallInputArray.Activate(alignC);
+      _fftSmallOutputArray.Activate(alignC);
 
-  for (int i=0;i<_nbin*_nbin;i++){
-    _rAtmos(i) = sqrt(xAtmos(i)*xAtmos(i) + yAtmos(i)*yAtmos(i));
+      _fft2PlanSmall = new fftw2dctc(_fftSmallInputArray,_fftSmallOutputArray,-1,_planFlags);
+      _ifft2PlanSmall = new fftw2dctc(_fftSmallInputArray,_fftSmallOutputArray,1,_planFlags);
+    }
+
+    // save any new wisdom for the next engine
+    if (_wisdomFile!=""){
+      if (!fftwExportWisdom(_wisdomFile)){
+        std::cout << "DonutEngine: ERROR could not write fftw wisdom to " << _wisdomFile << std::endl;
+      }
+    }
+  }
+
+  // the grids, the FT of the pixel and the atmosphere radii depend only on the grid, so with an engine
+  // context they are calculated once, by the first engine, and the other engines just view them
+  bool fillContext = (_context==0 || !_context->isFilled());
+
+  if (fillContext){
+    // setup the Pupil function and PSF arrays here
+    makePupilArrays(_nbin,-_Lu/2.0,_Lu/2.0,_outerRadius);
+    makeXPsf(_nbin,_scaleFactor*_lambdaz);
+
+    // FT of Pixel-sized box - just need this once
+    calcFTPixel();
+
+    // arrays for Atmosphere
+    Matrix xAtmos,yAtmos;
+    itricksMGrid(_nbin,-_Lf/2.,_Lf/2.,xAtmos,yAtmos);
+
+    for (int i=0;i<_nbin*_nbin;i++){
+      _rAtmos(i) = sqrt(xAtmos(i)*xAtmos(i) + yAtmos(i)*yAtmos(i));
+    }
+    _shftrAtmos = _rAtmos;    // deep copy 
+    fftShift(_shftrAtmos); // shifts in place, was InvShift
+
+    // for the analytic atmosphere store (r lambda f)^5/3 at the FFT frequencies of the OTF,
+    // which is sampled at k*deltaAtmos with k = 0,1,...,nbin/2,-nbin/2+1,...,-1
+    if (_analyticAtmos){
+      Real deltaAtmos = _Lf/((Real)_nbin - 1.);
+      Real fivethirds(5./3.);
+      for (int iy=0;iy<_nbin;iy++){
+	int ky = (iy<=_nbin/2) ? iy : iy-_nbin;
+	for (int ix=0;ix<_atmosR53.Ny();ix++){
+	  int kx = (ix<=_nbin/2) ? ix : ix-_nbin;
+	  Real r = deltaAtmos*sqrt((Real)(kx*kx + ky*ky));
+	  _atmosR53(iy,ix) = pow(r*_waveLength*_fLength,fivethirds);
+	}
+      }
+    }
+  }
+
+  // make Zernike basis
+  // the basis depends only on the grid (nbin,Lu), the pupil normalization (outerRadius) and nTerms,
+  // so with a cache directory it is calculated once and then memory mapped by every engine
+  // (the compact basis is built term by term as needed, so it does not use the cache)
+  // A shared basis comes from the context, the compact basis is always the engine's own, and is made
+  // after useContext since it keeps views of rho and theta
+  if (_context!=0){
+    if (fillContext && !_compactZernike){
+      makeZernike();
+    }
+    useContext();
+  }
+  if (_context==0 || _compactZernike){
+    makeZernike();
+  }
+
+  _pupilMaskCache.setCapacity(_pupilMaskCacheSize);
+  _imageMemo.setCapacity(_imageMemoSize);
+  if (_analyticAtmos){
+    _atmosCache.setCapacity(_atmosCacheSize);
   }
-  _shftrAtmos = _rAtmos;    // deep copy 
-  fftShift(_shftrAtmos); // shifts in place, was InvShift
   
 }
 
+void DonutEngine::makeZernike(){
+
+  std::string zernikeCacheFile = "";
+  if (_zernikeCacheDir!="" && !_compactZernike){
+    std::ostringstream zernikeName;
+    zernikeName.precision(12);
+    zernikeName << _zernikeCacheDir << "/donutzernike-nbin" << _nbin << "-Lu" << _Lu << "-R" << _outerRadius 
+                << "-n" << _nZernikeTerms << (sizeof(Real)==sizeof(float) ? "-float" : "") << ".bin";
+    zernikeCacheFile = zernikeName.str();
+  }
+  if (_compactZernike){
+    _zernikeObject = new Zernike(_rho,_theta,_nZernikeTerms,true,_compactZernikeFloat,_nThreads);
+  } else {
+    _zernikeObject = new Zernike(_rho,_theta,_nZernikeTerms,zernikeCacheFile,_nThreads);
+  }
+  if (_printLevel>=1 && zernikeCacheFile!=""){
+    std::cout << "DonutEngine: Zernike basis " << zernikeCacheFile << (_zernikeObject->isMapped() ? " mapped" : " calculated") << std::endl;
+  }
+
+}
+
+void DonutEngine::acquireContext(){
+
+  _context = 0;
+  if (!_shareContext && _contextShm==""){
+    return;
+  }
+
+  // the key holds every parameter that the shared arrays depend on
+  std::ostringstream key;
+  key.precision(12);
+  key << "nbin" << _nbin << "-Lu" << _Lu << "-R" << _outerRadius << "-Lf" << _Lf << "-pix" << _pixelSize 
+      << "-lz" << _scaleFactor*_lambdaz << "-lf" << _waveLength*_fLength << "-n" << _nZernikeTerms 
+      << "-half" << _halfSpectrum << "-atm" << _analyticAtmos << "-zc" << _compactZernike 
+      << (sizeof(Real)==sizeof(float) ? "-float" : "");
+  int nbinFts = _halfSpectrum ? (_nbin/2)+1 : _nbin;
+  _context = EngineContext::acquire(key.str(),_nbin,nbinFts,_nZernikeTerms,_analyticAtmos,_compactZernike,_contextShm);
+  if (_printLevel>=1){
+    std::cout << "DonutEngine: engine context " << key.str() << (_context->isFilled() ? " shared" : " made") 
+	      << (_context->isShm() ? ", in shared memory "+_context->shmName() : "") << std::endl;
+  }
+
+}
+
+// replace an array of the engine by a view of the context's array
+static void viewArray(Matrix& engineArray, Matrix& contextArray){
+  engineArray.Deallocate();
+  engineArray.Dimension(contextArray.Nx(),contextArray.Ny(),contextArray());
+}
+static void viewArray(MatrixC& engineArray, MatrixC& contextArray){
+  engineArray.Deallocate();
+  engineArray.Dimension(contextArray.Nx(),contextArray.Ny(),contextArray());
+}
+
+void DonutEngine::useContext(){
+
+  // the engine filling the context copies its arrays (and Zernike basis) there, and then makes it available
+  if (!_context->isFilled()){
+    _context->_xaxis = _xaxis;
+    _context->_yaxis = _yaxis;
+    _context->_rho = _rho;
+    _context->_theta = _theta;
+    _context->_xpsf = _xpsf;
+    _context->_ypsf = _ypsf;
+    _context->_rAtmos = _rAtmos;
+    _context->_shftrAtmos = _shftrAtmos;
+    if (_analyticAtmos){
+      _context->_atmosR53 = _atmosR53;
+    }
+    _context->_pixelBox = _pixelBox;
+    _context->_ftsPixel = _ftsPixel;
+    if (!_compactZernike){
+      if (_context->_zernikeStorage!=0){
+	AofMatrix& terms = _zernikeObject->_zernikeTerm;
+	std::copy(terms(),terms()+(size_t) terms.Nx()*terms.Ny()*terms.Nz(),_context->_zernikeStorage);
+	_context->_zernike = new Zernike(_context->_zernikeStorage,_nZernikeTerms,terms.Nz(),terms.Ny());
+	delete _zernikeObject;
+      } else {
+	_context->_zernike = _zernikeObject;
+      }
+    }
+    _context->setFilled();
+  }
+
+  // every engine then uses the context's arrays
+  viewArray(_xaxis,_context->_xaxis);
+  viewArray(_yaxis,_context->_yaxis);
+  viewArray(_rho,_context->_rho);
+  viewArray(_theta,_context->_theta);
+  viewArray(_xpsf,_context->_xpsf);
+  viewArray(_ypsf,_context->_ypsf);
+  viewArray(_rAtmos,_context->_rAtmos);
+  viewArray(_shftrAtmos,_context->_shftrAtmos);
+  if (_analyticAtmos){
+    viewArray(_atmosR53,_context->_atmosR53);
+  }
+  viewArray(_pixelBox,_context->_pixelBox);
+  viewArray(_ftsPixel,_context->_ftsPixel);
+  if (!_compactZernike){
+    _zernikeObject = _context->_zernike;
+  }
+
+}
+
+bool DonutEngine::removeContextShm(){
+
+  // unlink the shared memory object of this engine's context, engines (in any process) that have it 
+  // mapped keep working, new engines make a new one
+  if (_context==0 || !_context->isShm()){
+    return false;
+  }
+  return EngineContext::unlinkShm(_context->shmName());
+
+}
+
 void DonutEngine::initStateMachine(){
         
   // State machine flags
@@ -554,6 +1009,9 @@ void DonutEngine::initStateMachine(){
   _statePupilFunc = false;
   _stateAtmos = false;
   _stateDerivatives = false;
+  _stateTiltOnly = false;
+  _memoHit = false;
+  _memoGeneration = 0;
 
 }
 
@@ -611,6 +1069,71 @@ void DonutEngine::defineParams(){
     _dChi2dpar[ipar] = 0.0;
   }
 
+  // all parameters float until setFixedPar is called
+  _floatingZernike.resize(nZernikeSize);
+  for (int iZ=0;iZ<nZernikeSize;iZ++){
+    _floatingZernike[iZ] = iZ;
+  }
+  _floatingPar.resize(npar);
+  for (int ipar=0;ipar<npar;ipar++){
+    _floatingPar[ipar] = ipar;
+  }
+  _floatingChanged = true;
+
+}
+
+void DonutEngine::setFixedPar(int* fixed, int n){
+
+  // fixed[ipar]==1 for parameters fixed in the fit, only the floating Zernike terms get derivatives
+  if (n<npar){
+    std::cout << "DonutEngine: ERROR setFixedPar needs " << npar << " entries, got " << n << std::endl;
+    return;
+  }
+  _floatingZernike.clear();
+  for (int iZ=0;iZ<nZernikeSize;iZ++){
+    if (fixed[ipar_ZernikeFirst+iZ]==0){
+      _floatingZernike.push_back(iZ);
+    }
+  }
+  _floatingPar.clear();
+  for (int ipar=0;ipar<npar;ipar++){
+    if (fixed[ipar]==0){
+      _floatingPar.push_back(ipar);
+    }
+  }
+  _floatingChanged = true;
+  _memoGeneration++;
+
+}
+
+void DonutEngine::makeZernikeFloating(){
+
+  // contiguous (nFloating x nSupport) basis for the gradient, just a view when the floating terms are consecutive
+  // (the compact basis is gathered here, so only the floating terms are ever copied to the support)
+  int nSupport = _pupilSupport.size();
+  int nFloating = _floatingZernike.size();
+  bool consecutive = (nFloating>0 && _floatingZernike[nFloating-1]-_floatingZernike[0]==nFloating-1);
+  _zernikeFloating.Deallocate();
+  if (_compactZernike){
+    if (nFloating>0){
+      _zernikeFloating.Allocate(nFloating,(nSupport>0 ? nSupport : 1),alignR);
+    }
+    for (int jZ=0;jZ<nFloating;jZ++){
+      _zernikeObject->gatherTerm(_floatingZernike[jZ]+1,_pupilSupportAperture,&_zernikeFloating(jZ,0));
+    }
+  } else if (consecutive){
+    _zernikeFloating.Dimension(nFloating,_zernikeSupport.Ny(),&_zernikeSupport(_floatingZernike[0],0));
+  } else if (nFloating>0) {
+    _zernikeFloating.Allocate(nFloating,_zernikeSupport.Ny(),alignR);
+    for (int jZ=0;jZ<nFloating;jZ++){
+      int iZ = _floatingZernike[jZ];
+      for (int k=0;k<nSupport;k++){
+	_zernikeFloating(jZ,k) = _zernikeSupport(iZ,k);
+      }
+    }
+  }
+  _floatingChanged = false;
+
 }
 
 void DonutEngine::calcWFMtoImage(double* wfm, int nx, int ny){
@@ -626,6 +1149,8 @@ void DonutEngine::calcWFMtoImage(Matrix& wfm){
   // need to fill Par separately
 
   _statePupilFunc = false; 
+  _memoHit = false;
+  _imageMemoKey.clear();
       
   // State Machine: call each step of the calculation
   if (!_statePupilMask){ 
@@ -652,55 +1177,99 @@ void DonutEngine::calcWFMtoImage(Matrix& wfm){
 
 void DonutEngine::calcPupilFuncFromWFM(Matrix& wfm){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcPupilFuncFromWFM " << std::endl;
   }
   
-  // calculate the pupilFunc(tion) from the WFM
+  // calculate the pupilFunc(tion) from the WFM, on the pupil support only
   Complex I = Complex(0.0,1.0);
   Complex twopiI = Complex(0.0,2.0*_M_PI);
-  for (int i=0;i<_nbin*_nbin;i++){
-    if (_pupilMask(i)==0.0){
-      _pupilWaveZernike(i) = 0.0;
-      _pupilFunc(i) = 0.0;
-      _pupilFuncStar(i) = 0.0;
-    } else {
-      _pupilWaveZernike(i) = wfm(i);
-      _pupilFunc(i) = _pupilMask(i) * exp(twopiI  * wfm(i));   // no lambda here, so units are in waveLength
-      _pupilFuncStar(i) = conj(_pupilFunc(i));
-    }
+  _pupilWaveZernike = 0.0;
+  _pupilFunc = 0.0;
+  int nSupport = _pupilSupport.size();
+  for (int k=0;k<nSupport;k++){
+    int i = _pupilSupport[k];
+    _pupilWaveSupport[k] = wfm(i);
+    _pupilWaveZernike(i) = wfm(i);
+    _pupilFunc(i) = _pupilMask(i) * exp(twopiI  * wfm(i));   // no lambda here, so units are in waveLength
   }
+  _pupilSupportChanged = false;
 
   if (_debugFlag && nCallsCalcAll<=1){    
     toFits(_fptr,wfm);
     toFits(_fptr,_pupilFunc);
   }
 
-  clock_t stop = clock();
-  _timePupilFunc += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timePupilFunc += (stop-start);
+  _cpuPupilFunc += cpuTime()-startCpu;
 
 }
 
 
 
 void DonutEngine::calcAll(double* par, int n){
+#ifdef DONUT_FLOAT
+  std::vector<Real> parReal(par,par+n);
+  calcAll(&parReal[0]);
+#else
   calcAll(par);
+#endif
 }
 
 void DonutEngine::calcAll(Real* par){
   
   nCallsCalcAll++;
 
+  // an image in the memo is returned as is, leaving the state machine and the other arrays alone
+  if (_imageMemoSize>0){
+    _imageMemoKey.assign(par,par+npar);
+    _imageMemoKey.push_back(_xDECam);
+    _imageMemoKey.push_back(_yDECam);
+    ImageMemo* memo = _imageMemo.find(_imageMemoKey);
+    if (memo!=0){
+      for (int ipar=0;ipar<npar;ipar++){
+	_parCurrent[ipar] = par[ipar];
+      }
+      for (int i=0;i<_nPixels*_nPixels;i++){
+	_calcImage(i) = memo->image[i];
+      }
+      _memoHit = true;
+      return;
+    }
+  }
+
+  calcAllStates(par);
+
+  if (_imageMemoSize>0){
+    ImageMemo& memo = _imageMemo.insert(_imageMemoKey);
+    memo.image.assign(_calcImage(),_calcImage()+_nPixels*_nPixels);
+    memo.derivatives.clear();
+    memo.dataImage.clear();
+    memo.weight.clear();
+    memo.generation = _memoGeneration;
+  }
+
+}
+
+void DonutEngine::calcAllStates(Real* par){
+
+  _memoHit = false;
+
   // fill parameter and determine how much of the calculation to repeat
   fillPar(par);
+  countStates();
         
   // State Machine: call each step of the calculation
   if (!_statePupilMask){ 
     calcPupilMask();
   } 
-  if ( (!_statePupilMask) || (!_statePupilFunc)){ 
+  if (_statePupilMask && _stateTiltOnly){
+    calcTiltShift();
+  } else if ( (!_statePupilMask) || (!_statePupilFunc)){ 
     calcPupilFunc();
     calcOptics();
   } 
@@ -729,8 +1298,245 @@ void DonutEngine::calcAll(Real* par){
 
 }
 
+void DonutEngine::calcAllBatch(double* parBatch, int nBatch, int nParBatch, double* xBatch, int nxBatch, double* yBatch, int nyBatch,
+				double* images, int nImages, int nyImages, int nxImages){
+  if (nParBatch!=npar || nxBatch!=nBatch || nyBatch!=nBatch || nImages!=nBatch || nyImages!=_nPixels || nxImages!=_nPixels){
+    std::cout << "DonutEngine: ERROR calcAllBatch needs par[nBatch," << npar << "], x[nBatch], y[nBatch] and images[nBatch," 
+	      << _nPixels << "," << _nPixels << "]" << std::endl;
+    return;
+  }
+  calcAllBatch(parBatch,xBatch,yBatch,nBatch,images);
+}
+
+void DonutEngine::restoreMemoHit(){
+
+  // after an image from the memo, calculate it again for the arrays that derivatives need
+  if (_memoHit){
+    std::vector<Real> par(_parCurrent(),_parCurrent()+npar);
+    calcAllStates(&par[0]);
+  }
+
+}
+
+void DonutEngine::calcAllBatch(double* par, double* x, double* y, int nBatch, double* images){
+
+  // Calculate nBatch images, for parameters par[ib*npar+ipar] at positions x[ib],y[ib], into images[ib*nPixels*nPixels+i].
+  // The pupil functions are made one at a time, with the same state machine as calcAll, and the FFTs are done 
+  // _batchSize images at a time with batched plans.  The Zernike basis, pupil mask cache and FTs of the pixel 
+  // are shared by the whole batch.  Afterwards the engine is in the same state as after calcAll for the last image,
+  // except that _convOpticsAtmosPixel is not filled, so calcDerivatives can follow as usual.
+  if (nBatch<=0){
+    return;
+  }
+  if (!_batchReady){
+    setupBatch();
+  }
+
+  // the batch does not use the memo, and leaves the arrays for its last image
+  _memoHit = false;
+  _imageMemoKey.clear();
+
+  // the checkerboard factor (-1)^(ix+iy) replaces the fftShifts in this path
+  int nFts = _nbin * (_halfSpectrum ? _nbinHalf : _nbin);
+  int nFtsRow = (_halfSpectrum ? _nbinHalf : _nbin);
+  int nPixSq = _nPixels*_nPixels;
+  int stride = (int) _ngridperPixel;
+  bool useNgridperPixel = (int(_ngridperPixel) == _ngridperPixel);
+  Real nsqNorm = 1.0/(_nbin*_nbin);
+  Real gridNorm = _ngridperPixel*_ngridperPixel;
+  std::vector<Real> normalizationG(_batchSize);
+
+  // the batch always makes the pupil functions, so after a tilt shift bring _pupilFunc up to date for the first image
+  if (_opticsStale){
+    fillPupilFunc();
+    _opticsStale = false;
+  }
+
+  // _ftsAtmos is only recalculated when rzero changes from one image to the next
+  bool atmosValid = false;
+  Real rzeroAtmos = 0.0;
+
+  for (int ibFirst=0;ibFirst<nBatch;ibFirst=ibFirst+_batchSize){
+    int nb = std::min(_batchSize,nBatch-ibFirst);
+
+    // pupil functions, one at a time
+    for (int kb=0;kb<nb;kb++){
+      double* parb = par + (ibFirst+kb)*npar;
+      std::vector<Real> parReal(parb,parb+npar);
+      nCallsCalcAll++;
+      setXYDECam(x[ibFirst+kb],y[ibFirst+kb]);
+      fillPar(&parReal[0]);
+      _stateTiltOnly = false;
+      countStates();
+      if (!_statePupilMask){ 
+	calcPupilMask();
+      } 
+      if ( (!_statePupilMask) || (!_statePupilFunc)){ 
+	calcPupilFunc();
+      }
+      savePar();
+      normalizationG[kb] = 1.0/(_nbin*_pupilSNorm);
+
+      Complex* in = &_batchInputArray(kb,0,0);
+      for (int i=0;i<_nbin*_nbin;i++){
+	in[i] = _pupilFunc(i);
+      }
+    }
+
+    double start = wallTime();
+    double startCpu = cpuTime();
+
+    // PSF of the optics and its FT
+    _ifft2PlanBatch->execute();
+    for (int kb=0;kb<nb;kb++){
+      bool lastImage = (ibFirst+kb==nBatch-1);
+      Complex* out = &_batchOutputArray(kb,0,0);
+      int i(0);
+      for (int iy=0;iy<_nbin;iy++){
+	Real signNormG = (iy%2==0) ? normalizationG[kb] : -normalizationG[kb];
+	for (int ix=0;ix<_nbin;ix++){
+	  Complex g = out[i] * signNormG;
+	  if (lastImage){
+	    _calcG(i) = g;
+	  }
+	  if (_halfSpectrum){
+	    _batchHalfRealArray(kb,iy,ix) = norm(g);
+	  } else {
+	    _batchInputArray(kb,iy,ix) = norm(g);
+	  }
+	  signNormG = -signNormG;
+	  i++;
+	}
+      }
+    }
+    if (_halfSpectrum){
+      _fft2PlanBatchR->execute();
+    } else {
+      _fft2PlanBatch->execute();
+    }
+
+    double stop = wallTime();
+    _timeOptics += (stop-start);
+    _cpuOptics += cpuTime()-startCpu;
+
+    // convolution with the atmosphere and the pixel
+    for (int kb=0;kb<nb;kb++){
+      double* parb = par + (ibFirst+kb)*npar;
+      if (!atmosValid || parb[ipar_rzero]!=rzeroAtmos){
+	_rzero = parb[ipar_rzero];
+	calcAtmos();
+	rzeroAtmos = _rzero;
+	atmosValid = true;
+      }
+
+      start = wallTime();
+      startCpu = cpuTime();
+      Complex* fts = (_halfSpectrum ? &_batchHalfSpectrumArray(kb,0,0) : &_batchOutputArray(kb,0,0));
+      Complex* conv = (_halfSpectrum ? fts : &_batchInputArray(kb,0,0));
+      if (ibFirst+kb==nBatch-1){
+	for (int i=0;i<nFts;i++){
+	  _ftsOptics(i) = fts[i];
+	}
+      }
+      int i(0);
+      for (int iy=0;iy<_nbin;iy++){
+	Real sign = (iy%2==0) ? 1.0 : -1.0;
+	for (int ix=0;ix<nFtsRow;ix++){
+	  conv[i] = fts[i] * _ftsAtmos(i) * _ftsPixel(i) * sign;
+	  sign = -sign;
+	  i++;
+	}
+      }
+      stop = wallTime();
+      _timeConvolute += (stop-start);
+      _cpuConvolute += cpuTime()-startCpu;
+    }
+
+    start = wallTime();
+    startCpu = cpuTime();
+    if (_halfSpectrum){
+      _ifft2PlanBatchR->execute();
+    } else {
+      _ifft2PlanBatch->execute();
+    }
+
+    // pixelate, by selecting every nth grid point as in calcPixelate, and fill the images
+    for (int kb=0;kb<nb;kb++){
+      double* parb = par + (ibFirst+kb)*npar;
+      double* imageb = images + (ibFirst+kb)*nPixSq;
+      if (useNgridperPixel){
+	int pixIndex(0);
+	for (int j=0;j<_nbin;j=j+stride){
+	  for (int i=0;i<_nbin;i=i+stride){
+	    Real conv = (_halfSpectrum ? fabs(_batchHalfRealArray(kb,j,i)) : abs(_batchOutputArray(kb,j,i))) * nsqNorm;
+	    _valPixelCenters(pixIndex) = conv * gridNorm;
+	    pixIndex++;
+	  }
+	}
+      }
+      for (int i=0;i<nPixSq;i++){
+	_calcImage(i) = parb[ipar_nEle] * _valPixelCenters(i) + parb[ipar_bkgd];
+	imageb[i] = _calcImage(i);
+      }
+    }
+    stop = wallTime();
+    _timeConvolute += (stop-start);
+    _cpuConvolute += cpuTime()-startCpu;
+
+  }
+
+  // the optics and the atmosphere of the engine now belong to the last image
+  _nEle = par[(nBatch-1)*npar+ipar_nEle];
+  _rzero = par[(nBatch-1)*npar+ipar_rzero];
+  _bkgd = par[(nBatch-1)*npar+ipar_bkgd];
+
+  if (_printLevel>=2){
+    std::cout << "DonutEngine: calcAllBatch is done for " << nBatch << " images" << std::endl;
+  }
+
+}
+
+void DonutEngine::setupBatch(){
+
+  // the batched arrays are only made when calcAllBatch is used, they need 2 (3 with halfSpectrum) 
+  // complex arrays of _batchSize*_nbin*_nbin
+  if (_batchSize<1){
+    _batchSize = 1;
+  }
+  // plan while holding the fftw planner lock, as in setupStuff
+  {
+    fftwPlannerLock plannerLock;
+    fftwSetThreads(_nThreads);
+
+    _batchInputArray.Allocate(_batchSize,_nbin,_nbin,alignC);
+    _batchOutputArray.Allocate(_batchSize,_nbin,_nbin,alignC);
+    _ifft2PlanBatch = new fftw2dctcMany(_batchInputArray,_batchOutputArray,1,_planFlags);
+    if (_halfSpectrum){
+      _batchHalfRealArray.Allocate(_batchSize,_nbin,_nbin,alignR);
+      _batchHalfSpectrumArray.Allocate(_batchSize,_nbin,_nbinHalf,alignC);
+      _fft2PlanBatchR = new fftw2drtcHalfMany(_batchHalfRealArray,_batchHalfSpectrumArray,_planFlags);
+      _ifft2PlanBatchR = new fftw2dctrHalfMany(_batchHalfSpectrumArray,_batchHalfRealArray,_planFlags);
+    } else {
+      _fft2PlanBatch = new fftw2dctcMany(_batchInputArray,_batchOutputArray,-1,_planFlags);
+    }
+
+    if (_wisdomFile!=""){
+      if (!fftwExportWisdom(_wisdomFile)){
+        std::cout << "DonutEngine: ERROR could not write fftw wisdom to " << _wisdomFile << std::endl;
+      }
+    }
+  }
+  _batchReady = true;
+
+}
+
 void DonutEngine::fillPar(double* par, int n){
+#ifdef DONUT_FLOAT
+  std::vector<Real> parReal(par,par+n);
+  fillPar(&parReal[0]);
+#else
   fillPar(par);
+#endif
 }
 
 void DonutEngine::fillPar(Real* par){
@@ -742,6 +1548,7 @@ void DonutEngine::fillPar(Real* par){
   for (int ipar=0;ipar<npar;ipar++){
     _parCurrent[ipar] = par[ipar];
   }
+  _stateTiltOnly = false;
 
   // store fit parameters
   _nEle = par[ipar_nEle];
@@ -785,12 +1592,17 @@ void DonutEngine::fillPar(Real* par){
     _statePupilFunc = true;
     _stateAtmos = true;
 
-    // have any of the Pupil Wavefront parameters changed?
+    // have any of the Pupil Wavefront parameters changed?  only tilt (iZ=0,1 for Z2,Z3)?
+    bool higherOrder = false;
     for (int iZ=0;iZ<nZernikeSize;iZ++){
       if (_last_ZernikeArr[iZ] != _ZernikeArr[iZ]){
 	_statePupilFunc = false;
+	if (iZ>=2){
+	  higherOrder = true;
+	}
       }
     }
+    _stateTiltOnly = (!_statePupilFunc) && (!higherOrder) && _tiltShift && _tiltShiftExact;
 
     // Pupil?
     if (_xDECam != _last_xDECam || _yDECam != _last_yDECam){
@@ -817,8 +1629,27 @@ void DonutEngine::fillPar(Real* par){
 }
 
 
+void DonutEngine::countStates(){
+
+  // count the steps that the state machine will recalculate or skip, same logic as in calcAll
+  bool tiltShift = _statePupilMask && _stateTiltOnly;
+  bool pupilFunc = ((!_statePupilMask) || (!_statePupilFunc)) && !tiltShift;
+  bool convolute = pupilFunc || tiltShift || (!_stateAtmos);
+  if (!_statePupilMask) _nPupilMaskCalc++; else _nPupilMaskSkip++;
+  if (pupilFunc) _nPupilFuncCalc++; else _nPupilFuncSkip++;
+  if (tiltShift) _nTiltShift++;
+  if (!_stateAtmos) _nAtmosCalc++; else _nAtmosSkip++;
+  if (convolute) _nConvoluteCalc++; else _nConvoluteSkip++;
+
+}
+
 void DonutEngine::savePar(){
     
+  // after a memo hit the _last_ values still describe the arrays
+  if (_memoHit){
+    return;
+  }
+
   // save parameter values for the next iteraiton
   _last_nEle = _nEle;  
   _last_rzero = _rzero;
@@ -835,38 +1666,187 @@ void DonutEngine::savePar(){
 
 void DonutEngine::calcPupilMask(){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
     
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcPupilMask x,y = " << _xDECam << " " << _yDECam << std::endl;
   }
-  // input the PupilMask
-  //     None:  generate the pupilMask from outer,inter Radius
-  //     not implemented: string : readin the pupilMask from a fits file
-  //     not implemented: numpy.ndarray: the numpy array with the pupilMask
-  if (_inputPupilMask==""){
-
-    // for DECam make pupil Mask with extra detail
-    if (_iTelescope==0){
-    
-      // model all surfaces which contribute
-      // only 3 obstructions matter: EndCapTop, Shroud, ChimneyAOut
-      Real apertureRadius[3] = {0.301,0.298,0.264};
-      Real apertureSlope[3] = {3.72e-4,2.31e-4,-1.79e-4};
-      
-      // calculate the offsets 
-      // note that _xDECam,_yDECam is in [mm] not meters!!!
-      Real offx[3];
-      Real offy[3];
-      for (int iap=0;iap<3;iap++){
-	offx[iap] = _zemaxToDECamSignFlip * apertureSlope[iap] * _xDECam;
-	offy[iap] = _zemaxToDECamSignFlip * apertureSlope[iap] * _yDECam;
-      }
 
-      //std::cout << "x,y,offx,offy = " << _xDECam << " " << _yDECam << " " << offx[0] << " " << offx[1] << " " << offx[2] << " " << offy[0] << " " << offy[1] << " " << offy[2] << " " << std::endl;
+  // masks are cached by telescope and field position, rounded to _pupilMaskStep,
+  // and a new mask is always built at the rounded position so that it only depends on the key
+  if (_pupilMaskCacheSize>0 && _inputPupilMask==""){
+    PupilMaskKey key = pupilMaskKey(_xDECam,_yDECam);
+    PupilMaskBits* cached = _pupilMaskCache.find(key);
+    if (cached!=0){
+      unpackPupilMask(*cached);
+    } else {
+      Real xSave = _xDECam;
+      Real ySave = _yDECam;
+      _xDECam = key.second.first;
+      _yDECam = key.second.second;
+      buildPupilMask();
+      _xDECam = xSave;
+      _yDECam = ySave;
+      packPupilMask(_pupilMaskCache.insert(key));
+    }
+  } else {
+    buildPupilMask();
+  }
 
-      // constants for the FilterExch
-      Real filtExchSlope = 3.19e-4;
+  // save sqrt of the pupilMask.sum(), and the list of bins inside the pupil
+  _pupilSNorm = 0.0;
+  _pupilSupport.clear();
+  for (int i=0;i<_nbin*_nbin;i++){
+    if (_pupilMask(i)!=0.0){
+      _pupilSNorm += _pupilMask(i);
+      _pupilSupport.push_back(i);
+    }
+  }    
+  _pupilSNorm = sqrt(_pupilSNorm);
+
+  // the FT of the PSF is the autocorrelation of the pupil function, and a tilt multiplies its term at lag k
+  // by a phase linear in k only if no lag wraps around the grid, ie. if the support spans less than _nbin/2 
+  int ixMin(_nbin),ixMax(-1),iyMin(_nbin),iyMax(-1);
+  for (unsigned int k=0;k<_pupilSupport.size();k++){
+    int iy = _pupilSupport[k]/_nbin;
+    int ix = _pupilSupport[k]%_nbin;
+    ixMin = std::min(ixMin,ix);
+    ixMax = std::max(ixMax,ix);
+    iyMin = std::min(iyMin,iy);
+    iyMax = std::max(iyMax,iy);
+  }
+  _tiltShiftExact = (ixMax-ixMin < _nbin/2 && iyMax-iyMin < _nbin/2);
+
+  // Zernike terms (without Piston) on the pupil support, stored [iZ][k] for support bin k,
+  // or for the compact basis just the position of each support bin in the Zernike aperture
+  int nSupport = _pupilSupport.size();
+  if (_compactZernike){
+    Real rhoMax = 0.0;
+    for (int k=0;k<nSupport;k++){
+      rhoMax = std::max(rhoMax,_rho(_pupilSupport[k]));
+    }
+    _zernikeObject->extendAperture(rhoMax);
+    _pupilSupportAperture.resize(nSupport);
+    for (int k=0;k<nSupport;k++){
+      _pupilSupportAperture[k] = _zernikeObject->apertureIndex(_pupilSupport[k]);
+    }
+  } else {
+    _zernikeSupport.Deallocate();
+    _zernikeSupport.Allocate(nZernikeSize,(nSupport>0 ? nSupport : 1),alignR);
+    for (int iZ=0;iZ<nZernikeSize;iZ++){
+      Matrix zernikeTemp = _zernikeObject->_zernikeTerm[iZ+1]; // need [iZ+1] since ZernikeTerm includes the Piston term
+      for (int k=0;k<nSupport;k++){
+	_zernikeSupport(iZ,k) = zernikeTemp(_pupilSupport[k]);
+      }
+    }
+  }
+  _pupilWaveSupport.Reallocate((nSupport>0 ? nSupport : 1),alignR);
+  _pupilSupportChanged = true;
+  _floatingChanged = true;
+  
+  double stop = wallTime();
+  _timePupilMask += (stop-start);
+  _cpuPupilMask += cpuTime()-startCpu;
+
+}
+
+DonutEngine::PupilMaskKey DonutEngine::pupilMaskKey(Real x, Real y){
+  if (_pupilMaskStep>0.){
+    x = floor(x/_pupilMaskStep + 0.5) * _pupilMaskStep;
+    y = floor(y/_pupilMaskStep + 0.5) * _pupilMaskStep;
+  }
+  return std::make_pair(_iTelescope,std::make_pair(x,y));
+}
+
+void DonutEngine::packPupilMask(PupilMaskBits& bits){
+  // one bit per pupil bin, 32 bins per word
+  bits.assign((_nbin*_nbin+31)/32,0);
+  for (int i=0;i<_nbin*_nbin;i++){
+    if (_pupilMask(i)!=0.0){
+      bits[i>>5] |= (1u << (i&31));
+    }
+  }
+}
+
+void DonutEngine::unpackPupilMask(const PupilMaskBits& bits){
+  for (int i=0;i<_nbin*_nbin;i++){
+    _pupilMask(i) = ((bits[i>>5] >> (i&31)) & 1u) ? 1.0 : 0.0;
+  }
+}
+
+void DonutEngine::precomputePupilMasks(double xlo, double xhi, double ylo, double yhi){
+
+  // fill the pupil mask cache on the grid of rounded field positions inside [xlo,xhi] x [ylo,yhi]
+  if (_pupilMaskStep<=0. || _pupilMaskCacheSize<=0){
+    std::cout << "DonutEngine: ERROR precomputePupilMasks needs pupilMaskStep>0 and pupilMaskCacheSize>0" << std::endl;
+    return;
+  }
+  long ixlo = long(ceil(xlo/_pupilMaskStep));
+  long ixhi = long(floor(xhi/_pupilMaskStep));
+  long iylo = long(ceil(ylo/_pupilMaskStep));
+  long iyhi = long(floor(yhi/_pupilMaskStep));
+  long nGrid = (ixhi-ixlo+1)*(iyhi-iylo+1);
+  if (nGrid<=0){
+    return;
+  }
+  if ((size_t)nGrid > _pupilMaskCache.capacity()){
+    _pupilMaskCache.setCapacity(nGrid);
+  }
+
+  // keep the current mask, buildPupilMask overwrites it
+  Matrix pupilMaskSave(_nbin,_nbin);
+  pupilMaskSave = _pupilMask;
+  Real xSave = _xDECam;
+  Real ySave = _yDECam;
+  for (long iy=iylo;iy<=iyhi;iy++){
+    for (long ix=ixlo;ix<=ixhi;ix++){
+      PupilMaskKey key = pupilMaskKey(ix*_pupilMaskStep,iy*_pupilMaskStep);
+      _xDECam = key.second.first;
+      _yDECam = key.second.second;
+      buildPupilMask();
+      packPupilMask(_pupilMaskCache.insert(key));
+    }
+  }
+  _xDECam = xSave;
+  _yDECam = ySave;
+  _pupilMask = pupilMaskSave;
+
+  if (_printLevel>=1){
+    std::cout << "DonutEngine: precomputed " << nGrid << " pupil masks" << std::endl;
+  }
+
+}
+
+void DonutEngine::buildPupilMask(){
+
+  // input the PupilMask
+  //     None:  generate the pupilMask from outer,inter Radius
+  //     not implemented: string : readin the pupilMask from a fits file
+  //     not implemented: numpy.ndarray: the numpy array with the pupilMask
+  if (_inputPupilMask==""){
+
+    // for DECam make pupil Mask with extra detail
+    if (_iTelescope==0){
+    
+      // model all surfaces which contribute
+      // only 3 obstructions matter: EndCapTop, Shroud, ChimneyAOut
+      Real apertureRadius[3] = {0.301,0.298,0.264};
+      Real apertureSlope[3] = {3.72e-4,2.31e-4,-1.79e-4};
+      
+      // calculate the offsets 
+      // note that _xDECam,_yDECam is in [mm] not meters!!!
+      Real offx[3];
+      Real offy[3];
+      for (int iap=0;iap<3;iap++){
+	offx[iap] = _zemaxToDECamSignFlip * apertureSlope[iap] * _xDECam;
+	offy[iap] = _zemaxToDECamSignFlip * apertureSlope[iap] * _yDECam;
+      }
+
+      //std::cout << "x,y,offx,offy = " << _xDECam << " " << _yDECam << " " << offx[0] << " " << offx[1] << " " << offx[2] << " " << offy[0] << " " << offy[1] << " " << offy[2] << " " << std::endl;
+
+      // constants for the FilterExch
+      Real filtExchSlope = 3.19e-4;
       Real filtExchBoxXmax = 0.167;
       Real filtExchBoxYmax = 0.320;
       Real filtExchArcP0 = 0.3685;
@@ -884,6 +1864,7 @@ void DonutEngine::calcPupilMask(){
       bool filtExchMask(false);
       bool annulusMask(false);
 	
+#pragma omp parallel for num_threads(_nThreads) schedule(static) private(spiderMask,filtExchMask,annulusMask)
       for (int i=0;i<_nbin*_nbin;i++){
 
 	// model the 3 circular apertures of the central obstruction
@@ -1340,51 +2321,59 @@ void DonutEngine::calcPupilMask(){
     std::cout << "DonutEngine:  ERROR inputPupilMask is currently disabled " << std::endl;
   }
 
-  // save sqrt of the pupilMask.sum()
-  _pupilSNorm = 0.0;
-  for (int i=0;i<_nbin*_nbin;i++){
-    _pupilSNorm += _pupilMask(i);
-  }    
-  _pupilSNorm = sqrt(_pupilSNorm);
-  
-  clock_t stop = clock();
-  _timePupilMask += (stop-start)/(Real)CLOCKS_PER_SEC;
-
 }
 
 void DonutEngine::calcPupilFunc(){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcPupilFunc " << std::endl;
   }
   
-  // Zernike terms
-  for (int iZ=0;iZ<nZernikeSize;iZ++){
-    if (_ZernikeArr[iZ] != _last_ZernikeArr[iZ]){
+  // all pupil plane work is done only on the bins inside the pupil mask, _pupilSupport
+  int nSupport = _pupilSupport.size();
 
-      Matrix zernikeTemp =  _zernikeObject->_zernikeTerm[iZ+1]; // need [iZ+1] since ZernikeTerm includes the Piston term
-      for (int i=0;i<_nbin*_nbin;i++){
-	_pupilWaveZernike(i) = _pupilWaveZernike(i) +  ( _ZernikeArr[iZ] - _last_ZernikeArr[iZ] ) * zernikeTemp(i);
+  // a new support needs the wavefront from scratch, and zeros outside of the pupil
+  if (_pupilSupportChanged){
+    for (int k=0;k<nSupport;k++){
+      _pupilWaveSupport[k] = 0.0;
+    }
+    for (int iZ=0;iZ<nZernikeSize;iZ++){
+      if (_compactZernike){
+	// terms with a zero coefficient are never built
+	if (_ZernikeArr[iZ] != 0.0){
+	  _zernikeObject->addTerm(iZ+1,_ZernikeArr[iZ],_pupilSupportAperture,&_pupilWaveSupport[0]);
+	}
+      } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+	for (int k=0;k<nSupport;k++){
+	  _pupilWaveSupport[k] = _pupilWaveSupport[k] + _ZernikeArr[iZ] * _zernikeSupport(iZ,k);
+	}
       }
-      
     }
-  }
- 
-    
-  // calculate the pupilFunc(tion) from the pupilWave(front)
-  Complex I = Complex(0.0,1.0);
-  Complex twopiI = Complex(0.0,2.0*_M_PI);
-  for (int i=0;i<_nbin*_nbin;i++){
-    if (_pupilMask(i)==0.0){
-      _pupilFunc(i) = 0.0;
-      _pupilFuncStar(i) = 0.0;
-    } else {
-      _pupilFunc(i) = _pupilMask(i) * exp(twopiI  *_pupilWaveZernike(i));   // no lambda here, so units are in waveLength
-      _pupilFuncStar(i) = conj(_pupilFunc(i));
+    _pupilWaveZernike = 0.0;
+    _pupilFunc = 0.0;
+      _pupilSupportChanged = false;
+  } else {
+    // Zernike terms
+    for (int iZ=0;iZ<nZernikeSize;iZ++){
+      if (_ZernikeArr[iZ] != _last_ZernikeArr[iZ]){
+	Real deltaZ = _ZernikeArr[iZ] - _last_ZernikeArr[iZ];
+	if (_compactZernike){
+	  _zernikeObject->addTerm(iZ+1,deltaZ,_pupilSupportAperture,&_pupilWaveSupport[0]);
+	} else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+	  for (int k=0;k<nSupport;k++){
+	    _pupilWaveSupport[k] = _pupilWaveSupport[k] + deltaZ * _zernikeSupport(iZ,k);
+	  }
+	}
+      }
     }
   }
+    
+  fillPupilFunc();
 
   if (_debugFlag && nCallsCalcAll<=1){    
     Matrix pupil(_nbin,_nbin);
@@ -1395,38 +2384,207 @@ void DonutEngine::calcPupilFunc(){
     toFits(_fptr,_pupilFunc);
   }
 
-  clock_t stop = clock();
-  _timePupilFunc += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timePupilFunc += (stop-start);
+  _cpuPupilFunc += cpuTime()-startCpu;
+
+}
+
+// sin and cos of 2 pi w for n values of w (in waves), without branches so that the loop vectorizes.
+// The range reduction r = w - nearest integer (|r| <= 1/2) is exact, then x = (pi/2) r with |x| <= pi/4, and
+// sin(x), cos(x) are Taylor polynomials to x^15 and x^16 (truncation error < 5e-17), doubled twice:
+// sin 2a = 2 sin a cos a, cos 2a = 1 - 2 sin^2 a.  Each doubling at most doubles the absolute error, so
+// |error| < 2e-15 for any w with |w| < 2^31.  (libm's exp(2 pi i w) loses |2 pi w| * 1e-16 in the product 2 pi w.)
+static void sinCosTwoPi(const Real* w, int n, double* sinOut, double* cosOut){
+  const double halfPi = 1.5707963267948966;
+  const double s3 = -1.0/6.0, s5 = 1.0/120.0, s7 = -1.0/5040.0, s9 = 1.0/362880.0, s11 = -1.0/39916800.0,
+    s13 = 1.0/6227020800.0, s15 = -1.0/1307674368000.0;
+  const double c2 = -1.0/2.0, c4 = 1.0/24.0, c6 = -1.0/720.0, c8 = 1.0/40320.0, c10 = -1.0/3628800.0,
+    c12 = 1.0/479001600.0, c14 = -1.0/87178291200.0, c16 = 1.0/20922789888000.0;
+  for (int k=0;k<n;k++){
+    // nearest integer from two truncations, which vectorize with SSE2 unlike floor
+    double f = w[k] - (double)(int)w[k];
+    double r = f - (double)(int)(2.0*f);
+    double x = halfPi * r;
+    double x2 = x*x;
+    double sx = x*(1.0 + x2*(s3 + x2*(s5 + x2*(s7 + x2*(s9 + x2*(s11 + x2*(s13 + x2*s15)))))));
+    double cx = 1.0 + x2*(c2 + x2*(c4 + x2*(c6 + x2*(c8 + x2*(c10 + x2*(c12 + x2*(c14 + x2*c16)))))));
+    double s2 = 2.0*sx*cx;
+    double cc2 = 1.0 - 2.0*sx*sx;
+    sinOut[k] = 2.0*s2*cc2;
+    cosOut[k] = 1.0 - 2.0*s2*s2;
+  }
+}
+
+void DonutEngine::fillPupilFunc(){
+
+  // calculate the pupilFunc(tion) from the pupilWave(front)
+  int nSupport = _pupilSupport.size();
+  if (_fastSinCos){
+    // cos and sin in one pass over the contiguous wavefront, then scattered into the pupil arrays
+    _workspace.reset();
+    double* sinW = _workspace.get<double>(nSupport);
+    double* cosW = _workspace.get<double>(nSupport);
+    int nBlock = std::max(1,(nSupport + _nThreads - 1)/_nThreads);
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int kFirst=0;kFirst<nSupport;kFirst+=nBlock){
+      sinCosTwoPi(&_pupilWaveSupport[kFirst],std::min(nBlock,nSupport-kFirst),sinW+kFirst,cosW+kFirst);
+    }
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int k=0;k<nSupport;k++){
+      int i = _pupilSupport[k];
+      _pupilWaveZernike(i) = _pupilWaveSupport[k];
+      _pupilFunc(i) = Complex(_pupilMask(i)*cosW[k],_pupilMask(i)*sinW[k]);
+    }
+    return;
+  }
+
+  Complex twopiI = Complex(0.0,2.0*_M_PI);
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+  for (int k=0;k<nSupport;k++){
+    int i = _pupilSupport[k];
+    _pupilWaveZernike(i) = _pupilWaveSupport[k];
+    _pupilFunc(i) = _pupilMask(i) * exp(twopiI  *_pupilWaveSupport[k]);   // no lambda here, so units are in waveLength
+  }
+
+}
+
+void DonutEngine::calcTiltShift(){
+
+  // Z2 = 2x/R and Z3 = 2y/R, so a change of only the tilt multiplies the pupil function by a linear phase, 
+  // and the FT of the PSF (the autocorrelation of the pupil function) by exp(2 pi i 2 deltaZ dx k/R) at signed lag k. 
+  // This replaces calcPupilFunc and calcOptics, the wavefront is kept up to date, and the pupil function 
+  // and G are only remade if needed, see refreshOptics.
+  double start = wallTime();
+  double startCpu = cpuTime();
+
+  if (_printLevel>=2){
+    std::cout << "DonutEngine: calcTiltShift " << std::endl;
+  }
+
+  int nSupport = _pupilSupport.size();
+  double deltaTilt[2] = {0.0,0.0};
+  for (int iZ=0;iZ<2 && iZ<nZernikeSize;iZ++){
+    if (_ZernikeArr[iZ] != _last_ZernikeArr[iZ]){
+      Real deltaZ = _ZernikeArr[iZ] - _last_ZernikeArr[iZ];
+      deltaTilt[iZ] = deltaZ;
+      if (_compactZernike){
+	_zernikeObject->addTerm(iZ+1,deltaZ,_pupilSupportAperture,&_pupilWaveSupport[0]);
+      } else {
+	for (int k=0;k<nSupport;k++){
+	  _pupilWaveSupport[k] = _pupilWaveSupport[k] + deltaZ * _zernikeSupport(iZ,k);
+	}
+      }
+    }
+  }
+  for (int k=0;k<nSupport;k++){
+    _pupilWaveZernike(_pupilSupport[k]) = _pupilWaveSupport[k];
+  }
+
+  // phase per bin of lag, in radians
+  double dx = _Lu/(_nbin-1.0);
+  double phaseX = 2.0*_M_PI * 2.0*deltaTilt[0]*dx/_outerRadius;
+  double phaseY = 2.0*_M_PI * 2.0*deltaTilt[1]*dx/_outerRadius;
+
+  // the ramp is separable, the half-spectrum only holds kx = 0.._nbin/2
+  int nFtsRow = (_halfSpectrum ? _nbinHalf : _nbin);
+  std::vector<Complex> rampX(nFtsRow);
+  std::vector<Complex> rampY(_nbin);
+  for (int ix=0;ix<nFtsRow;ix++){
+    int kx = (_halfSpectrum || ix<_nbin/2) ? ix : ix-_nbin;
+    rampX[ix] = Complex(cos(phaseX*kx),sin(phaseX*kx));
+  }
+  for (int iy=0;iy<_nbin;iy++){
+    int ky = (iy<_nbin/2) ? iy : iy-_nbin;
+    rampY[iy] = Complex(cos(phaseY*ky),sin(phaseY*ky));
+  }
+  int i(0);
+  for (int iy=0;iy<_nbin;iy++){
+    for (int ix=0;ix<nFtsRow;ix++){
+      _ftsOptics(i) = _ftsOptics(i) * (rampY[iy]*rampX[ix]);
+      i++;
+    }
+  }
+  _opticsStale = true;
+
+  double stop = wallTime();
+  _timeTiltShift += (stop-start);
+  _cpuTiltShift += cpuTime()-startCpu;
+
+}
+
+void DonutEngine::refreshOptics(){
+
+  // after a tilt shift, remake the pupil function and G from the wavefront for the derivatives and the getters
+  if (_opticsStale){
+    double start = wallTime();
+    double startCpu = cpuTime();
+    fillPupilFunc();
+    double stop = wallTime();
+    _timePupilFunc += (stop-start);
+    _cpuPupilFunc += cpuTime()-startCpu;
+    calcOptics();
+  }
 
 }
  
         
 void DonutEngine::calcOptics(){
            
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcOptics " << std::endl;
   }
                 
   // calculate the PSF from the Pupil function (use ifft to match Zemax output! )
-  MatrixC ishftpupilFunc(_nbin,_nbin);
-  ishftpupilFunc = _pupilFunc;
-  fftShift(ishftpupilFunc); //was InvShift, but these are the same as long as _nbin is even
-  _ifftInputArray = ishftpupilFunc;  
+  // shift straight into the FFT input, no temporary needed
+  // (with the checkerboard, shifting the input is the same as multiplying the output by (-1)^(ix+iy), done below)
+  if (_checkerboard){
+    _ifftInputArray = _pupilFunc;
+  } else {
+    fftShift(_pupilFunc,_ifftInputArray); //was InvShift, but these are the same as long as _nbin is even
+  }
   _ifft2PlanC->execute();
 
-  // don't shift G and G*, only psfOptics   (normalize to sqrt(Area*NbinsTotal))
+  // don't shift G, only psfOptics = |G|^2   (normalize to sqrt(Area*NbinsTotal))
+  // the PSF goes directly into the input of the next FFT
   Real normalizationG = 1.0/(_nbin*_pupilSNorm);
-  Matrix unshftpsfOptics(_nbin,_nbin);
-  for (int i=0;i<_nbin*_nbin;i++){
-    _calcG(i) = _ifftOutputArray(i) * normalizationG;
-    _calcGstar(i) = conj(_calcG(i));
-    unshftpsfOptics(i) = real(_calcG(i)*_calcGstar(i));
+  if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int iy=0;iy<_nbin;iy++){
+      Real signNormG = (iy%2==0) ? normalizationG : -normalizationG;
+      int i = iy*_nbin;
+      for (int ix=0;ix<_nbin;ix++){
+	_calcG(i) = _ifftOutputArray(i) * signNormG;
+	if (_halfSpectrum){
+	  _fftHalfInputArray(i) = norm(_calcG(i));
+	} else {
+	  _fftInputArray(i) = norm(_calcG(i));
+	}
+	signNormG = -signNormG;
+	i++;
+      }
+    }
+  } else if (_halfSpectrum){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<_nbin*_nbin;i++){
+      _calcG(i) = _ifftOutputArray(i) * normalizationG;
+      _fftHalfInputArray(i) = norm(_calcG(i));
+    }
+  } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<_nbin*_nbin;i++){
+      _calcG(i) = _ifftOutputArray(i) * normalizationG;
+      _fftInputArray(i) = norm(_calcG(i));
+    }
   }
 
   if (_debugFlag  && nCallsCalcAll<=1){
-    _psfOptics = unshftpsfOptics;
+    for (int i=0;i<_nbin*_nbin;i++){
+      _psfOptics(i) = (_halfSpectrum ? _fftHalfInputArray(i) : real(_fftInputArray(i)));
+    }
     fftShift(_psfOptics);
 
     toFits(_fptr,_psfOptics);
@@ -1434,83 +2592,181 @@ void DonutEngine::calcOptics(){
 
   // now take the Fourier Transform of the PSF for use in Convolution
   // Q: is an fft of an unshifted fft shifted?
-  realToComplex(unshftpsfOptics,_fftInputArray);
-  _fft2PlanC->execute();
-  _ftsOptics = _fftOutputArray;  
-
-  //_fftrtcInputArray = unshftpsfOptics;
-  //_fft2rtcPlanC->execute();
-  //_ftsOptics = _fftrtcOutputArray;  
+  if (_halfSpectrum){
+    _fft2PlanR->execute();
+    _ftsOptics = _fftHalfOutputArray;
+  } else {
+    _fft2PlanC->execute();
+    _ftsOptics = _fftOutputArray;  
+  }
 
-  // for (int k=0;k<512*512;k++){
-  //   if (abs(_ftsOptics(k)-_fftrtcOutputArray(k))>1e-10){
-  //     std::cout << k << " " << _ftsOptics(k) << " " << _fftrtcOutputArray(k) << std::endl;
-  //   }
-  // }
+  _opticsStale = false;
 
-  clock_t stop = clock();
-  _timeOptics += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timeOptics += (stop-start);
+  _cpuOptics += cpuTime()-startCpu;
 
 }
 
 void DonutEngine::calcAtmos(){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcAtmos" << std::endl;
   }
+
+  // the analytic OTF has no psfAtmos, so the first debug call still goes the long way
+  if (_analyticAtmos && !(_debugFlag && nCallsCalcAll<=1)){
+    calcAtmosAnalytic();
+    double stop = wallTime();
+    _timeAtmos += (stop-start);
+    _cpuAtmos += cpuTime()-startCpu;
+    return;
+  }
   
   // calculate Kolmogorov dist, use shifted radius Array, instead of shifting this everytime!
-  Matrix shftarrAtmos(_nbin,_nbin);
+  // the intermediate arrays are kept in the FFT input arrays, so no temporaries are needed:
+  //    shftarrAtmos   in _ifftInputArray   (_fftHalfInputArray in halfSpectrum mode)
+  //    unshftpsfAtmos in _fftInputArray    (_fftHalfInputArray in halfSpectrum mode)
   Real fivethirds(5./3.);
   Real shftarrAtmosMax(0.);
+#pragma omp parallel for num_threads(_nThreads) schedule(static) reduction(max:shftarrAtmosMax)
   for (int i=0;i<_nbin*_nbin;i++){  
-    shftarrAtmos(i) = exp(-3.44*pow(_shftrAtmos(i)*_waveLength*_fLength/_rzero,fivethirds));
-    if (shftarrAtmos(i)>shftarrAtmosMax){
-      shftarrAtmosMax = shftarrAtmos(i);
+    Real shftarrAtmos = exp(-3.44*pow(_shftrAtmos(i)*_waveLength*_fLength/_rzero,fivethirds));
+    if (shftarrAtmos>shftarrAtmosMax){
+      shftarrAtmosMax = shftarrAtmos;
+    }
+    if (_halfSpectrum){
+      _fftHalfInputArray(i) = shftarrAtmos;
+    } else {
+      _ifftInputArray(i) = shftarrAtmos;
     }
   }
   // normalize (for now) to match python code
-  shftarrAtmos /= shftarrAtmosMax;
-
-  // take the inverse FT to get the Atmosphere's PSF
-  realToComplex(shftarrAtmos,_ifftInputArray);  
-  _ifft2PlanC->execute();
-
-  //_fftrtcInputArray = shftarrAtmos;
-  //_fft2rtcPlanC->execute();
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+  for (int i=0;i<_nbin*_nbin;i++){  
+    if (_halfSpectrum){
+      _fftHalfInputArray(i) = _fftHalfInputArray(i) / shftarrAtmosMax;
+    } else {
+      _ifftInputArray(i) = real(_ifftInputArray(i)) / shftarrAtmosMax;
+    }
+  }
 
-  Matrix unshftpsfAtmos(_nbin,_nbin);
   // normalization of unshftpsfAtmos is very close to the maximum value divided by _nbin*_nbin
   // but is a few percent off from that - so just normalize so the sum==1.0 
-  Real atmosNormalization(0.);
-  for (int i=0;i<_nbin*_nbin;i++){  
-    unshftpsfAtmos(i) = abs(_ifftOutputArray(i))/(_nbin*_nbin);
-    //unshftpsfAtmos(i) = abs(_fftrtcOutputArray(i))/(_nbin*_nbin);
-    atmosNormalization += unshftpsfAtmos(i);
+  // (summed by row, then over the rows in order, so the result does not depend on the number of threads)
+  double atmosNormalization(0.);  // sums are kept in double, also in the float engine
+  std::vector<double> rowNormalization(_nbin,0.0);
+
+  if (_halfSpectrum){
+    // shftarrAtmos is real, so its inverse FT is the complex conjugate of its forward FT, and
+    // we only need the absolute value: use the r2c FFT, and rebuild the missing half from
+    // the Hermitian symmetry  out(iy,ix) = conj(out(Ny-iy,Nx-ix))
+    _fft2PlanR->execute();
+
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int iy=0;iy<_nbin;iy++){
+      int iyStar = (_nbin-iy) % _nbin;
+      int index = iy*_nbin;
+      for (int ix=0;ix<_nbin;ix++){
+	if (ix<_nbinHalf){
+	  _fftHalfInputArray(index) = abs(_fftHalfOutputArray(iy,ix))/(_nbin*_nbin);
+	} else {
+	  _fftHalfInputArray(index) = abs(_fftHalfOutputArray(iyStar,_nbin-ix))/(_nbin*_nbin);
+	}
+	rowNormalization[iy] += _fftHalfInputArray(index);
+	index++;
+      }
+    }
+    for (int iy=0;iy<_nbin;iy++){
+      atmosNormalization += rowNormalization[iy];
+    }
+    _fftHalfInputArray *= (1.0/atmosNormalization);
+
+  } else {
+
+    // take the inverse FT to get the Atmosphere's PSF
+    _ifft2PlanC->execute();
+
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int iy=0;iy<_nbin;iy++){
+      for (int i=iy*_nbin;i<(iy+1)*_nbin;i++){  
+	Real unshftpsfAtmos = abs(_ifftOutputArray(i))/(_nbin*_nbin);
+	_fftInputArray(i) = unshftpsfAtmos;
+	rowNormalization[iy] += unshftpsfAtmos;
+      }
+    }
+    for (int iy=0;iy<_nbin;iy++){
+      atmosNormalization += rowNormalization[iy];
+    }
+    Real invNormalization = 1.0/atmosNormalization;
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<_nbin*_nbin;i++){  
+      _fftInputArray(i) = real(_fftInputArray(i)) * invNormalization;
+    }
   }
-  unshftpsfAtmos *= (1.0/atmosNormalization);
 
   //fftShift(unshftpsfAtmos,_psfAtmos);  //really just needed for debugging
 
   if (_debugFlag  && nCallsCalcAll<=1){
-    fftShift(unshftpsfAtmos,_psfAtmos);
+    for (int i=0;i<_nbin*_nbin;i++){
+      _psfAtmos(i) = (_halfSpectrum ? _fftHalfInputArray(i) : real(_fftInputArray(i)));
+    }
+    fftShift(_psfAtmos);
     toFits(_fptr,_psfAtmos);
   }
 
                                 
   // to convolve with the other sources of PSF, take the FT of the Atmosphere's PSF
-  realToComplex(unshftpsfAtmos,_fftInputArray); 
-  _fft2PlanC->execute();
-  _ftsAtmos = _fftOutputArray; 
+  if (_halfSpectrum){
+    _fft2PlanR->execute();
+    _ftsAtmos = _fftHalfOutputArray;
+  } else {
+    _fft2PlanC->execute();
+    _ftsAtmos = _fftOutputArray; 
+  }
 
-  //_fftrtcInputArray = unshftpsfAtmos;
-  //_fft2rtcPlanC->execute();
-  //_ftsAtmos = _fftrtcOutputArray; 
+  double stop = wallTime();
+  _timeAtmos += (stop-start);
+  _cpuAtmos += cpuTime()-startCpu;
 
-  clock_t stop = clock();
-  _timeAtmos += (stop-start)/(Real)CLOCKS_PER_SEC;
+}
+
+void DonutEngine::calcAtmosAnalytic(){
+
+  // The Kolmogorov OTF  exp(-3.44 (r lambda f/rzero)^5/3)  is real, symmetric and equal to 1.0 at r=0,
+  // so the PSF obtained by inverse transforming it is real and already sums to 1.0 - the normalization
+  // and the two FFTs done in calcAtmos are not needed, just fill _ftsAtmos directly.
+  // rzero is rounded to _atmosRzeroStep, so that the OTF only depends on the cache key.
+  long rzeroKey = long(floor(_rzero/_atmosRzeroStep + 0.5));
+  Real rzero = rzeroKey * _atmosRzeroStep;
+  int nFts = _ftsAtmos.Nx()*_ftsAtmos.Ny();
+
+  std::vector<Real>* cached = 0;
+  if (_atmosCacheSize>0){
+    cached = _atmosCache.find(rzeroKey);
+  }
+  if (cached!=0){
+    for (int i=0;i<nFts;i++){
+      _ftsAtmos(i) = (*cached)[i];
+    }
+    return;
+  }
+
+  Real coeff = -3.44*pow(rzero,-5./3.);
+  for (int i=0;i<nFts;i++){
+    _ftsAtmos(i) = exp(coeff*_atmosR53(i));
+  }
+
+  if (_atmosCacheSize>0){
+    std::vector<Real>& entry = _atmosCache.insert(rzeroKey);
+    entry.resize(nFts);
+    for (int i=0;i<nFts;i++){
+      entry[i] = real(_ftsAtmos(i));
+    }
+  }
 
 }
 
@@ -1519,7 +2775,7 @@ void DonutEngine::calcFTPixel(){
   // define the pixelBox
   _pixelBox.Dimension(_nbin,_nbin);
   _pixelBox.Activate();
-  Real sumOfBox(0.);
+  double sumOfBox(0.);
   for (int i=0;i<_nbin*_nbin;i++){
     if ( fabs(_xpsf(i)) <= _pixelSize/2.0 &&  fabs(_ypsf(i)) <= _pixelSize/2.0 ){
       _pixelBox(i) = 1.0;
@@ -1536,9 +2792,19 @@ void DonutEngine::calcFTPixel(){
   // check if grid is too sparse, then just set the FT(pixel) to all ones
   if (sumOfBox>0.){
     _pixelBox *= (1.0/sumOfBox);           // normalize to 1.0
-    fftShift(_pixelBox,_fftInputArray);  // was InvShift, also don't need pixelBox anymore - this shifts in place
-    _fft2PlanC->execute();
-    _ftsPixel = _fftOutputArray; 
+    if (_halfSpectrum){
+      Matrix realPixelBox(_nbin,_nbin);
+      for (int i=0;i<_nbin*_nbin;i++){
+	realPixelBox(i) = real(_pixelBox(i));
+      }
+      fftShift(realPixelBox,_fftHalfInputArray);
+      _fft2PlanR->execute();
+      _ftsPixel = _fftHalfOutputArray;
+    } else {
+      fftShift(_pixelBox,_fftInputArray);  // was InvShift, also don't need pixelBox anymore - this shifts in place
+      _fft2PlanC->execute();
+      _ftsPixel = _fftOutputArray; 
+    }
   } else {
     _ftsPixel = 1.0;  // sets whole array to 1.0
   }
@@ -1552,43 +2818,178 @@ void DonutEngine::calcFTPixel(){
 
 void DonutEngine::calcConvolute(){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcConv" << std::endl;
   }
         
-  // convolution (now doing it as F-1{F(Optics) F(Atmos) F(Pixels)
-  MatrixC prodFts(_nbin,_nbin);
-  for (int i=0;i<_nbin*_nbin;i++){
-    prodFts(i) = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i);
+  if (useDecimatedFFT()){
+    calcConvoluteDecimated();
+    double stop = wallTime();
+    _timeConvolute += (stop-start);
+    _cpuConvolute += cpuTime()-startCpu;
+    return;
   }
 
-  _ifftInputArray = prodFts;
-  _ifft2PlanC->execute();
-  fftShift(_ifftOutputArray);
-
   // normalize and take absolute value
   Real nsqNorm = 1.0/(_nbin*_nbin);
 
-  // save calculated image
-  for (int i=0;i<_nbin*_nbin;i++){
-    _convOpticsAtmosPixel(i) = abs(_ifftOutputArray(i)) * nsqNorm;
+  if (_halfSpectrum){
+
+    // the product of the three half-spectra is Hermitian, so its inverse FT is real
+    // (with the checkerboard, shifting the output is the same as multiplying the input by (-1)^(ix+iy))
+    if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real sign = (iy%2==0) ? 1.0 : -1.0;
+	int i = iy*_nbinHalf;
+	for (int ix=0;ix<_nbinHalf;ix++){
+	  _ifftHalfInputArray(i) = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i) * sign;
+	  sign = -sign;
+	  i++;
+	}
+      }
+      _ifft2PlanR->execute();
+    } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbinHalf;i++){
+	_ifftHalfInputArray(i) = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i);
+      }
+      _ifft2PlanR->execute();
+      fftShift(_ifftHalfOutputArray);
+    }
+
+    // save calculated image
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<_nbin*_nbin;i++){
+      _convOpticsAtmosPixel(i) = fabs(_ifftHalfOutputArray(i)) * nsqNorm;
+    }
+
+  } else {
+
+    // convolution (now doing it as F-1{F(Optics) F(Atmos) F(Pixels)
+    if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real sign = (iy%2==0) ? 1.0 : -1.0;
+	int i = iy*_nbin;
+	for (int ix=0;ix<_nbin;ix++){
+	  _ifftInputArray(i) = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i) * sign;
+	  sign = -sign;
+	  i++;
+	}
+      }
+      _ifft2PlanC->execute();
+    } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbin;i++){
+	_ifftInputArray(i) = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i);
+      }
+      _ifft2PlanC->execute();
+      fftShift(_ifftOutputArray);
+    }
+
+    // save calculated image
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<_nbin*_nbin;i++){
+      _convOpticsAtmosPixel(i) = abs(_ifftOutputArray(i)) * nsqNorm;
+    }
   }
 
   if (_debugFlag  && nCallsCalcAll<=1){
     toFits(_fptr,_convOpticsAtmosPixel);
   }
 
-  clock_t stop = clock();
-  _timeConvolute += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timeConvolute += (stop-start);
+  _cpuConvolute += cpuTime()-startCpu;
 
 }
         
             
+bool DonutEngine::useDecimatedFFT(){
+  // the first debug call still goes the long way, to fill _convOpticsAtmosPixel
+  return _decimatedFFT && !(_debugFlag && nCallsCalcAll<=1);
+}
+
+void DonutEngine::calcConvoluteDecimated(){
+
+  // Sampling the image at every stride-th grid point is the same as folding (aliasing) its 
+  // spectrum onto nPixels x nPixels, so fold F(Optics) F(Atmos) F(Pixels) and finish with a 
+  // small inverse FFT.  The samples of the unshifted image land on the unshifted small grid,
+  // which is then shifted by nPixels/2 to the pixel grid.
+  int stride = (int) _ngridperPixel;
+  _fftSmallInputArray = 0.0;
+
+  if (_halfSpectrum){
+    // fold both the stored half and its Hermitian mirror  P(-ky,-kx) = conj(P(ky,kx)), 
+    // the columns kx=0 and kx=nbin/2 are their own mirror
+    int i(0);
+    for (int iy=0;iy<_nbin;iy++){
+      Complex* smallRow = &_fftSmallInputArray(iy%_nPixels,0);
+      Complex* smallRowStar = &_fftSmallInputArray((_nbin-iy)%_nPixels,0);
+      for (int ix=0;ix<_nbinHalf;ix++){
+	Complex prodFts = _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i);
+	smallRow[ix%_nPixels] += prodFts;
+	if (ix>0 && ix<_nbin/2){
+	  smallRowStar[(_nbin-ix)%_nPixels] += conj(prodFts);
+	}
+	i++;
+      }
+    }
+  } else {
+    int i(0);
+    for (int iy=0;iy<_nbin;iy++){
+      Complex* smallRow = &_fftSmallInputArray(iy%_nPixels,0);
+      int qx(0);
+      for (int ix=0;ix<_nbin;ix++){
+	smallRow[qx] += _ftsOptics(i) * _ftsAtmos(i) * _ftsPixel(i);
+	qx++;
+	if (qx==_nPixels){
+	  qx = 0;
+	}
+	i++;
+      }
+    }
+  }
+  _ifft2PlanSmall->execute();
+
+  Real gridNorm = (Real)(stride*stride)/(_nbin*_nbin);
+  for (int my=0;my<_nPixels;my++){
+    int qy = (my+_nhalfPixels) % _nPixels;
+    for (int mx=0;mx<_nPixels;mx++){
+      int qx = (mx+_nhalfPixels) % _nPixels;
+      _valPixelCenters(my,mx) = abs(_fftSmallOutputArray(qy,qx)) * gridNorm;
+    }
+  }
+
+}
+
+void DonutEngine::calcQtildeDecimated(Matrix& Qpixels, int sign){
+
+  // Q is zero except on the pixel centers, so its FT over the full grid is periodic with period 
+  // nPixels and equal to the small FT of Qpixels, once Qpixels is shifted like Q would be
+  for (int my=0;my<_nPixels;my++){
+    int qy = (my+_nhalfPixels) % _nPixels;
+    for (int mx=0;mx<_nPixels;mx++){
+      int qx = (mx+_nhalfPixels) % _nPixels;
+      _fftSmallInputArray(qy,qx) = Qpixels(my,mx);
+    }
+  }
+  if (sign<0){
+    _fft2PlanSmall->execute();
+  } else {
+    _ifft2PlanSmall->execute();
+  }
+
+}
+
 void DonutEngine::calcPixelate(){
 
-  clock_t start = clock();
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   if (_printLevel>=2){
     std::cout << "DonutEngine: calcPixelate" << std::endl;
@@ -1597,7 +2998,9 @@ void DonutEngine::calcPixelate(){
   // integer value of ngridperPixel?
   bool useNgridperPixel = (int(_ngridperPixel) == _ngridperPixel);
 
-  if (useNgridperPixel){
+  if (useDecimatedFFT()){
+    // calcConvoluteDecimated has already filled _valPixelCenters
+  } else if (useNgridperPixel){
     // pixelate - now by just selecting every nth grid point!
     // Q: is this there where we are getting offset from the grid center?  should we start at the stride/2 grid point and
     //    then go every stride grid point???
@@ -1637,8 +3040,9 @@ void DonutEngine::calcPixelate(){
     toFits(_fptr,_valPixelCenters);
   }
 
-  clock_t stop = clock();
-  _timePixelate += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timePixelate += (stop-start);
+  _cpuPixelate += cpuTime()-startCpu;
 
 }
  
@@ -1666,35 +3070,109 @@ void DonutEngine::calcPixelate(){
 
 void DonutEngine::calcDerivatives(double* image, int ny, int nx, 
 				  double* weight, int my, int mx){
+#ifdef DONUT_FLOAT
+  std::vector<Real> imageReal(image,image+ny*nx);
+  std::vector<Real> weightReal(weight,weight+my*mx);
+  calcDerivatives(&imageReal[0],&weightReal[0]);
+#else
   calcDerivatives(image,weight);
+#endif
+}
+
+double DonutEngine::calcChi2(double* par, int n, double* image, int ny, int nx, double* invSigmaSq, int my, int mx,
+			     double* grad, int ngrad, double* pullsq, int py, int px){
+
+  // one call for a fit: the image at par, chi2 = sum invSigmaSq*(image-model)^2, and into the caller's 
+  // buffers the squared pulls (if py*px>0) and dChi2/dpar (if ngrad>0), then save par for the next call.
+  // Arrays of the wrong size give NaN, which no minimizer takes for a good point (the Python wrapper raises)
+  int nPix = _nPixels*_nPixels;
+  if (n!=npar || ny*nx!=nPix || my*mx!=nPix || (py*px>0 && py*px!=nPix) || (ngrad>0 && ngrad!=npar)){
+    std::cout << "DonutEngine: ERROR calcChi2 needs " << npar << " parameters, images of " << _nPixels << " by " << _nPixels 
+	      << " and a gradient of size " << npar << std::endl;
+    return std::numeric_limits<double>::quiet_NaN();
+  }
+
+  calcAll(par,n);
+
+  double chi2(0.0);
+  for (int i=0;i<nPix;i++){
+    double diff = image[i] - _calcImage(i);
+    double pull2 = invSigmaSq[i] * diff * diff;
+    chi2 += pull2;
+    if (py*px>0){
+      pullsq[i] = pull2;
+    }
+  }
+
+  if (ngrad>0){
+    calcDerivatives(image,ny,nx,invSigmaSq,my,mx);
+    for (int ipar=0;ipar<npar;ipar++){
+      grad[ipar] = _dChi2dpar[ipar];
+    }
+  }
+
+  savePar();
+  return chi2;
+
 }
 
 void DonutEngine::calcDerivatives(Real* image, Real* weight){
 
   nCallsCalcDerivative++;
 
-  clock_t start = clock();
+  // dChi2/dpar for the same parameters and data as before
+  ImageMemo* memo = 0;
+  if (_imageMemoSize>0){
+    memo = _imageMemo.peek(_imageMemoKey);
+  }
+  if (memo!=0 && memo->generation==_memoGeneration && !memo->derivatives.empty() 
+      && std::equal(image,image+_nPixels*_nPixels,memo->dataImage.begin()) 
+      && std::equal(weight,weight+_nPixels*_nPixels,memo->weight.begin())){
+    for (int ipar=0;ipar<npar;ipar++){
+      _dChi2dpar[ipar] = memo->derivatives[ipar];
+    }
+    _nDerivMemoHits++;
+    return;
+  }
+  if (_imageMemoSize>0){
+    _nDerivMemoMisses++;
+  }
+  restoreMemoHit();
+  refreshOptics();
+
+  double start = wallTime();
+  double startCpu = cpuTime();
 
   // calculate derivatives, put in the _dChi2dpar array
 
   // needed arrays:  calcImage, ftsAtmos, ftsPixel, calcG, calcGstar
-  // local arrays (save time by avoiding re-reserving memory?):
-  //     Qpixels, Q, Qtilde, QQ, QQtilde, QQQ QQQtilde
+  // local arrays Qpixels and Q come from the workspace, and 
+  //     Qtilde, QQ, QQtilde, QQQ, QQQtilde  live in the FFT input and output arrays
 
   // arrays we will need
-  Matrix Qpixels(_nPixels,_nPixels);
-  Matrix Q(_nbin,_nbin);
-  Q = 0.0;
-  MatrixC Qtilde(_nbin,_nbin);
-  MatrixC QQ(_nbin,_nbin);
-  MatrixC QQtilde(_nbin,_nbin);
-  MatrixC QQQ(_nbin,_nbin);
-  MatrixC QQQtilde(_nbin,_nbin);
+  // with the checkerboard Q is not shifted, so it goes straight into the input of the first FFT
+  _workspace.reset();
+  // with the decimated FFT Q is never built on the full grid, see calcQtildeDecimated
+  bool decimated = useDecimatedFFT();
+  Matrix Qpixels(_nPixels,_nPixels,_workspace.get<Real>(_nPixels*_nPixels));
+  Matrix Q;
+  if (decimated){
+    // nothing to prepare
+  } else if (!_checkerboard){
+    Q.Dimension(_nbin,_nbin,_workspace.get<Real>(_nbin*_nbin));
+    Q = 0.0;
+  } else if (_halfSpectrum){
+    _fftHalfInputArray = 0.0;
+  } else {
+    _ifftInputArray = 0.0;
+  }
 
-  clock_t stop = clock();
-  _timeDerivatives0 += (stop-start)/(Real)CLOCKS_PER_SEC;
+  double stop = wallTime();
+  _timeDerivatives0 += (stop-start);
+  _cpuDerivatives0 += cpuTime()-startCpu;
 
-  start = clock();
+  start = wallTime();
+  startCpu = cpuTime();
 
   // calculate Q = W(I-N)
   for (int i=0;i<_nPixels*_nPixels;i++){
@@ -1706,95 +3184,243 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
   int pixIndex(0);
   int stride = (int) _ngridperPixel;
 
-  for (int j=0;j<_nbin;j=j+stride){
-    for (int i=0;i<_nbin;i=i+stride){
-	Q(index) = Qpixels(pixIndex);
+  if (!decimated){
+    for (int j=0;j<_nbin;j=j+stride){
+      for (int i=0;i<_nbin;i=i+stride){
+	if (!_checkerboard){
+	  Q(index) = Qpixels(pixIndex);
+	} else if (_halfSpectrum){
+	  _fftHalfInputArray(index) = Qpixels(pixIndex);
+	} else {
+	  _ifftInputArray(index) = Qpixels(pixIndex);
+	}
 
 	index = index + stride;
 	pixIndex++;
+      }
+      index = index + _nbin*(stride-1);
     }
-    index = index + _nbin*(stride-1);
   }
 
   // FT^-1{Q}
-  fftShift(Q); //was InvShift
-  realToComplex(Q,_ifftInputArray);  
-  _ifft2PlanC->execute();
-  Qtilde = _ifftOutputArray;
+  // with the checkerboard, the shift of Q becomes a factor (-1)^(ix+iy) on Qtilde
+  if (!_checkerboard && !decimated){
+    fftShift(Q); //was InvShift
+  }
+  Real QQnorm = 1.0/(_nbin * _nbin);
+  Real QQQnorm = 1.0/(_nbin * _nbin);
+  Real QQandQQQnorm = QQnorm * QQQnorm;
 
-  //_fftrtcInputArray = Q;
-  //_fft2rtcPlanC->execute();
-  //Qtilde = _fftrtcOutputArray;
+  // with the checkerboard, the shift of QQQtilde becomes a factor (-1)^(ix+iy) on QQQ, 
+  // applied together with the normalization when QQQ is filled
+
+  if (_halfSpectrum){
+
+    // Q is real, so FT^-1{Q} = conj(F{Q}), and QQtilde = F{ Qtilde * ftsAtmos * ftsPixel } is real, 
+    // which is the c2r transform of its conjugate:  QQtilde = F^-1{ F{Q} * conj(ftsAtmos * ftsPixel) }
+    if (decimated){
+      // F{Q} is periodic with period nPixels, tile the small FFT over the half-spectrum
+      calcQtildeDecimated(Qpixels,-1);
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Complex* smallRow = &_fftSmallOutputArray(iy%_nPixels,0);
+	int i = iy*_nbinHalf;
+	int qx(0);
+	for (int ix=0;ix<_nbinHalf;ix++){
+	  _ifftHalfInputArray(i) = smallRow[qx] * conj(_ftsAtmos(i) * _ftsPixel(i));
+	  qx++;
+	  if (qx==_nPixels){
+	    qx = 0;
+	  }
+	  i++;
+	}
+      }
+    } else if (_checkerboard){
+      _fft2PlanR->execute();
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real sign = (iy%2==0) ? 1.0 : -1.0;
+	int i = iy*_nbinHalf;
+	for (int ix=0;ix<_nbinHalf;ix++){
+	  _ifftHalfInputArray(i) = _fftHalfOutputArray(i) * conj(_ftsAtmos(i) * _ftsPixel(i)) * sign;
+	  sign = -sign;
+	  i++;
+	}
+      }
+    } else {
+      _fftHalfInputArray = Q;
+      _fft2PlanR->execute();
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbinHalf;i++){
+	_ifftHalfInputArray(i) = _fftHalfOutputArray(i) * conj(_ftsAtmos(i) * _ftsPixel(i));
+      }
+    }
+    _ifft2PlanR->execute();
+
+    // QQQ into _fftInputArray
+    if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real signNorm = (iy%2==0) ? QQandQQQnorm : -QQandQQQnorm;
+	int i = iy*_nbin;
+	for (int ix=0;ix<_nbin;ix++){
+	  _fftInputArray(i) = _calcG(i) * (_ifftHalfOutputArray(i) * signNorm);
+	  signNorm = -signNorm;
+	  i++;
+	}
+      }
+    } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbin;i++){ 
+	_fftInputArray(i) = _calcG(i) * _ifftHalfOutputArray(i);
+      }
+    }
 
+  } else {
 
-  // F{ Qtilde * ftsAtmos * ftsPixel}
-  for (int i=0;i<_nbin*_nbin;i++){
-    QQ(i) = Qtilde(i) * _ftsAtmos(i) * _ftsPixel(i);
-  }
-  _fftInputArray = QQ;
-  _fft2PlanC->execute();
-  Real QQnorm = 1.0/(_nbin * _nbin);
-  QQtilde = _fftOutputArray;
-  //QQtilde *= QQnorm;
+    // Qtilde in _ifftOutputArray
+    if (!_checkerboard && !decimated){
+      realToComplex(Q,_ifftInputArray);  
+    }
+    if (!decimated){
+      _ifft2PlanC->execute();
+    }
 
-  // QQQstartilde and QQQtilde are complex conj, can use that, instead of separate calcs
-  // since QQtilde is all real
-  // F{ G * QQtilde } 
 
-  for (int i=0;i<_nbin*_nbin;i++){ 
-    QQQ(i) = _calcG(i) * QQtilde(i);
+    // F{ Qtilde * ftsAtmos * ftsPixel},  QQ in _fftInputArray and QQtilde in _fftOutputArray
+    if (decimated){
+      // Qtilde is periodic with period nPixels, tile the small inverse FFT over the full grid
+      calcQtildeDecimated(Qpixels,1);
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Complex* smallRow = &_fftSmallOutputArray(iy%_nPixels,0);
+	int i = iy*_nbin;
+	int qx(0);
+	for (int ix=0;ix<_nbin;ix++){
+	  _fftInputArray(i) = smallRow[qx] * _ftsAtmos(i) * _ftsPixel(i);
+	  qx++;
+	  if (qx==_nPixels){
+	    qx = 0;
+	  }
+	  i++;
+	}
+      }
+    } else if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real sign = (iy%2==0) ? 1.0 : -1.0;
+	int i = iy*_nbin;
+	for (int ix=0;ix<_nbin;ix++){
+	  _fftInputArray(i) = _ifftOutputArray(i) * _ftsAtmos(i) * _ftsPixel(i) * sign;
+	  sign = -sign;
+	  i++;
+	}
+      }
+    } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbin;i++){
+	_fftInputArray(i) = _ifftOutputArray(i) * _ftsAtmos(i) * _ftsPixel(i);
+      }
+    }
+    _fft2PlanC->execute();
+    //QQtilde *= QQnorm;
+
+    // QQQstartilde and QQQtilde are complex conj, can use that, instead of separate calcs
+    // since QQtilde is all real
+    // F{ G * QQtilde },  QQQ in _fftInputArray
+
+    if (_checkerboard){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int iy=0;iy<_nbin;iy++){
+	Real signNorm = (iy%2==0) ? QQandQQQnorm : -QQandQQQnorm;
+	int i = iy*_nbin;
+	for (int ix=0;ix<_nbin;ix++){
+	  _fftInputArray(i) = _calcG(i) * (_fftOutputArray(i) * signNorm);
+	  signNorm = -signNorm;
+	  i++;
+	}
+      }
+    } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+      for (int i=0;i<_nbin*_nbin;i++){ 
+	_fftInputArray(i) = _calcG(i) * _fftOutputArray(i);
+      }
+    }
   }
-  _fftInputArray = QQQ;
   _fft2PlanC->execute();
-  Real QQQnorm = 1.0/(_nbin * _nbin);
-  fftShift(_fftOutputArray);
-  QQQtilde = _fftOutputArray;
-  Real QQandQQQnorm = QQnorm * QQQnorm;
-  QQQtilde *= QQandQQQnorm;
+  if (!_checkerboard){
+    fftShift(_fftOutputArray);
+  }
+  MatrixC QQQtilde(_nbin,_nbin,_fftOutputArray());   // a view, not a copy
+  if (!_checkerboard){
+    QQQtilde *= QQandQQQnorm;
+  }
 
-  stop = clock();
-  _timeDerivatives1 += (stop-start)/(Real)CLOCKS_PER_SEC;
+  stop = wallTime();
+  _timeDerivatives1 += (stop-start);
+  _cpuDerivatives1 += cpuTime()-startCpu;
 
-  start = clock();
+  start = wallTime();
+  startCpu = cpuTime();
 
   // dg*(x)/dalpha * QQQtilde
-  Vector dChi2dzern(nZernikeSize);
+  Vector dChi2dzern(nZernikeSize,_workspace.get<Real>(nZernikeSize));
+  for (int iZ=0;iZ<nZernikeSize;iZ++){
+    dChi2dzern[iZ] = 0.0;
+  }
   
   // Loop over Zernike terms - only need nZernikeSize=nZernikeTerm-1 of them!!!
   Complex minustwopiI(0.0,-2.0*_M_PI);
   Real minustwopi(-2.0*_M_PI);
-  for (int iZ=0;iZ<nZernikeSize;iZ++){
-
-    MatrixC dgdalphaStar(_nbin,_nbin);
-    dgdalphaStar = 0.0;
-    Matrix zernikeTemp = _zernikeObject->_zernikeTerm[iZ+1];  // since nZernikeSize = nZernikeTerm-1
-    for (int i=0;i<_nbin*_nbin;i++){
-      // these are complex conj too, can calculate more compactly, 4.0 * Re{} below
-      // move 2piI below, was
-      // dgdalphaStar(i) = minustwopiI *  _pupilFuncStar(i) * zernikeTemp(i);
-      dgdalphaStar(i) =  _pupilFuncStar(i) * zernikeTemp(i);
-      ////dgdalpha = 2.0 * numpy.pi * 1j *  _pupilFunc * _zernikeObject->_zernikeTerm[iZ]
-    }
 
-    ////dChi2dalpha[iZ] = 2.0 * _nEle *  (dgdalphaStar * QQQtilde).sum()  + 2.0 * _nEle *  (dgdalpha * QQQstartilde).sum()
-    ////is equal to    dChi2dzern[iZ] = 4.0 * _nEle *  ((dgdalphaStar * QQQtilde).real).sum()
-    dChi2dzern[iZ] = 0.0;
-    for (int i=0;i<_nbin*_nbin;i++){
-      //      dChi2dzern[iZ] += real(dgdalphaStar(i)*QQQtilde(i));
-      dChi2dzern[iZ] -= imag(dgdalphaStar(i)*QQQtilde(i));  //note its -= not += !!
+  // these are complex conj too, can calculate more compactly, 4.0 * Re{} below
+  // move 2piI below, was
+  // dgdalphaStar(i) = minustwopiI *  conj(_pupilFunc(i)) * zernikeTemp(i);
+  ////dgdalpha = 2.0 * numpy.pi * 1j *  _pupilFunc * _zernikeObject->_zernikeTerm[iZ]
+
+  ////dChi2dalpha[iZ] = 2.0 * _nEle *  (dgdalphaStar * QQQtilde).sum()  + 2.0 * _nEle *  (dgdalpha * QQQstartilde).sum()
+  ////is equal to    dChi2dzern[iZ] = 4.0 * _nEle *  ((dgdalphaStar * QQQtilde).real).sum()
+  //// and since the Zernike terms are real:  dChi2dzern[iZ] = -sum_k Z[iZ][k] * imag(pupilFuncStar*QQQtilde)[k]
+  //// over the pupil support, ie. one matrix-vector product for all floating terms
+  if (_floatingChanged){
+    makeZernikeFloating();
+  }
+  int nSupport = _pupilSupport.size();
+  int nFloating = _floatingZernike.size();
+  if (nFloating>0 && nSupport>0){
+    Vector pupilQQQ(nSupport,_workspace.get<Real>(nSupport));
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int k=0;k<nSupport;k++){
+      int i = _pupilSupport[k];
+      pupilQQQ[k] = imag(conj(_pupilFunc(i))*QQQtilde(i));
     }
-    dChi2dzern[iZ] *= (4.0 * _nEle * minustwopi * 86.8692) ; 
-    // why oh why am I off by this weird number??!!
-    //    dChi2dzern[iZ] *= 86.8692;
-
+    Vector dChi2dfloat(nFloating,_workspace.get<Real>(nFloating));
+    Real scaleZern = -(4.0 * _nEle * minustwopi * 86.8692)/(_scaleFactor*_scaleFactor*_scaleFactor);  //note the - sign!!
+    // why oh why am I off by this weird number 86.8692??!!
     // need extra scaling  with scaleFactor - 3 factors, 1 for Zernikes, 2 for grid
-    dChi2dzern[iZ] = dChi2dzern[iZ]/(_scaleFactor*_scaleFactor*_scaleFactor);
-
+#ifdef DONUT_USE_BLAS
+    cblas_gemv(CblasRowMajor,CblasNoTrans,nFloating,nSupport,scaleZern,_zernikeFloating(),_zernikeFloating.Ny(),
+		&pupilQQQ[0],1,0.0,&dChi2dfloat[0],1);
+#else
+    // one term per thread, so each sum is done in the same order for any number of threads
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int jZ=0;jZ<nFloating;jZ++){
+      Real* zRow = &_zernikeFloating(jZ,0);
+      double sum(0.);
+      for (int k=0;k<nSupport;k++){
+	sum += zRow[k] * pupilQQQ[k];
+      }
+      dChi2dfloat[jZ] = scaleZern * sum;
+    }
+#endif
+    for (int jZ=0;jZ<nFloating;jZ++){
+      dChi2dzern[_floatingZernike[jZ]] = dChi2dfloat[jZ];
+    }
   }
 
   // also calculate derivative of Nele,bckg and rzero
-  Real dChi2dnele(0.);
-  Real dChi2dbkgd(0.);
+  double dChi2dnele(0.);
+  double dChi2dbkgd(0.);
   for (int i=0;i<_nPixels*_nPixels;i++){
     dChi2dnele += 2.0 * Qpixels(i) * (_calcImage(i) - _bkgd) / _nEle; 
     dChi2dbkgd += 2.0 * Qpixels(i);
@@ -1806,7 +3432,7 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
   if (_calcRzeroDerivative){
 
     // calculate Chi2 value now
-    Real chi2nominal(0.);
+    double chi2nominal(0.);
     for (int i=0;i<_nPixels*_nPixels;i++){
       chi2nominal = chi2nominal + weight[i] * (_calcImage(i) - image[i]) * (_calcImage(i) - image[i]);
     }
@@ -1830,7 +3456,7 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
     _anotherDonutEngine->calcAll(parToUse);
 
     // calculate Chi2 value at this +delta value
-    Real chi2deltaplus(0.);
+    double chi2deltaplus(0.);
     for (int i=0;i<_nPixels*_nPixels;i++){
       chi2deltaplus = chi2deltaplus + weight[i] * pow(_anotherDonutEngine->getImage()(i) - image[i],2);
     }
@@ -1841,7 +3467,7 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
     _anotherDonutEngine->calcAll(parToUse);
 
     // calculate Chi2 value at this +delta value
-    Real chi2deltaminus(0.);
+    double chi2deltaminus(0.);
     for (int i=0;i<_nPixels*_nPixels;i++){
       chi2deltaminus = chi2deltaminus + weight[i] * pow(_anotherDonutEngine->getImage()(i) - image[i],2);
     }
@@ -1858,6 +3484,13 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
     _dChi2dpar[ipar_ZernikeFirst+iZ] = dChi2dzern[iZ];
   }
 
+  if (memo!=0){
+    memo->derivatives.assign(_dChi2dpar(),_dChi2dpar()+npar);
+    memo->dataImage.assign(image,image+_nPixels*_nPixels);
+    memo->weight.assign(weight,weight+_nPixels*_nPixels);
+    memo->generation = _memoGeneration;
+  }
+
   // print out Derivatives
   if (_printLevel>=2){
     std::cout << "DonutEngine: Derivatives are = " ;
@@ -1868,8 +3501,9 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
   }
 
 
-  stop = clock();
-  _timeDerivatives2 += (stop-start)/(Real)CLOCKS_PER_SEC;
+  stop = wallTime();
+  _timeDerivatives2 += (stop-start);
+  _cpuDerivatives2 += cpuTime()-startCpu;
 
 }
 
@@ -1911,6 +3545,166 @@ void DonutEngine::calcDerivatives(Real* image, Real* weight){
     //     return transArray,calcImageSaved
     
 
+void DonutEngine::calcJacobian(){
+
+  // Fill _jacobian(pixel,j) = d image[pixel] / d par[_floatingPar[j]], for the parameters of the last calcAll.
+  // The Zernike columns are forward derivatives through the same chain as the image:
+  //    dG = F^-1{ 2 pi i Z/scaleFactor * pupilFunc } ,  dPsf = 2 Re{G* dG} ,  dImage = nEle * pixelate( dPsf (x) Atmos (x) Pixel )
+  // at 3 FFTs per floating term, nEle and bkgd are exact, and rzero uses the same finite difference as calcDerivatives.
+  // All modes work on the full grid here, with explicit shifts, so the checkerboard and decimated FFT do not matter.
+  nCallsCalcJacobian++;
+  restoreMemoHit();
+  refreshOptics();
+
+  double start = wallTime();
+  double startCpu = cpuTime();
+
+  int nPixSq = _nPixels*_nPixels;
+  int nFloatingPar = _floatingPar.size();
+  if (_jacobian.Nx()!=(unsigned int)nPixSq || _jacobian.Ny()!=(unsigned int)nFloatingPar){
+    _jacobian.Deallocate();
+    _jacobian.Dimension(nPixSq,nFloatingPar);
+    _jacobian.Activate(alignR);
+  }
+  _jacobian = 0.0;
+
+  _workspace.reset();
+  Matrix pixels(_nPixels,_nPixels,_workspace.get<Real>(nPixSq));
+  Matrix signConv(_nPixels,_nPixels,_workspace.get<Real>(nPixSq));
+
+  // the image is the absolute value of the convolution, so its derivative needs the sign of the convolution
+  // (F{psfOptics} is _ftsOptics, in the same layout as the forward FFT output)
+  if (_halfSpectrum){
+    _fftHalfOutputArray = _ftsOptics;
+  } else {
+    _fftOutputArray = _ftsOptics;
+  }
+  convolvePixels(signConv());
+  for (int i=0;i<nPixSq;i++){
+    signConv(i) = (signConv(i)<0.0) ? -1.0 : 1.0;
+  }
+
+  if (_floatingChanged){
+    makeZernikeFloating();
+  }
+  int nSupport = _pupilSupport.size();
+  int half = _nbin/2;
+  Real normalizationG = 1.0/(_nbin*_pupilSNorm);
+  Complex dWave(0.0,2.0*_M_PI/_scaleFactor);
+  for (int j=0;j<nFloatingPar;j++){
+    int ipar = _floatingPar[j];
+
+    if (ipar==ipar_nEle){
+      for (int i=0;i<nPixSq;i++){
+	_jacobian(i,j) = _valPixelCenters(i);
+      }
+
+    } else if (ipar==ipar_bkgd){
+      for (int i=0;i<nPixSq;i++){
+	_jacobian(i,j) = 1.0;
+      }
+
+    } else if (ipar==ipar_rzero){
+      if (_calcRzeroDerivative){
+	Real delta(0.0005);
+	Vector parToUse;
+	parToUse.Dimension(npar);
+	parToUse.Activate();
+	for (int jpar=0;jpar<npar;jpar++){
+	  parToUse[jpar] = _parCurrent[jpar];
+	}
+	_anotherDonutEngine->setXYDECam(_xDECam,_yDECam);
+	parToUse[ipar_rzero] = _parCurrent[ipar_rzero] + delta;
+	_anotherDonutEngine->calcAll(parToUse);
+	for (int i=0;i<nPixSq;i++){
+	  pixels(i) = _anotherDonutEngine->getImage()(i);
+	}
+	parToUse[ipar_rzero] = _parCurrent[ipar_rzero] - delta;
+	_anotherDonutEngine->calcAll(parToUse);
+	for (int i=0;i<nPixSq;i++){
+	  _jacobian(i,j) = (pixels(i) - _anotherDonutEngine->getImage()(i))/(2.*delta);
+	}
+      }
+
+    } else {
+      // Zernike term, basis on the pupil support from _zernikeFloating
+      int iZ = ipar - ipar_ZernikeFirst;
+      int jZ = std::find(_floatingZernike.begin(),_floatingZernike.end(),iZ) - _floatingZernike.begin();
+      const Real* zRow = &_zernikeFloating(jZ,0);
+
+      // shift d pupilFunc straight into the inverse FFT input
+      _ifftInputArray = 0.0;
+      for (int k=0;k<nSupport;k++){
+	int i = _pupilSupport[k];
+	int iy = ((i/_nbin) + half) % _nbin;
+	int ix = ((i%_nbin) + half) % _nbin;
+	_ifftInputArray(iy,ix) = dWave * zRow[k] * _pupilFunc(i);
+      }
+      _ifft2PlanC->execute();
+
+      if (_halfSpectrum){
+	for (int i=0;i<_nbin*_nbin;i++){
+	  _fftHalfInputArray(i) = 2.0 * real(conj(_calcG(i)) * _ifftOutputArray(i)) * normalizationG;
+	}
+	_fft2PlanR->execute();
+      } else {
+	for (int i=0;i<_nbin*_nbin;i++){
+	  _fftInputArray(i) = 2.0 * real(conj(_calcG(i)) * _ifftOutputArray(i)) * normalizationG;
+	}
+	_fft2PlanC->execute();
+      }
+      convolvePixels(pixels());
+      for (int i=0;i<nPixSq;i++){
+	_jacobian(i,j) = _nEle * signConv(i) * pixels(i);
+      }
+    }
+  }
+
+  double stop = wallTime();
+  _timeJacobian += (stop-start);
+  _cpuJacobian += cpuTime()-startCpu;
+
+}
+
+void DonutEngine::convolvePixels(Real* pixels){
+
+  // pixels = the pixel center values of F^-1{ fts * ftsAtmos * ftsPixel }, with fts in the output array of the 
+  // forward FFT (_fftHalfOutputArray or _fftOutputArray).  Signed, and normalized like calcConvolute and calcPixelate.
+  Real norm = _ngridperPixel*_ngridperPixel/(_nbin*_nbin);
+  int stride = (int) _ngridperPixel;
+  int half = _nbin/2;
+  if (_halfSpectrum){
+    for (int i=0;i<_nbin*_nbinHalf;i++){
+      _ifftHalfInputArray(i) = _fftHalfOutputArray(i) * _ftsAtmos(i) * _ftsPixel(i);
+    }
+    _ifft2PlanR->execute();
+  } else {
+    for (int i=0;i<_nbin*_nbin;i++){
+      _ifftInputArray(i) = _fftOutputArray(i) * _ftsAtmos(i) * _ftsPixel(i);
+    }
+    _ifft2PlanC->execute();
+  }
+
+  // the image is the shifted convolution sampled every stride bins, so read the unshifted one at the shifted bins
+  int pixIndex(0);
+  for (int my=0;my<_nPixels;my++){
+    int iy = (my*stride + half) % _nbin;
+    for (int mx=0;mx<_nPixels;mx++){
+      int ix = (mx*stride + half) % _nbin;
+      Real conv = _halfSpectrum ? _ifftHalfOutputArray(iy,ix) : real(_ifftOutputArray(iy,ix));
+      pixels[pixIndex] = conv * norm;
+      pixIndex++;
+    }
+  }
+
+}
+
+void DonutEngine::getvJacobian(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  *DIM1 = _jacobian.Nx();
+  *DIM2 = _jacobian.Ny();
+  *ARGOUTVIEW_ARRAY2 = _jacobian();
+}
+
 void DonutEngine::realToComplex(Matrix& in, MatrixC& out){
 
   int n = in.Nx() * in.Ny();
@@ -1939,47 +3733,245 @@ void DonutEngine::resetTimers(){
   _timePupilMask=0.0;
   _timePupilFunc= 0.0;
   _timeOptics= 0.0;
+  _timeTiltShift = 0.0;
   _timeAtmos= 0.0;
   _timeConvolute= 0.0;
   _timePixelate= 0.0;
   _timeDerivatives0 = 0.0;
   _timeDerivatives1 = 0.0;
   _timeDerivatives2 = 0.0;
+  _timeJacobian = 0.0;
+  _cpuPupilMask = 0.0;
+  _cpuPupilFunc = 0.0;
+  _cpuOptics = 0.0;
+  _cpuTiltShift = 0.0;
+  _cpuAtmos = 0.0;
+  _cpuConvolute = 0.0;
+  _cpuPixelate = 0.0;
+  _cpuDerivatives0 = 0.0;
+  _cpuDerivatives1 = 0.0;
+  _cpuDerivatives2 = 0.0;
+  _cpuJacobian = 0.0;
+}
+
+void DonutEngine::resetCounters(){
+  nCallsCalcAll = 0;
+  nCallsCalcDerivative = 0;
+  nCallsCalcJacobian = 0;
+  _nPupilMaskCalc = 0;
+  _nPupilMaskSkip = 0;
+  _nPupilFuncCalc = 0;
+  _nPupilFuncSkip = 0;
+  _nTiltShift = 0;
+  _nAtmosCalc = 0;
+  _nAtmosSkip = 0;
+  _nConvoluteCalc = 0;
+  _nConvoluteSkip = 0;
+  _pupilMaskCache.resetCounters();
+  _atmosCache.resetCounters();
+  _imageMemo.resetCounters();
+  _nDerivMemoHits = 0;
+  _nDerivMemoMisses = 0;
 }
 
 void DonutEngine::printTimers(){
 
-  std::cout << "DonutEngine Timers " << std::endl;
-  std::cout << "     Pupil Mask     = " << _timePupilMask << std::endl;
-  std::cout << "     Pupil Func     = " << _timePupilFunc << std::endl;
-  std::cout << "     Optics         = " << _timeOptics << std::endl;
-  std::cout << "     Atmos          = " << _timeAtmos << std::endl;
-  std::cout << "     Convolute      = " << _timeConvolute << std::endl;
-  std::cout << "     Pixelate       = " << _timePixelate << std::endl;
-  std::cout << "     Derivatives0   = " << _timeDerivatives0 << std::endl;
-  std::cout << "     Derivatives1   = " << _timeDerivatives1 << std::endl;
-  std::cout << "     Derivatives2   = " << _timeDerivatives2 << std::endl;
+  // wall-clock times show the speedup from nThreads>1 directly, CPU times are summed over the threads
+  std::cout << "DonutEngine Timers (wall-clock / CPU seconds, nThreads = " << _nThreads << ")" << std::endl;
+  std::cout << "     Pupil Mask     = " << _timePupilMask << " / " << _cpuPupilMask << std::endl;
+  std::cout << "     Pupil Func     = " << _timePupilFunc << " / " << _cpuPupilFunc << std::endl;
+  std::cout << "     Optics         = " << _timeOptics << " / " << _cpuOptics << std::endl;
+  std::cout << "     Tilt Shift     = " << _timeTiltShift << " / " << _cpuTiltShift << std::endl;
+  std::cout << "     Atmos          = " << _timeAtmos << " / " << _cpuAtmos << std::endl;
+  std::cout << "     Convolute      = " << _timeConvolute << " / " << _cpuConvolute << std::endl;
+  std::cout << "     Pixelate       = " << _timePixelate << " / " << _cpuPixelate << std::endl;
+  std::cout << "     Derivatives0   = " << _timeDerivatives0 << " / " << _cpuDerivatives0 << std::endl;
+  std::cout << "     Derivatives1   = " << _timeDerivatives1 << " / " << _cpuDerivatives1 << std::endl;
+  std::cout << "     Derivatives2   = " << _timeDerivatives2 << " / " << _cpuDerivatives2 << std::endl;
+  std::cout << "     Jacobian       = " << _timeJacobian << " / " << _cpuJacobian << std::endl;
+  std::cout << "     calcAll calls = " << nCallsCalcAll << "  calcDerivatives calls = " << nCallsCalcDerivative 
+	    << "  calcJacobian calls = " << nCallsCalcJacobian << std::endl;
+  std::cout << "     State machine calculated/skipped:  Pupil Mask " << _nPupilMaskCalc << "/" << _nPupilMaskSkip
+	    << "  Pupil Func " << _nPupilFuncCalc << "/" << _nPupilFuncSkip << " (tilt shifts " << _nTiltShift << ")  Atmos " << _nAtmosCalc << "/" << _nAtmosSkip
+	    << "  Convolute " << _nConvoluteCalc << "/" << _nConvoluteSkip << std::endl;
+  if (_pupilMaskCacheSize>0){
+    std::cout << "     Pupil Mask cache hits/misses = " << _pupilMaskCache.hits() << "/" << _pupilMaskCache.misses() << std::endl;
+  }
+  if (_analyticAtmos){
+    std::cout << "     Atmos cache hits/misses = " << _atmosCache.hits() << "/" << _atmosCache.misses() << std::endl;
+  }
+  if (_imageMemoSize>0){
+    std::cout << "     Image memo hits/misses = " << _imageMemo.hits() << "/" << _imageMemo.misses() 
+	      << "  derivatives hits/misses = " << _nDerivMemoHits << "/" << _nDerivMemoMisses << std::endl;
+  }
+}
+
+MapStoD DonutEngine::getTimers(){
+
+  // wall-clock and CPU seconds per stage, since the last resetTimers
+  MapStoD timers;
+  timers["pupilMaskWall"] = _timePupilMask;
+  timers["pupilMaskCpu"] = _cpuPupilMask;
+  timers["pupilFuncWall"] = _timePupilFunc;
+  timers["pupilFuncCpu"] = _cpuPupilFunc;
+  timers["opticsWall"] = _timeOptics;
+  timers["opticsCpu"] = _cpuOptics;
+  timers["tiltShiftWall"] = _timeTiltShift;
+  timers["tiltShiftCpu"] = _cpuTiltShift;
+  timers["atmosWall"] = _timeAtmos;
+  timers["atmosCpu"] = _cpuAtmos;
+  timers["convoluteWall"] = _timeConvolute;
+  timers["convoluteCpu"] = _cpuConvolute;
+  timers["pixelateWall"] = _timePixelate;
+  timers["pixelateCpu"] = _cpuPixelate;
+  timers["derivatives0Wall"] = _timeDerivatives0;
+  timers["derivatives0Cpu"] = _cpuDerivatives0;
+  timers["derivatives1Wall"] = _timeDerivatives1;
+  timers["derivatives1Cpu"] = _cpuDerivatives1;
+  timers["derivatives2Wall"] = _timeDerivatives2;
+  timers["derivatives2Cpu"] = _cpuDerivatives2;
+  timers["jacobianWall"] = _timeJacobian;
+  timers["jacobianCpu"] = _cpuJacobian;
+  return timers;
+
+}
+
+MapStoI DonutEngine::getCounters(){
+
+  // call counts, state machine branches and cache statistics, since the last resetCounters
+  MapStoI counters;
+  counters["calcAll"] = nCallsCalcAll;
+  counters["calcDerivatives"] = nCallsCalcDerivative;
+  counters["calcJacobian"] = nCallsCalcJacobian;
+  counters["pupilMaskCalc"] = _nPupilMaskCalc;
+  counters["pupilMaskSkip"] = _nPupilMaskSkip;
+  counters["pupilFuncCalc"] = _nPupilFuncCalc;
+  counters["pupilFuncSkip"] = _nPupilFuncSkip;
+  counters["tiltShift"] = _nTiltShift;
+  counters["atmosCalc"] = _nAtmosCalc;
+  counters["atmosSkip"] = _nAtmosSkip;
+  counters["convoluteCalc"] = _nConvoluteCalc;
+  counters["convoluteSkip"] = _nConvoluteSkip;
+  counters["pupilMaskCacheHits"] = _pupilMaskCache.hits();
+  counters["pupilMaskCacheMisses"] = _pupilMaskCache.misses();
+  counters["atmosCacheHits"] = _atmosCache.hits();
+  counters["atmosCacheMisses"] = _atmosCache.misses();
+  counters["imageMemoHits"] = _imageMemo.hits();
+  counters["imageMemoMisses"] = _imageMemo.misses();
+  counters["derivativeMemoHits"] = _nDerivMemoHits;
+  counters["derivativeMemoMisses"] = _nDerivMemoMisses;
+  counters["zernikeTermsBuilt"] = (_zernikeObject->isCompact() ? _zernikeObject->nTermsBuilt() : nZernikeSize+1);
+  counters["zernikeCacheMapped"] = (int) _zernikeObject->isMapped();
+  return counters;
+
+}
+
+// size of an array in MBytes
+static double arrayMB(const Matrix& a){return a.Nx()*a.Ny()*sizeof(Real)/1.0e6;}
+static double arrayMB(const MatrixC& a){return a.Nx()*a.Ny()*sizeof(Complex)/1.0e6;}
+static double arrayMB(const AofMatrix& a){return a.Nx()*a.Ny()*a.Nz()*sizeof(Real)/1.0e6;}
+static double arrayMB(const AofMatrixC& a){return a.Nx()*a.Ny()*a.Nz()*sizeof(Complex)/1.0e6;}
+
+MapStoD DonutEngine::getMemory(){
+
+  // MBytes of the arrays held by this engine, by group.  total is this engine's own footprint, context is
+  // the shared engine context (not in total), and rzeroEngine the total of the engine made for calcRzeroDerivative
+  MapStoD memory;
+  double gridMB = arrayMB(_xaxis) + arrayMB(_yaxis) + arrayMB(_rho) + arrayMB(_theta) + arrayMB(_xpsf) + arrayMB(_ypsf) 
+    + arrayMB(_rAtmos) + arrayMB(_shftrAtmos) + arrayMB(_atmosR53);
+  double pupilMB = arrayMB(_pupilMask) + arrayMB(_pupilWaveZernike) + arrayMB(_pupilFunc)
+    + _pupilSupport.size()*sizeof(int)/1.0e6 + _pupilWaveSupport.Nx()*sizeof(Real)/1.0e6;
+  double psfMB = arrayMB(_calcG) + arrayMB(_psfOptics) + arrayMB(_ftsOptics) + arrayMB(_psfAtmos) + arrayMB(_ftsAtmos)
+    + arrayMB(_pixelBox) + arrayMB(_ftsPixel) + arrayMB(_convOpticsAtmosPixel) + arrayMB(_valPixelCenters) + arrayMB(_calcImage)
+    + arrayMB(_jacobian);
+  double fftMB = arrayMB(_fftInputArray) + arrayMB(_fftOutputArray) + arrayMB(_ifftInputArray) + arrayMB(_ifftOutputArray) 
+    + arrayMB(_fftHalfInputArray) + arrayMB(_fftHalfOutputArray) + arrayMB(_ifftHalfInputArray) + arrayMB(_ifftHalfOutputArray)
+    + arrayMB(_fftSmallInputArray) + arrayMB(_fftSmallOutputArray);
+  double batchMB = arrayMB(_batchInputArray) + arrayMB(_batchOutputArray) + arrayMB(_batchHalfRealArray) + arrayMB(_batchHalfSpectrumArray);
+  double zernikeMB = _zernikeObject->memoryBytes()/1.0e6 + arrayMB(_zernikeSupport) + _pupilSupportAperture.size()*sizeof(int)/1.0e6;
+  if (_zernikeFloating.test(Matrix::allocated)){
+    zernikeMB += arrayMB(_zernikeFloating);   // otherwise just a view of _zernikeSupport
+  }
+  // with an engine context the grids, the pixel arrays and the (non-compact) Zernike basis are the context's
+  double contextMB = 0.0;
+  if (_context!=0){
+    contextMB = _context->memoryBytes()/1.0e6;
+    gridMB = 0.0;
+    psfMB -= arrayMB(_pixelBox) + arrayMB(_ftsPixel);
+    if (!_compactZernike){
+      zernikeMB -= _zernikeObject->memoryBytes()/1.0e6;
+    }
+  }
+  double cacheMB = _atmosCache.size()*_ftsAtmos.Nx()*_ftsAtmos.Ny()*sizeof(Real)/1.0e6
+    + _pupilMaskCache.size()*((_nbin*_nbin+31)/32)*sizeof(unsigned int)/1.0e6
+    + _imageMemo.size()*(3*_nPixels*_nPixels+npar)*sizeof(Real)/1.0e6;
+  double workspaceMB = _workspace.size()/1.0e6;
+
+  memory["grid"] = gridMB;
+  memory["pupil"] = pupilMB;
+  memory["psf"] = psfMB;
+  memory["fft"] = fftMB;
+  memory["batch"] = batchMB;
+  memory["zernike"] = zernikeMB;
+  memory["cache"] = cacheMB;
+  memory["workspace"] = workspaceMB;
+  memory["total"] = gridMB+pupilMB+psfMB+fftMB+batchMB+zernikeMB+cacheMB+workspaceMB;
+  memory["context"] = contextMB;
+  memory["rzeroEngine"] = (_anotherDonutEngine!=0 ? _anotherDonutEngine->getMemory()["total"] : 0.0);
+  return memory;
+
+}
+
+void DonutEngine::printMemory(){
+
+  MapStoD memory = getMemory();
+  struct rusage usage;
+  getrusage(RUSAGE_SELF,&usage);
+
+  std::cout << "DonutEngine Memory (MBytes)" << std::endl;
+  std::cout << "     Grid arrays    = " << memory["grid"] << std::endl;
+  std::cout << "     Pupil arrays   = " << memory["pupil"] << std::endl;
+  std::cout << "     PSF arrays     = " << memory["psf"] << std::endl;
+  std::cout << "     FFT arrays     = " << memory["fft"] << std::endl;
+  std::cout << "     Batch arrays   = " << memory["batch"] << std::endl;
+  std::cout << "     Zernike basis  = " << memory["zernike"];
+  if (_compactZernike){
+    std::cout << "  (compact, " << _zernikeObject->nTermsBuilt() << " of " << nZernikeSize+1 << " terms built)";
+  }
+  std::cout << std::endl;
+  std::cout << "     Caches         = " << memory["cache"] << std::endl;
+  std::cout << "     Workspace      = " << memory["workspace"] << "  (peak used " << _workspace.peak()/1.0e6 << ")" << std::endl;
+  std::cout << "     Total          = " << memory["total"] << std::endl;
+  if (_context!=0){
+    std::cout << "     Shared context = " << memory["context"] << "  (not in the total, used by " << _context->nUsers() << " engines"
+	      << (_context->isShm() ? ", in shared memory "+_context->shmName() : "") << ")" << std::endl;
+  }
+  if (_anotherDonutEngine!=0){
+    std::cout << "     Rzero engine   = " << memory["rzeroEngine"] << "  (not in the total)" << std::endl;
+  }
+  std::cout << "     Process peak RSS = " << usage.ru_maxrss/1.0e3 << std::endl;   // ru_maxrss is in kBytes on linux
+
 }
 
-void DonutEngine::getvXaxis(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvXaxis(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
   *DIM1 = _xaxis.Ny();
   *DIM2 = _xaxis.Nx();
   *ARGOUTVIEW_ARRAY2 = _xaxis();
 }
 
-void DonutEngine::getvYaxis(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvYaxis(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
   *DIM1 = _yaxis.Ny();
   *DIM2 = _yaxis.Nx();
   *ARGOUTVIEW_ARRAY2 = _yaxis();
 }
 
-void DonutEngine::getvRho(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvRho(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
   *DIM1 = _rho.Ny();
   *DIM2 = _rho.Nx();
   *ARGOUTVIEW_ARRAY2 = _rho();
 }
 
-void DonutEngine::getvTheta(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvTheta(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
   *DIM1 = _theta.Ny();
   *DIM2 = _theta.Nx();
   *ARGOUTVIEW_ARRAY2 = _theta();
@@ -1997,72 +3989,83 @@ void DonutEngine::getvFtsPixel(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2
   *ARGOUTVIEW_ARRAY2 = _ftsPixel();
 }
 
-void DonutEngine::getvPupilWaveZernike(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvPupilWaveZernike(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _pupilWaveZernike.Ny();
   *DIM2 = _pupilWaveZernike.Nx();
   *ARGOUTVIEW_ARRAY2 = _pupilWaveZernike();
 }
 
-void DonutEngine::getvPupilMask(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvPupilMask(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _pupilMask.Ny();
   *DIM2 = _pupilMask.Nx();
   *ARGOUTVIEW_ARRAY2 = _pupilMask();
 }
 
 void DonutEngine::getvPupilFunc(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
+  refreshOptics();
   *DIM1 = _pupilFunc.Ny();
   *DIM2 = _pupilFunc.Nx();
   *ARGOUTVIEW_ARRAY2 = _pupilFunc();
 }
 
-void DonutEngine::getvPsfOptics(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvPsfOptics(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
+  refreshOptics();
   *DIM1 = _psfOptics.Ny();
   *DIM2 = _psfOptics.Nx();
   *ARGOUTVIEW_ARRAY2 = _psfOptics();
 }
 
 void DonutEngine::getvFtsOptics(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _ftsOptics.Ny();
   *DIM2 = _ftsOptics.Nx();
   *ARGOUTVIEW_ARRAY2 = _ftsOptics();
 }
 
-void DonutEngine::getvPsfAtmos(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvPsfAtmos(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _psfAtmos.Ny();
   *DIM2 = _psfAtmos.Nx();
   *ARGOUTVIEW_ARRAY2 = _psfAtmos();
 }
 
 void DonutEngine::getvFtsAtmos(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _ftsAtmos.Ny();
   *DIM2 = _ftsAtmos.Nx();
   *ARGOUTVIEW_ARRAY2 = _ftsAtmos();
 }
 
-void DonutEngine::getvConvOpticsAtmosPixel(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvConvOpticsAtmosPixel(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _convOpticsAtmosPixel.Ny();
   *DIM2 = _convOpticsAtmosPixel.Nx();
   *ARGOUTVIEW_ARRAY2 = _convOpticsAtmosPixel();
 }
 
-void DonutEngine::getvValPixelCenters(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvValPixelCenters(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+  restoreMemoHit();
   *DIM1 = _valPixelCenters.Ny();
   *DIM2 = _valPixelCenters.Nx();
   *ARGOUTVIEW_ARRAY2 = _valPixelCenters();
 }
 
-void DonutEngine::getvImage(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
+void DonutEngine::getvImage(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2){
   *DIM1 = _calcImage.Ny();
   *DIM2 = _calcImage.Nx();
   *ARGOUTVIEW_ARRAY2 = _calcImage();
 }
 
-void DonutEngine::getParCurrent(double** ARGOUTVIEW_ARRAY1, int* DIM1){
+void DonutEngine::getParCurrent(Real** ARGOUTVIEW_ARRAY1, int* DIM1){
   *DIM1 = _parCurrent.Nx();
   *ARGOUTVIEW_ARRAY1 = _parCurrent;
 }
 
-void DonutEngine::getDerivatives(double** ARGOUTVIEW_ARRAY1, int* DIM1){
+void DonutEngine::getDerivatives(Real** ARGOUTVIEW_ARRAY1, int* DIM1){
   *DIM1 = _dChi2dpar.Nx();
   *ARGOUTVIEW_ARRAY1 = _dChi2dpar;
 }
@@ -2078,7 +4081,7 @@ void DonutEngine::toFits(fitsfile* fptr, MatrixC& in){
   long fpixel=1;
   int status = 0;         /* initialize status before calling fitsio routines */
 
-  if (fits_create_img(fptr,DOUBLE_IMG,2,naxes,&status)){
+  if (fits_create_img(fptr,fitsImgReal,2,naxes,&status)){
     fits_report_error(stderr, status);
   }
 
@@ -2087,7 +4090,7 @@ void DonutEngine::toFits(fitsfile* fptr, MatrixC& in){
   for (int i=0;i<Nsq;i++){
     temp(i) = abs(in(i));
   }
-  if (fits_write_img(fptr, TDOUBLE, fpixel, Nsq, temp(), &status)){
+  if (fits_write_img(fptr, fitsTypeReal, fpixel, Nsq, temp(), &status)){
     fits_report_error(stderr, status);
   }
 
@@ -2104,13 +4107,13 @@ void DonutEngine::toFits(fitsfile* fptr, Matrix& in){
   long fpixel=1;
   int status = 0;         /* initialize status before calling fitsio routines */
 
-  if (fits_create_img(fptr,DOUBLE_IMG,2,naxes,&status)){
+  if (fits_create_img(fptr,fitsImgReal,2,naxes,&status)){
     fits_report_error(stderr, status);
   }
 
   /* Write the array of doubles to the image */
   Real* ptrIn = in();
-  if (fits_write_img(fptr, TDOUBLE, fpixel, Nsq, ptrIn, &status)){
+  if (fits_write_img(fptr, fitsTypeReal, fpixel, Nsq, ptrIn, &status)){
     fits_report_error(stderr, status);
   }
 
@@ -14,6 +14,9 @@
 #include "ArrayTypes.h"  
 #include "FFTWClass.h"
 #include "Zernike.h"
+#include "EngineContext.h"
+#include "LRUCache.h"
+#include "Workspace.h"
 #include "fitsio.h"
 
 // typedefs for DonutEngine
@@ -23,6 +26,9 @@ typedef std::map<std::string, std::string> MapStoS;
 typedef std::map<std::string, int> MapStoI;
 typedef std::map<std::string, double> MapStoD;
 
+// An engine keeps all of its work arrays, plans and state machine, so an instance is single-threaded:
+// use one engine per thread.  Different engines may run concurrently, fftw planning is serialized
+// with fftwPlannerLock, and the Python wrapper releases the GIL in the long calculations.
 class DonutEngine{
 
 public:
@@ -48,62 +54,81 @@ public:
 
   // public methods - version with input arrays
   void calcAll(Real* par);
+  void calcAllBatch(double* par, double* x, double* y, int nBatch, double* images);
   void calcDerivatives(Real* image, Real* weight);
+  void calcJacobian();
   void calcWFMtoImage(Matrix& wfm);
   void calcPupilFuncFromWFM(Matrix& wfm);
   void resetTimers();
+  void resetCounters();
   void printTimers();
+  MapStoD getTimers();
+  MapStoI getCounters();
+  MapStoD getMemory();
+  void printMemory();
   Vector& getvParCurrent(){return _parCurrent;};  
   Vector& getvDerivatives(){return _dChi2dpar;};  
   void savePar();
   void printOptions();
   void closeFits();
+  bool removeContextShm();
 
   // public methods - version for SWIG using numpy arrays or lists
   void calcAll(double* par, int n);
+  void calcAllBatch(double* parBatch, int nBatch, int nParBatch, double* xBatch, int nxBatch, double* yBatch, int nyBatch, 
+		    double* images, int nImages, int nyImages, int nxImages);
   void calcDerivatives(double* image, int ny, int nx, double* weight, int my, int mx);
-  void getParCurrent(double** ARGOUTVIEW_ARRAY1, int* DIM1);  
-  void getDerivatives(double** ARGOUTVIEW_ARRAY1, int* DIM1);  
+  double calcChi2(double* par, int n, double* image, int ny, int nx, double* invSigmaSq, int my, int mx,
+		  double* grad, int ngrad, double* pullsq, int py, int px);
+  void getParCurrent(Real** ARGOUTVIEW_ARRAY1, int* DIM1);  
+  void getDerivatives(Real** ARGOUTVIEW_ARRAY1, int* DIM1);  
+  void getvJacobian(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  std::vector<int> getFloatingPar(){return _floatingPar;};
   void setXYDECam(double x, double y){_xDECam = x; _yDECam = y;};
+  void precomputePupilMasks(double xlo, double xhi, double ylo, double yhi);
+  void setFixedPar(int* fixed, int n);
   void fillPar(double* par, int n);
   void calcWFMtoImage(double* IN_ARRAY2, int DIM1, int DIM2);
 
   // getter methods returning Matrix (caution!: these return a reference, so don't their object)
+  // (in halfSpectrum mode FtsOptics, FtsAtmos and FtsPixel are Hermitian half-spectra, of size nbin by nbin/2+1)
   Matrix& getXaxis(){return _xaxis;}
   Matrix& getYaxis(){return _yaxis;}
   Matrix& getRho(){return _rho;}
   Matrix& getTheta(){return _theta;}
   MatrixC& getPixelBox(){return _pixelBox;}
   MatrixC& getFtsPixel(){return _ftsPixel;}
-  Matrix& getPupilMask(){return _pupilMask;}
-  Matrix& getPupilWaveZernike(){return _pupilWaveZernike;}
-  MatrixC& getPupilFunc(){return _pupilFunc;}
-  Matrix& getPsfOptics(){return _psfOptics;}
-  MatrixC& getFtsOptics(){return _ftsOptics;}
-  Matrix& getPsfAtmos(){return _psfAtmos;}
-  MatrixC& getFtsAtmos(){return _ftsAtmos;}
-  Matrix& getConvOpticsAtmosPixel(){return _convOpticsAtmosPixel;}
-  Matrix& getValPixelCenters(){return _valPixelCenters;}
+  // the arrays of the last calculation, which after an image from the memo is done again first,
+  // and the pupil function after a tilt shift is remade first
+  Matrix& getPupilMask(){restoreMemoHit(); return _pupilMask;}
+  Matrix& getPupilWaveZernike(){restoreMemoHit(); return _pupilWaveZernike;}
+  MatrixC& getPupilFunc(){restoreMemoHit(); refreshOptics(); return _pupilFunc;}
+  Matrix& getPsfOptics(){restoreMemoHit(); refreshOptics(); return _psfOptics;}
+  MatrixC& getFtsOptics(){restoreMemoHit(); return _ftsOptics;}
+  Matrix& getPsfAtmos(){restoreMemoHit(); return _psfAtmos;}
+  MatrixC& getFtsAtmos(){restoreMemoHit(); return _ftsAtmos;}
+  Matrix& getConvOpticsAtmosPixel(){restoreMemoHit(); return _convOpticsAtmosPixel;}
+  Matrix& getValPixelCenters(){restoreMemoHit(); return _valPixelCenters;}
   Matrix& getImage(){return _calcImage;}
   Zernike* getZernikeObject(){return _zernikeObject;}
 
   // getter methods for use with SWIG and numpy.i
-  void getvXaxis(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvYaxis(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvRho(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvTheta(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvXaxis(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvYaxis(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvRho(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvTheta(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
   void getvPixelBox(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
   void getvFtsPixel(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvPupilMask(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvPupilWaveZernike(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvPupilMask(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvPupilWaveZernike(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
   void getvPupilFunc(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvPsfOptics(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvPsfOptics(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
   void getvFtsOptics(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvPsfAtmos(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvPsfAtmos(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
   void getvFtsAtmos(Complex** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvConvOpticsAtmosPixel(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvValPixelCenters(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
-  void getvImage(double** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvConvOpticsAtmosPixel(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvValPixelCenters(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
+  void getvImage(Real** ARGOUTVIEW_ARRAY2, int* DIM1, int* DIM2);
 
   // don't strictly need these now
   // VString getVNames(){return parNames;}
@@ -111,8 +136,8 @@ public:
   double getScaleFactor(){return (double) _scaleFactor;};
 
   // set methods
-  void setCalcRzeroDerivativeTrue(){_calcRzeroDerivative=true;};
-  void setCalcRzeroDerivativeFalse(){_calcRzeroDerivative=false;};
+  void setCalcRzeroDerivativeTrue(){_calcRzeroDerivative=true; _memoGeneration++;};
+  void setCalcRzeroDerivativeFalse(){_calcRzeroDerivative=false; _memoGeneration++;};
 
   // Public variables (make some of the input variables Public
   int ipar_nEle,ipar_rzero,ipar_bkgd,ipar_ZernikeFirst,ipar_ZernikeLast;
@@ -123,7 +148,7 @@ public:
   VString parNames;
   VString parTitles;
   // calling statistics
-  int nCallsCalcAll,nCallsCalcDerivative;
+  int nCallsCalcAll,nCallsCalcDerivative,nCallsCalcJacobian;
   int nZernikeSize;
   
 
@@ -140,18 +165,34 @@ protected:
   void makeXPsf(int nbin,Real lambdaz);
   void setupArrays();
   void setupStuff();
+  void acquireContext();
+  void makeZernike();
+  void useContext();
   void initStateMachine();
   void defineParams();
 
   // internal methods
-  void fillPar(double* par);
+  void fillPar(Real* par);
+  void countStates();
   void calcPupilMask();
+  void buildPupilMask();
   void calcPupilFunc();
+  void fillPupilFunc();
   void calcOptics();
+  void calcTiltShift();
+  void refreshOptics();
+  void calcAllStates(Real* par);
+  void restoreMemoHit();
   void calcAtmos();
+  void calcAtmosAnalytic();
   void calcFTPixel();
   void calcConvolute();
   void calcPixelate();
+  bool useDecimatedFFT();
+  void calcConvoluteDecimated();
+  void calcQtildeDecimated(Matrix& Qpixels, int sign);
+  void setupBatch();
+  void chooseGridSize();
 
   // used for alignment of arrays
   size_t alignR;
@@ -186,6 +227,33 @@ protected:
   std::string _inputPupilMask;
   int _zemaxToDECamSignFlip;
   bool _calcRzeroDerivative;
+  bool _halfSpectrum;
+  int _nThreads;
+  std::string _wisdomDir;
+  std::string _wisdomFile;
+  std::string _zernikeCacheDir;
+  unsigned _planFlags;
+  bool _fftwPatient;
+  bool _analyticAtmos;
+  int _atmosCacheSize;
+  Real _atmosRzeroStep;
+  int _pupilMaskCacheSize;
+  Real _pupilMaskStep;
+  bool _checkerboard;
+  bool _decimatedFFT;
+  int _batchSize;
+  bool _autoGrid;
+  bool _autoGridKeepPixels;
+  Real _autoGridZ4;
+  Real _autoGridRzero;
+  bool _compactZernike;
+  bool _compactZernikeFloat;
+  bool _shareContext;
+  std::string _contextShm;
+  bool _tiltShift;
+  int _imageMemoSize;
+  bool _fastSinCos;
+  bool _compactMemory;
 
   // telescope parameters, set from _iTelescope
   Real _outerRadius;
@@ -207,8 +275,12 @@ protected:
   Real _Lf;
   int _nhalfPixels;
 
-  // cpu time
-  Real _timePupilMask,_timePupilFunc,_timeOptics,_timeAtmos,_timeConvolute,_timePixelate,_timeDerivatives0,_timeDerivatives1,_timeDerivatives2;
+  // wall-clock and CPU time per stage
+  double _timePupilMask,_timePupilFunc,_timeOptics,_timeTiltShift,_timeAtmos,_timeConvolute,_timePixelate,_timeDerivatives0,_timeDerivatives1,_timeDerivatives2,_timeJacobian;
+  double _cpuPupilMask,_cpuPupilFunc,_cpuOptics,_cpuTiltShift,_cpuAtmos,_cpuConvolute,_cpuPixelate,_cpuDerivatives0,_cpuDerivatives1,_cpuDerivatives2,_cpuJacobian;
+
+  // how often each step of the state machine was recalculated or skipped, see countStates
+  int _nPupilMaskCalc,_nPupilMaskSkip,_nPupilFuncCalc,_nPupilFuncSkip,_nTiltShift,_nAtmosCalc,_nAtmosSkip,_nConvoluteCalc,_nConvoluteSkip;
 
 
   // parameters, for internal use
@@ -228,39 +300,120 @@ protected:
   // FFT arrays and plans
   MatrixC _fftInputArray,_fftOutputArray;
   MatrixC _ifftInputArray,_ifftOutputArray;
-  Matrix _fftrtcInputArray;
-  MatrixC _fftrtcTempArray;
-  MatrixC _fftrtcOutputArray;
 
   fftw2dctc *_fft2PlanC;
   fftw2dctc *_ifft2PlanC;
-  fftw2drtc *_fft2rtcPlanC;
+
+  // FFT arrays and plans for the half-spectrum (r2c/c2r) mode, Hermitian arrays are _nbin by _nbinHalf
+  int _nbinHalf;
+  Matrix _fftHalfInputArray;
+  MatrixC _fftHalfOutputArray;
+  MatrixC _ifftHalfInputArray;
+  Matrix _ifftHalfOutputArray;
+
+  fftw2drtcHalf *_fft2PlanR;
+  fftw2dctrHalf *_ifft2PlanR;
+
+  // FFT arrays and plans for the decimatedFFT mode, _nPixels by _nPixels
+  MatrixC _fftSmallInputArray;
+  MatrixC _fftSmallOutputArray;
+
+  fftw2dctc *_fft2PlanSmall;
+  fftw2dctc *_ifft2PlanSmall;
+
+  // batched FFT arrays and plans for calcAllBatch, made on first use, _batchSize by _nbin by _nbin
+  // (the half-spectra are _batchSize by _nbin by _nbinHalf)
+  bool _batchReady;
+  AofMatrixC _batchInputArray;
+  AofMatrixC _batchOutputArray;
+  AofMatrix _batchHalfRealArray;
+  AofMatrixC _batchHalfSpectrumArray;
+
+  fftw2dctcMany *_fft2PlanBatch;
+  fftw2dctcMany *_ifft2PlanBatch;
+  fftw2drtcHalfMany *_fft2PlanBatchR;
+  fftw2dctrHalfMany *_ifft2PlanBatchR;
 
   // Zernike object
   Zernike* _zernikeObject;
 
+  // read-only arrays shared with other engines (with shareContext or contextShm, otherwise 0)
+  EngineContext* _context;
+
   // FFT grid arrays
   Matrix _xaxis,_yaxis;
   Matrix _rho,_theta; 
 
   // arrays for pupil
-  MatrixC _pupilFunc,_pupilFuncStar;
+  MatrixC _pupilFunc;   // its conjugate is formed where needed
 
   // arrays for Focal plane grid
   Matrix _xpsf,_ypsf;
 
   // Wavefront arrays and pupil function
   Matrix _pupilMask;
+
+  // pupil mask cache, keyed by telescope and rounded field position, masks stored one bit per bin
+  typedef std::pair<int, std::pair<Real,Real> > PupilMaskKey;
+  typedef std::vector<unsigned int> PupilMaskBits;
+  PupilMaskKey pupilMaskKey(Real x, Real y);
+  void packPupilMask(PupilMaskBits& bits);
+  void unpackPupilMask(const PupilMaskBits& bits);
+  LRUCache<PupilMaskKey, PupilMaskBits> _pupilMaskCache;
   Real _pupilSNorm;
   Matrix _pupilWaveZernike;
+
+  // bins inside the pupil mask, and the Zernike terms and wavefront on just those bins
+  std::vector<int> _pupilSupport;
+  std::vector<int> _pupilSupportAperture;
+  Matrix _zernikeSupport;
+  Vector _pupilWaveSupport;
+  bool _pupilSupportChanged;
+
+  // a change of only tilt (and piston) is a shift of _ftsOptics, exact if the pupil support spans less than
+  // _nbin/2 bins in x and y; after such a shift the pupil function and G are stale until refreshOptics
+  bool _tiltShiftExact;
+  bool _opticsStale;
+
+  // Zernike terms floating in the fit, and their basis on the pupil support for the gradient
+  std::vector<int> _floatingZernike;
+  Matrix _zernikeFloating;
+  bool _floatingChanged;
+  void makeZernikeFloating();
+
+  // image Jacobian, d image[pixel] / d par for the floating parameters, see calcJacobian
+  std::vector<int> _floatingPar;
+  Matrix _jacobian;
+  void convolvePixels(Real* pixels);
   
   // atmosphere arrays
   Matrix _rAtmos,_shftrAtmos;
   Matrix _psfAtmos;
   MatrixC _ftsAtmos;
 
+  // analytic atmosphere: (r lambda f)^5/3 on the Fourier grid, and OTFs cached by rounded rzero
+  Matrix _atmosR53;
+  LRUCache<long, std::vector<Real> > _atmosCache;
+
+  // memo of recent images, keyed by the exact parameters and field position, and of dChi2/dpar with the 
+  // data image and weight they were calculated for.  After a hit (_memoHit) the other arrays, and _last_*, 
+  // still belong to the last calculation, until restoreMemoHit.
+  struct ImageMemo{
+    std::vector<Real> image;
+    std::vector<Real> derivatives;
+    std::vector<Real> dataImage;
+    std::vector<Real> weight;
+    long generation;
+  };
+  typedef std::vector<Real> ImageMemoKey;
+  LRUCache<ImageMemoKey, ImageMemo> _imageMemo;
+  ImageMemoKey _imageMemoKey;
+  bool _memoHit;
+  long _memoGeneration;     // counts changes of the fixed parameters and rzero derivative, which void memo derivatives
+  long _nDerivMemoHits,_nDerivMemoMisses;
+
   // Psf arrays
-  MatrixC _calcG,_calcGstar;
+  MatrixC _calcG;
   Matrix _psfOptics;
   MatrixC _ftsOptics;  
 
@@ -272,7 +425,7 @@ protected:
   Matrix _convOpticsAtmosPixel;
 
   // State Machine flags
-  bool _first,_statePupilMask,_statePupilFunc,_stateAtmos,_stateDerivatives;
+  bool _first,_statePupilMask,_statePupilFunc,_stateAtmos,_stateDerivatives,_stateTiltOnly;
   int _stateCounter;
 
   // pixel Array
@@ -282,6 +435,9 @@ protected:
   // Derivatives
   Vector _dChi2dpar;
 
+  // preallocated scratch memory for the temporaries of each call
+  Workspace _workspace;
+
   // Fits file pointer for debug output
   fitsfile *_fptr;
 
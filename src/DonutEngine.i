@@ -1,4 +1,9 @@
-%module(docstring="donutengine calculates out of focus stars from a pupil plane Zernike expansion, for the DECam, Aaron Roodman SLAC National Accelerator Laboratory, Stanford University, 2012") donutengine
+// the single precision engine (swig -DDONUT_FLOAT) is the separate module donutenginef
+#ifdef DONUT_FLOAT
+%module(threads="1", docstring="donutengine calculates out of focus stars from a pupil plane Zernike expansion, for the DECam, Aaron Roodman SLAC National Accelerator Laboratory, Stanford University, 2012 (single precision)") donutenginef
+#else
+%module(threads="1", docstring="donutengine calculates out of focus stars from a pupil plane Zernike expansion, for the DECam, Aaron Roodman SLAC National Accelerator Laboratory, Stanford University, 2012") donutengine
+#endif
 
 // make a docstring for Swig created code
 %feature("autodoc", "3");
@@ -32,24 +37,102 @@ namespace std {
 %}
 
 
-// for complex types with numpy
+// for complex types with numpy, and the precision of Real
+#ifdef DONUT_FLOAT
+typedef float Real;
+%numpy_typemaps(Complex , NPY_CFLOAT, int)
+#else
+typedef double Real;
 %numpy_typemaps(Complex , NPY_CDOUBLE, int)
+#endif
 
 // numpy arguments 
 %apply (double* IN_ARRAY2, int DIM1, int DIM2) {(double* image, int ny, int nx)};
 %apply (double* IN_ARRAY2, int DIM1, int DIM2) {(double* weight, int my, int mx)};
 %apply (double* IN_ARRAY1, int DIM1) {(double* par, int n)};
 %apply (double* IN_ARRAY2, int DIM1, int DIM2) {(double* wfm, int nx, int ny)};
+%apply (int* IN_ARRAY1, int DIM1) {(int* fixed, int n)};
+%apply (double* IN_ARRAY2, int DIM1, int DIM2) {(double* parBatch, int nBatch, int nParBatch)};
+%apply (double* IN_ARRAY1, int DIM1) {(double* xBatch, int nxBatch)};
+%apply (double* IN_ARRAY1, int DIM1) {(double* yBatch, int nyBatch)};
+%apply (double* INPLACE_ARRAY3, int DIM1, int DIM2, int DIM3) {(double* images, int nImages, int nyImages, int nxImages)};
+%apply (double* IN_ARRAY2, int DIM1, int DIM2) {(double* invSigmaSq, int my, int mx)};
+%apply (double* INPLACE_ARRAY1, int DIM1) {(double* grad, int ngrad)};
+%apply (double* INPLACE_ARRAY2, int DIM1, int DIM2) {(double* pullsq, int py, int px)};
+
+// release the GIL only around the long pure C++ calls, everything else keeps it
+// (an engine instance is not thread safe: use one engine per thread, see the donutengine docstring)
+%nothread;
+%thread DonutEngine::DonutEngine;
+%thread DonutEngine::calcAll;
+%thread DonutEngine::calcAllBatch;
+%thread DonutEngine::calcDerivatives;
+%thread DonutEngine::calcJacobian;
+%thread DonutEngine::calcChi2;
+%thread DonutEngine::calcWFMtoImage;
+%thread DonutEngine::precomputePupilMasks;
+
+// calcChi2 is wrapped below, so that the gradient and pull buffers are optional
+%rename(_calcChi2) DonutEngine::calcChi2;
 
 // Include the header file to be wrapped
 %include "DonutEngine.h"
 
+// batched images, with the output array allocated here
+%extend DonutEngine {
+%pythoncode %{
+  def calcImageBatch(self, par, x, y):
+    """ calculate images for par[nBatch,npar] at positions x[nBatch],y[nBatch], returns images[nBatch,nPixels,nPixels] """
+    import numpy
+    par = numpy.ascontiguousarray(par,dtype=numpy.float64)
+    x = numpy.ascontiguousarray(x,dtype=numpy.float64)
+    y = numpy.ascontiguousarray(y,dtype=numpy.float64)
+    images = numpy.zeros((par.shape[0],self._nPixels,self._nPixels))
+    self.calcAllBatch(par,x,y,images)
+    return images
+
+  def calcChi2(self, par, image, invSigmaSq, grad=None, pullsq=None):
+    """ calculate the image for par and return chi2 = sum invSigmaSq*(image-model)**2, 
+        also fills dChi2/dpar into grad[npar] and invSigmaSq*(image-model)**2 into pullsq[nPixels,nPixels]
+        if they are given, both must be contiguous float64 arrays, they are written in place.
+        Raises ValueError if an array does not have its size """
+    import numpy
+    imageShape = (self._nPixels,self._nPixels)
+    if numpy.size(par)!=self.npar:
+      raise ValueError("calcChi2: par has %d values, the engine has %d parameters" % (numpy.size(par),self.npar))
+    if numpy.shape(image)!=imageShape:
+      raise ValueError("calcChi2: image has shape %s, not %s" % (numpy.shape(image),imageShape))
+    if numpy.shape(invSigmaSq)!=imageShape:
+      raise ValueError("calcChi2: invSigmaSq has shape %s, not %s" % (numpy.shape(invSigmaSq),imageShape))
+    if grad is None:
+      grad = numpy.zeros(0)
+    elif numpy.shape(grad)!=(self.npar,):
+      raise ValueError("calcChi2: grad has shape %s, not (%d,)" % (numpy.shape(grad),self.npar))
+    if pullsq is None:
+      pullsq = numpy.zeros((0,0))
+    elif numpy.shape(pullsq)!=imageShape:
+      raise ValueError("calcChi2: pullsq has shape %s, not %s" % (numpy.shape(pullsq),imageShape))
+    return self._calcChi2(par,image,invSigmaSq,grad,pullsq)
+%}
+}
+
 
 /* Rewrite the high level interface to DonutEngine, but call it donutengine */
 %pythoncode %{
 
 def donutengine(**inputDict):
-  """  donutengine class for calculating out-of-focus star images from Zernike pupil basis """
+  """  donutengine class for calculating out-of-focus star images from Zernike pupil basis 
+       use singlePrecision=True for the float engine from the donutenginef module
+
+       the constructor, calcAll, calcAllBatch, calcDerivatives, calcJacobian, calcChi2, calcWFMtoImage and 
+       precomputePupilMasks release the GIL, so engines can run in parallel in Python threads.
+       Each engine is single-threaded: it keeps all of its work arrays, so one engine must only 
+       be used by one thread at a time - make one engine per thread """
+
+  # the single precision engine is built as a separate module
+  if inputDict.pop("singlePrecision",False):
+    from donutlib import donutenginef
+    return donutenginef.donutengine(**inputDict)
 
   # special code for scaleFactor - be sure it is a float
   if inputDict.has_key("scaleFactor"):
@@ -0,0 +1,263 @@
+//
+// EngineContext.cc:  the read-only arrays of a DonutEngine that depend only on its grid,
+//                    shared by all engines with the same key, within a process or through POSIX shared memory
+//
+// Copyright (C) 2011 Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University
+//
+#include <iostream>
+#include <cstdlib>
+#include <cstring>
+#include <cerrno>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "EngineContext.h"
+
+// header of the shared memory object, the arrays follow at an offset of sizeof(ContextShmHeader)=512 bytes;
+// ready is set last, by the process that fills the arrays
+struct ContextShmHeader{
+  char magic[8];
+  volatile int ready;
+  int realSize;
+  size_t blockSize;
+  char key[480];
+  char pad[8];
+};
+static const char contextShmMagic[8] = {'D','O','N','U','T','C','0','1'};
+
+// how long to wait for another process to fill a shared memory context, in steps of 10 msec
+static const int contextShmWaitSteps = 6000;
+
+// alignment of each array in the block
+static const size_t contextAlign = 64;
+
+std::map<std::string, EngineContext*> EngineContext::_registry;
+pthread_mutex_t EngineContext::_registryMutex = PTHREAD_MUTEX_INITIALIZER;
+
+
+EngineContext* EngineContext::acquire(const std::string& key, int nbin, int nbinFts, int nZernikeTerms,
+				      bool analyticAtmos, bool compactZernike, const std::string& shmPrefix){
+
+  std::string registryKey = key + "|" + shmPrefix;
+  pthread_mutex_lock(&_registryMutex);
+  std::map<std::string, EngineContext*>::iterator it = _registry.find(registryKey);
+  if (it!=_registry.end()){
+    EngineContext* context = it->second;
+    context->_nUsers++;
+    pthread_mutex_unlock(&_registryMutex);
+
+    // wait for the engine that is filling it
+    pthread_mutex_lock(&context->_fillMutex);
+    pthread_mutex_unlock(&context->_fillMutex);
+    return context;
+  }
+
+  EngineContext* context = new EngineContext(key,nbin,nbinFts,nZernikeTerms,analyticAtmos,compactZernike,shmPrefix);
+  context->_nUsers = 1;
+  _registry[registryKey] = context;
+  pthread_mutex_unlock(&_registryMutex);
+  return context;
+
+}
+
+void EngineContext::release(EngineContext* context){
+
+  if (context==0){
+    return;
+  }
+  pthread_mutex_lock(&_registryMutex);
+  context->_nUsers--;
+  if (context->_nUsers<=0){
+    std::map<std::string, EngineContext*>::iterator it = _registry.begin();
+    while (it!=_registry.end() && it->second!=context){
+      it++;
+    }
+    if (it!=_registry.end()){
+      _registry.erase(it);
+    }
+    delete context;
+  }
+  pthread_mutex_unlock(&_registryMutex);
+
+}
+
+bool EngineContext::unlinkShm(const std::string& shmName){
+  return (shm_unlink(shmName.c_str())==0);
+}
+
+
+EngineContext::EngineContext(const std::string& key, int nbin, int nbinFts, int nZernikeTerms, bool analyticAtmos,
+			     bool compactZernike, const std::string& shmPrefix) :
+  _zernike(0), _zernikeStorage(0), _key(key), _shmName(""), _nbin(nbin), _nbinFts(nbinFts),
+  _nZernikeTerms(nZernikeTerms<3 ? 3 : nZernikeTerms), _analyticAtmos(analyticAtmos),
+  _compactZernike(compactZernike), _filled(false), _nUsers(0), _block(0), _blockSize(0), _mapped(false) {
+
+  pthread_mutex_init(&_fillMutex,0);
+
+  // only a shared memory context holds the Zernike basis in its block
+  bool shm = (shmPrefix!="");
+  _blockSize = layout(0);
+  if (shm && !_compactZernike){
+    _blockSize += (size_t) _nZernikeTerms*_nbin*_nbin*sizeof(Real);
+  }
+
+  if (shm){
+    std::string shmName = shmPrefix + "-" + key;
+    if (openShm(shmName,_blockSize)){
+      _shmName = shmName;
+    } else {
+      std::cout << "EngineContext: ERROR could not use the shared memory " << shmName << ", using memory of this process" << std::endl;
+      _blockSize = layout(0);
+    }
+  }
+  if (_block==0){
+    void* address(0);
+    if (posix_memalign(&address,contextAlign,_blockSize)!=0){
+      std::cout << "EngineContext: ERROR could not allocate " << _blockSize << " bytes" << std::endl;
+      exit(1);
+    }
+    _block = (char*) address;
+  }
+  layout(_block);
+
+  if (_filled){
+    // attached to a context filled by another process
+    if (!_compactZernike){
+      _zernike = new Zernike(_zernikeStorage,_nZernikeTerms,_nbin,_nbin);
+    }
+  } else {
+    pthread_mutex_lock(&_fillMutex);
+  }
+
+}
+
+EngineContext::~EngineContext(){
+
+  delete _zernike;
+  if (_mapped){
+    munmap(_block,_blockSize);
+  } else {
+    free(_block);
+  }
+  pthread_mutex_destroy(&_fillMutex);
+
+}
+
+size_t EngineContext::layout(char* block){
+
+  // set the views of all arrays into block and return the size used (without the Zernike basis),
+  // a null block just gives the size
+  size_t offset = sizeof(ContextShmHeader);
+  size_t nReal = (size_t) _nbin*_nbin*sizeof(Real);
+  size_t nComplex = (size_t) _nbin*_nbin*sizeof(Complex);
+  size_t nComplexFts = (size_t) _nbin*_nbinFts*sizeof(Complex);
+
+  Matrix* grids[8] = {&_xaxis,&_yaxis,&_rho,&_theta,&_xpsf,&_ypsf,&_rAtmos,&_shftrAtmos};
+  for (int i=0;i<8;i++){
+    grids[i]->Dimension(_nbin,_nbin,(Real*) (block+offset));
+    offset += (nReal+contextAlign-1)/contextAlign*contextAlign;
+  }
+  if (_analyticAtmos){
+    _atmosR53.Dimension(_nbin,_nbinFts,(Real*) (block+offset));
+    offset += ((size_t) _nbin*_nbinFts*sizeof(Real)+contextAlign-1)/contextAlign*contextAlign;
+  }
+  _pixelBox.Dimension(_nbin,_nbin,(Complex*) (block+offset));
+  offset += (nComplex+contextAlign-1)/contextAlign*contextAlign;
+  _ftsPixel.Dimension(_nbin,_nbinFts,(Complex*) (block+offset));
+  offset += (nComplexFts+contextAlign-1)/contextAlign*contextAlign;
+
+  _zernikeStorage = (block!=0 && _mapped && !_compactZernike) ? (Real*) (block+offset) : 0;
+  return offset;
+
+}
+
+bool EngineContext::openShm(const std::string& shmName, size_t blockSize){
+
+  // the first process makes the object and fills it (see setFilled)
+  int fd = shm_open(shmName.c_str(),O_RDWR|O_CREAT|O_EXCL,0600);
+  if (fd>=0){
+    if (ftruncate(fd,blockSize)!=0){
+      close(fd);
+      shm_unlink(shmName.c_str());
+      return false;
+    }
+    void* address = mmap(0,blockSize,PROT_READ|PROT_WRITE,MAP_SHARED,fd,0);
+    close(fd);
+    if (address==MAP_FAILED){
+      shm_unlink(shmName.c_str());
+      return false;
+    }
+    _block = (char*) address;
+    _mapped = true;
+    return true;
+  }
+  if (errno!=EEXIST){
+    return false;
+  }
+
+  // the others map it read-only, once it has its size and is filled
+  fd = shm_open(shmName.c_str(),O_RDONLY,0);
+  if (fd<0){
+    return false;
+  }
+  struct stat shmStat;
+  int iWait = 0;
+  while (fstat(fd,&shmStat)==0 && (size_t) shmStat.st_size!=blockSize && iWait<contextShmWaitSteps){
+    usleep(10000);
+    iWait++;
+  }
+  if ((size_t) shmStat.st_size!=blockSize){
+    close(fd);
+    return false;
+  }
+  void* address = mmap(0,blockSize,PROT_READ,MAP_SHARED,fd,0);
+  close(fd);
+  if (address==MAP_FAILED){
+    return false;
+  }
+  ContextShmHeader* header = (ContextShmHeader*) address;
+  while (!header->ready && iWait<contextShmWaitSteps){
+    usleep(10000);
+    iWait++;
+  }
+  __sync_synchronize();
+  if (!header->ready || memcmp(header->magic,contextShmMagic,8)!=0 || header->realSize!=(int)sizeof(Real)
+      || header->blockSize!=blockSize || _key.compare(0,sizeof(header->key)-1,header->key)!=0){
+    munmap(address,blockSize);
+    return false;
+  }
+  _block = (char*) address;
+  _mapped = true;
+  _filled = true;
+  return true;
+
+}
+
+void EngineContext::setFilled(){
+
+  // publish a shared memory context to the other processes
+  if (_shmName!=""){
+    ContextShmHeader* header = (ContextShmHeader*) _block;
+    memcpy(header->magic,contextShmMagic,8);
+    header->realSize = sizeof(Real);
+    header->blockSize = _blockSize;
+    strncpy(header->key,_key.c_str(),sizeof(header->key)-1);
+    __sync_synchronize();
+    header->ready = 1;
+  }
+  _filled = true;
+  pthread_mutex_unlock(&_fillMutex);
+
+}
+
+size_t EngineContext::memoryBytes() const{
+
+  // the block, and the Zernike basis if it is not in the block
+  size_t bytes = _blockSize;
+  if (_zernike!=0 && _zernikeStorage==0){
+    bytes += _zernike->memoryBytes();
+  }
+  return bytes;
+
+}
@@ -0,0 +1,90 @@
+//
+// EngineContext.h:  the read-only arrays of a DonutEngine that depend only on its grid,
+//                   shared by all engines with the same key, within a process or through POSIX shared memory
+//
+// Copyright (C) 2011 Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University
+//
+#ifndef ENGINECONTEXT_H
+#define ENGINECONTEXT_H
+
+#include <string>
+#include <map>
+#include <pthread.h>
+#include "ArrayTypes.h"
+#include "Zernike.h"
+
+class EngineContext{
+
+public:
+  // returns the context for key, made if needed, and counts one more user of it.  The key must hold every
+  // parameter that the arrays depend on.  If the context is new (!isFilled()) the caller fills the arrays and
+  // then calls setFilled(), other engines asking for the same key wait until then.
+  // With a shmPrefix the arrays, and the Zernike basis unless it is compact, live in the POSIX shared memory
+  // object shmPrefix-key, which is made by the first process and attached read-only by the others.
+  static EngineContext* acquire(const std::string& key, int nbin, int nbinFts, int nZernikeTerms,
+				bool analyticAtmos, bool compactZernike, const std::string& shmPrefix="");
+  // one user less, the context is deleted after its last user
+  static void release(EngineContext* context);
+  // remove a shared memory object, processes that have it mapped keep their mapping
+  static bool unlinkShm(const std::string& shmName);
+
+  bool isFilled() const {return _filled;}
+  void setFilled();
+  bool isShm() const {return _shmName!="";}
+  const std::string& shmName() const {return _shmName;}
+  const std::string& key() const {return _key;}
+  int nUsers() const {return _nUsers;}
+  size_t memoryBytes() const;
+
+  // views of the shared arrays, as in DonutEngine
+  Matrix _xaxis;
+  Matrix _yaxis;
+  Matrix _rho;
+  Matrix _theta;
+  Matrix _xpsf;
+  Matrix _ypsf;
+  Matrix _rAtmos;
+  Matrix _shftrAtmos;
+  Matrix _atmosR53;   // only with analyticAtmos
+  MatrixC _pixelBox;
+  MatrixC _ftsPixel;
+
+  // the (non-compact) Zernike basis, set by the engine that fills the context; in shared memory the terms
+  // are stored at _zernikeStorage, and the engine copies them there
+  Zernike* _zernike;
+  Real* _zernikeStorage;
+
+private:
+  EngineContext(const std::string& key, int nbin, int nbinFts, int nZernikeTerms, bool analyticAtmos,
+		bool compactZernike, const std::string& shmPrefix);
+  ~EngineContext();
+  EngineContext(const EngineContext&);
+  EngineContext& operator=(const EngineContext&);
+
+  size_t layout(char* block);
+  bool openShm(const std::string& shmName, size_t blockSize);
+
+  std::string _key;
+  std::string _shmName;
+  int _nbin;
+  int _nbinFts;
+  int _nZernikeTerms;
+  bool _analyticAtmos;
+  bool _compactZernike;
+  bool _filled;
+  int _nUsers;
+
+  // the arrays are in one block, from posix_memalign or mapped from the shared memory object
+  char* _block;
+  size_t _blockSize;
+  bool _mapped;
+
+  // held by the filling engine until setFilled
+  pthread_mutex_t _fillMutex;
+
+  // contexts shared in this process, by key
+  static std::map<std::string, EngineContext*> _registry;
+  static pthread_mutex_t _registryMutex;
+
+};
+#endif
@@ -22,8 +22,76 @@
 // Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University, 2011.
 //
 
+#include <cstdio>
+#include <sstream>
+#include <unistd.h>
+#include <sys/resource.h>
 #include "FFTWClass.h"
 
+double wallTime(){
+  struct timeval tv;
+  gettimeofday(&tv,NULL);
+  return (double) tv.tv_sec + 1.0e-6 * (double) tv.tv_usec;
+}
+
+double cpuTime(){
+  struct rusage usage;
+  getrusage(RUSAGE_SELF,&usage);
+  return (double) (usage.ru_utime.tv_sec + usage.ru_stime.tv_sec) 
+    + 1.0e-6 * (double) (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec);
+}
+
+// one planner lock for all engines of this precision, the fftwf planner of the float engine is separate
+static pthread_mutex_t fftwPlannerMutex = PTHREAD_MUTEX_INITIALIZER;
+
+fftwPlannerLock::fftwPlannerLock(){
+  pthread_mutex_lock(&fftwPlannerMutex);
+}
+
+fftwPlannerLock::~fftwPlannerLock(){
+  pthread_mutex_unlock(&fftwPlannerMutex);
+}
+
+void fftwSetThreads(int nThreads){
+
+  // fftw_init_threads must be called once, before any other fftw call that uses threads
+  static bool threadsInitialized(false);
+  if (!threadsInitialized){
+    if (FFTW(init_threads)()==0){
+      std::cout << "fftwSetThreads: ERROR fftw_init_threads failed, using 1 thread" << std::endl;
+      return;
+    }
+    threadsInitialized = true;
+  }
+  if (nThreads<1){
+    nThreads = 1;
+  }
+  FFTW(plan_with_nthreads)(nThreads);
+
+}
+
+bool fftwImportWisdom(const std::string& fileName){
+  // returns false if the file is missing or unreadable, which just means a cold start
+  return (FFTW(import_wisdom_from_filename)(fileName.c_str())!=0);
+}
+
+bool fftwExportWisdom(const std::string& fileName){
+
+  // write to a temporary file and rename it, so that several processes starting at the 
+  // same time never see a partially written wisdom file
+  std::ostringstream tempName;
+  tempName << fileName << ".tmp" << getpid();
+  if (FFTW(export_wisdom_to_filename)(tempName.str().c_str())==0){
+    return false;
+  }
+  if (rename(tempName.str().c_str(),fileName.c_str())!=0){
+    remove(tempName.str().c_str());
+    return false;
+  }
+  return true;
+
+}
+
 void fftShift(Matrix& in,Matrix& out){
 
   // only works for even n !!!!
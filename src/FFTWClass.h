@@ -37,12 +37,21 @@ Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA. */
 #include <cerrno>
 #include <cmath>
 #include <time.h>
+#include <sys/time.h>
 #include <complex>
+#include <string>
 
+#include <pthread.h>
 #include <fftw3.h>
 #include "ArrayTypes.h"
 #include "Array.h"
 
+// fftw names for the precision of Real, ie. FFTW(plan) is fftw_plan or fftwf_plan
+#ifdef DONUT_FLOAT
+#define FFTW(name) fftwf_ ## name
+#else
+#define FFTW(name) fftw_ ## name
+#endif
 
 
 
@@ -51,17 +60,41 @@ void fftShift(Matrix& in);
 void fftShift(MatrixC& in, MatrixC& out);
 void fftShift(MatrixC& in);
 
+// elapsed wall-clock time in seconds, use for timing with multi-threaded plans
+double wallTime();
+
+// CPU time (user+system) of the process in seconds, summed over all of its threads
+double cpuTime();
+
+// use nThreads threads for all fftw plans created after this call
+void fftwSetThreads(int nThreads);
+
+// read/write accumulated fftw wisdom, return true on success
+bool fftwImportWisdom(const std::string& fileName);
+bool fftwExportWisdom(const std::string& fileName);
+
+// fftw planning (and its thread count and wisdom) is global and not thread safe, only fftw_execute is,
+// so hold one of these in a scope around any planning when engines may be built from several threads
+class fftwPlannerLock {
+public:
+  fftwPlannerLock();
+  ~fftwPlannerLock();
+private:
+  fftwPlannerLock(const fftwPlannerLock&);
+  fftwPlannerLock& operator=(const fftwPlannerLock&);
+};
+
 
 class fftw2dctc {
 protected:
   int sign;
-  fftw_plan plan;
+  FFTW(plan) plan;
   Real cputime;
   
 public:
-  fftw2dctc(MatrixC& in, MatrixC& out, int sign0) {
+  fftw2dctc(MatrixC& in, MatrixC& out, int sign0, unsigned flags=FFTW_MEASURE) {
     sign = sign0;
-    plan = fftw_plan_dft_2d(in.Ny(),in.Nx(),(fftw_complex *) in(), (fftw_complex *) out(),sign,FFTW_MEASURE);  
+    plan = FFTW(plan_dft_2d)(in.Ny(),in.Nx(),(FFTW(complex) *) in(), (FFTW(complex) *) out(),sign,flags);  
     cputime = 0.0;
   }
   
@@ -72,7 +105,7 @@ public:
   
   void execute() {
     clock_t start = clock();
-    fftw_execute(plan);
+    FFTW(execute)(plan);
     clock_t stop = clock();
     cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
   }
@@ -87,15 +120,15 @@ protected:
   Matrix* in;
   MatrixC* temp;
   MatrixC* out;
-  fftw_plan plan;
+  FFTW(plan) plan;
   Real cputime;
   
 public:
-  fftw2drtc(Matrix& in0, MatrixC& temp0, MatrixC& out0) {
+  fftw2drtc(Matrix& in0, MatrixC& temp0, MatrixC& out0, unsigned flags=FFTW_MEASURE) {
     in = &in0;
     temp = &temp0;
     out = &out0;
-    plan = fftw_plan_dft_r2c_2d(in0.Ny(),in0.Nx(),(double *) in0(), (fftw_complex *) temp0(),FFTW_MEASURE);  
+    plan = FFTW(plan_dft_r2c_2d)(in0.Ny(),in0.Nx(),(Real *) in0(), (FFTW(complex) *) temp0(),flags);  
     cputime = 0.0;
   }
   
@@ -107,7 +140,7 @@ public:
   void execute() {
     clock_t start = clock();
 
-    fftw_execute(plan);
+    FFTW(execute)(plan);
 
     // for r->c FFTs the output c array has the correct components for iy: 0->Ny AND ix: 0->Nx/2
     // so the "out" array needs copies of the "temp" components for iy: 0->Ny AND ix: 0->Nx/2
@@ -181,4 +214,154 @@ public:
     
 };
 
+
+
+// real -> complex FFT which keeps only the Hermitian half-spectrum
+// if in is Ny by Nx, then out must be Ny by (Nx/2 + 1); no expansion to the full spectrum is done
+class fftw2drtcHalf {
+protected:
+  FFTW(plan) plan;
+  Real cputime;
+  
+public:
+  fftw2drtcHalf(Matrix& in, MatrixC& out, unsigned flags=FFTW_MEASURE) {
+    plan = FFTW(plan_dft_r2c_2d)(in.Nx(),in.Ny(),(Real *) in(), (FFTW(complex) *) out(),flags);  
+    cputime = 0.0;
+  }
+  
+  virtual ~fftw2drtcHalf() {
+    //    if(plan) fftw_destroy_plan(plan);
+  }
+  
+  void execute() {
+    clock_t start = clock();
+    FFTW(execute)(plan);
+    clock_t stop = clock();
+    cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
+  }
+    
+};
+
+
+
+// complex -> real FFT from a Hermitian half-spectrum (this is always the inverse, sign=+1, transform)
+// if out is Ny by Nx, then in must be Ny by (Nx/2 + 1); note that fftw overwrites the input array
+class fftw2dctrHalf {
+protected:
+  FFTW(plan) plan;
+  Real cputime;
+  
+public:
+  fftw2dctrHalf(MatrixC& in, Matrix& out, unsigned flags=FFTW_MEASURE) {
+    plan = FFTW(plan_dft_c2r_2d)(out.Nx(),out.Ny(),(FFTW(complex) *) in(), (Real *) out(),flags);  
+    cputime = 0.0;
+  }
+  
+  virtual ~fftw2dctrHalf() {
+    //    if(plan) fftw_destroy_plan(plan);
+  }
+  
+  void execute() {
+    clock_t start = clock();
+    FFTW(execute)(plan);
+    clock_t stop = clock();
+    cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
+  }
+    
+};
+
+
+
+// batched FFTs, for a stack of nBatch 2d transforms stored one after the other in an array3
+// (first dimension is the batch index), all done with a single fftw_plan_many_dft call
+class fftw2dctcMany {
+protected:
+  int sign;
+  FFTW(plan) plan;
+  Real cputime;
+  
+public:
+  fftw2dctcMany(AofMatrixC& in, AofMatrixC& out, int sign0, unsigned flags=FFTW_MEASURE) {
+    sign = sign0;
+    int n[2] = {(int)in.Ny(),(int)in.Nz()};
+    int dist = in.Ny()*in.Nz();
+    plan = FFTW(plan_many_dft)(2,n,in.Nx(),(FFTW(complex) *) in(),NULL,1,dist,
+			      (FFTW(complex) *) out(),NULL,1,dist,sign,flags);  
+    cputime = 0.0;
+  }
+  
+  virtual ~fftw2dctcMany() {
+    //    if(plan) fftw_destroy_plan(plan);
+  }
+  
+  void execute() {
+    clock_t start = clock();
+    FFTW(execute)(plan);
+    clock_t stop = clock();
+    cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
+  }
+    
+};
+
+
+
+// batched real -> complex FFT keeping the Hermitian half-spectra,
+// if in is nBatch by Ny by Nx, then out must be nBatch by Ny by (Nx/2 + 1)
+class fftw2drtcHalfMany {
+protected:
+  FFTW(plan) plan;
+  Real cputime;
+  
+public:
+  fftw2drtcHalfMany(AofMatrix& in, AofMatrixC& out, unsigned flags=FFTW_MEASURE) {
+    int n[2] = {(int)in.Ny(),(int)in.Nz()};
+    plan = FFTW(plan_many_dft_r2c)(2,n,in.Nx(),(Real *) in(),NULL,1,in.Ny()*in.Nz(),
+				  (FFTW(complex) *) out(),NULL,1,out.Ny()*out.Nz(),flags);  
+    cputime = 0.0;
+  }
+  
+  virtual ~fftw2drtcHalfMany() {
+    //    if(plan) fftw_destroy_plan(plan);
+  }
+  
+  void execute() {
+    clock_t start = clock();
+    FFTW(execute)(plan);
+    clock_t stop = clock();
+    cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
+  }
+    
+};
+
+
+
+// batched complex -> real FFT from Hermitian half-spectra (inverse transform, overwrites the input)
+// if out is nBatch by Ny by Nx, then in must be nBatch by Ny by (Nx/2 + 1)
+class fftw2dctrHalfMany {
+protected:
+  FFTW(plan) plan;
+  Real cputime;
+  
+public:
+  fftw2dctrHalfMany(AofMatrixC& in, AofMatrix& out, unsigned flags=FFTW_MEASURE) {
+    int n[2] = {(int)out.Ny(),(int)out.Nz()};
+    plan = FFTW(plan_many_dft_c2r)(2,n,out.Nx(),(FFTW(complex) *) in(),NULL,1,in.Ny()*in.Nz(),
+				  (Real *) out(),NULL,1,out.Ny()*out.Nz(),flags);  
+    cputime = 0.0;
+  }
+  
+  virtual ~fftw2dctrHalfMany() {
+    //    if(plan) fftw_destroy_plan(plan);
+  }
+  
+  void execute() {
+    clock_t start = clock();
+    FFTW(execute)(plan);
+    clock_t stop = clock();
+    cputime += (stop-start)/(Real)CLOCKS_PER_SEC;
+  }
+    
+};
+
+
 #endif
@@ -0,0 +1,87 @@
+//
+// LRUCache.h:  small least-recently-used cache, used by DonutEngine to keep
+//              arrays that are expensive to recalculate
+//
+// Copyright (C) 2011 Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University
+//
+#ifndef LRUCACHE_H
+#define LRUCACHE_H
+
+#include <list>
+#include <map>
+#include <utility>
+
+// Value must be default constructible and copyable (ie. std::vector, not an Array.h Matrix,
+// whose copy constructor only makes a view)
+template <class Key, class Value>
+class LRUCache{
+
+public:
+  // a capacity of 0 means that the cache is not bounded
+  LRUCache(size_t capacity=8) : _capacity(capacity), _hits(0), _misses(0) {}
+
+  // returns a pointer to the cached value, or 0 if the key is not present
+  // (a hit also moves the entry to the front of the list)
+  Value* find(const Key& key){
+    typename IndexMap::iterator it = _index.find(key);
+    if (it==_index.end()){
+      _misses++;
+      return 0;
+    }
+    _hits++;
+    _items.splice(_items.begin(),_items,it->second);
+    return &(it->second->second);
+  }
+
+  // the same without counting or reordering, for a second look at an entry found before
+  Value* peek(const Key& key){
+    typename IndexMap::iterator it = _index.find(key);
+    return (it==_index.end()) ? 0 : &(it->second->second);
+  }
+
+  // make a new entry for key, evicting the least recently used one if the cache is full,
+  // and return a reference to its (default constructed) value to be filled by the caller
+  Value& insert(const Key& key){
+    typename IndexMap::iterator it = _index.find(key);
+    if (it!=_index.end()){
+      _items.splice(_items.begin(),_items,it->second);
+      return it->second->second;
+    }
+    if (_capacity>0 && _items.size()>=_capacity){
+      _index.erase(_items.back().first);
+      _items.pop_back();
+    }
+    _items.push_front(std::make_pair(key,Value()));
+    _index[key] = _items.begin();
+    return _items.front().second;
+  }
+
+  void clear(){_items.clear(); _index.clear();}
+
+  // changing the capacity only drops the least recently used entries that no longer fit
+  void setCapacity(size_t capacity){
+    _capacity = capacity;
+    while (_capacity>0 && _items.size()>_capacity){
+      _index.erase(_items.back().first);
+      _items.pop_back();
+    }
+  }
+
+  size_t size() const {return _items.size();}
+  size_t capacity() const {return _capacity;}
+  long hits() const {return _hits;}
+  long misses() const {return _misses;}
+  void resetCounters(){_hits = 0; _misses = 0;}
+
+private:
+  typedef std::list< std::pair<Key,Value> > ItemList;
+  typedef std::map<Key, typename ItemList::iterator> IndexMap;
+
+  size_t _capacity;
+  long _hits;
+  long _misses;
+  ItemList _items;
+  IndexMap _index;
+
+};
+#endif
@@ -0,0 +1,79 @@
+//
+// Workspace.h:  preallocated, aligned scratch memory for the per-call temporaries of DonutEngine
+//
+// Copyright (C) 2011 Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University
+//
+#ifndef WORKSPACE_H
+#define WORKSPACE_H
+
+#include <vector>
+#include <utility>
+#include "Array.h"
+
+// A simple arena: get() hands out aligned pieces of one block, reset() gives them all back.
+// If a request does not fit, the piece comes from a separate allocation, and at the next
+// reset() the block is regrown to the peak use, so the arena settles after one call.
+class Workspace{
+
+public:
+  Workspace() : _base(0), _size(0), _used(0), _peak(0) {}
+  ~Workspace(){release();}
+
+  void reserve(size_t bytes){
+    release();
+    if (bytes>0){
+      Array::newAlign(_base,bytes,_align);
+    }
+    _size = bytes;
+    _used = 0;
+  }
+
+  void reset(){
+    if (_overflow.size()>0){
+      reserve(_peak);
+    }
+    _used = 0;
+  }
+
+  template <class T>
+  T* get(size_t n){
+    size_t bytes = ((n*sizeof(T) + _align - 1)/_align)*_align;
+    char* p = 0;
+    if (_used+bytes <= _size){
+      p = _base + _used;
+    } else {
+      Array::newAlign(p,bytes,_align);
+      _overflow.push_back(std::make_pair(p,bytes));
+    }
+    _used += bytes;
+    if (_used>_peak){
+      _peak = _used;
+    }
+    return (T*) p;
+  }
+
+  size_t size() const {return _size;}
+  size_t peak() const {return _peak;}
+
+private:
+  void release(){
+    for (size_t i=0;i<_overflow.size();i++){
+      Array::deleteAlign(_overflow[i].first,_overflow[i].second);
+    }
+    _overflow.clear();
+    if (_base!=0){
+      Array::deleteAlign(_base,_size);
+    }
+    _base = 0;
+    _size = 0;
+  }
+
+  static const size_t _align = 64;
+  char* _base;
+  size_t _size;
+  size_t _used;
+  size_t _peak;
+  std::vector< std::pair<char*,size_t> > _overflow;
+
+};
+#endif
@@ -4,13 +4,91 @@
 // Copyright (C) 2011 Aaron J. Roodman, SLAC National Accelerator Laboratory, Stanford University
 //
 #include <iostream>
+#include <sstream>
+#include <cstdio>
+#include <cstring>
 #include <cmath>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include "Zernike.h"
 
+// header of the cache file, the basis follows at an offset of sizeof(ZernikeCacheHeader)=64 bytes
+struct ZernikeCacheHeader{
+  char magic[8];
+  int nTerms;
+  int nx;
+  int ny;
+  int realSize;
+  char pad[40];
+};
+static const char zernikeCacheMagic[8] = {'D','O','N','U','T','Z','0','1'};
+
 
 // constructor 
-Zernike::Zernike(Matrix& rhoArr,Matrix& thetaArr,int nTerms){
+Zernike::Zernike(Matrix& rhoArr,Matrix& thetaArr,int nTerms, const std::string& cacheFile, int nThreads) : 
+  _nThreads(nThreads), _mapAddress(0), _mapSize(0), _compact(false), _singlePrecision(false), _apertureRho(0.0) {
+
+  // the cache file is keyed by the caller, the header only checks the array sizes and precision
+  if (cacheFile!=""){
+    int nTermsUsed = (nTerms<3) ? 3 : nTerms;
+    if (mapCache(cacheFile,nTermsUsed,rhoArr.Nx(),rhoArr.Ny())){
+      _nTerms = nTerms;
+      makeDescriptions(nTermsUsed);
+      return;
+    }
+  }
+
   init(rhoArr,thetaArr,nTerms);
+
+  if (cacheFile!=""){
+    if (!writeCache(cacheFile)){
+      std::cout << "Zernike: ERROR could not write the Zernike cache " << cacheFile << std::endl;
+    }
+  }
+}
+
+// constructor for the compact basis, nothing is calculated until a term is used
+Zernike::Zernike(Matrix& rhoArr,Matrix& thetaArr,int nTerms, bool compact, bool singlePrecision, int nThreads) : 
+  _nThreads(nThreads), _mapAddress(0), _mapSize(0), _compact(compact), _singlePrecision(singlePrecision), _apertureRho(0.0) {
+
+  if (!_compact){
+    init(rhoArr,thetaArr,nTerms);
+    return;
+  }
+
+  _nTerms = nTerms;
+  if (nTerms<3) {
+    nTerms = 3;
+  } 
+  makeDescriptions(nTerms);
+  _rhoGrid.Dimension(rhoArr.Nx(),rhoArr.Ny(),rhoArr());
+  _thetaGrid.Dimension(thetaArr.Nx(),thetaArr.Ny(),thetaArr());
+  _compactTerm.resize(nTerms);
+  _compactTermFloat.resize(nTerms);
+  extendAperture(1.0);
+
+}
+
+// constructor for a basis kept elsewhere, ie. in the shared memory of an EngineContext
+Zernike::Zernike(Real* terms, int nTerms, int nx, int ny) : 
+  _nThreads(1), _mapAddress(0), _mapSize(0), _compact(false), _singlePrecision(false), _apertureRho(0.0) {
+
+  _nTerms = nTerms;
+  if (nTerms<3) {
+    nTerms = 3;
+  } 
+  makeDescriptions(nTerms);
+  _zernikeTerm.Dimension(nTerms,ny,nx,terms);
+
+}
+
+Zernike::~Zernike(){
+  delete [] _zernikeDescription;
+  if (_mapAddress!=0){
+    munmap(_mapAddress,_mapSize);
+  }
 }
 
 void Zernike::init(Matrix& rho,Matrix& theta,int nTerms){
@@ -28,11 +106,68 @@ void Zernike::init(Matrix& rho,Matrix& theta,int nTerms){
   int ny = rho.Ny();
 
   // new member variables
-  _zernikeDescription = new std::string[nTerms];
+  makeDescriptions(nTerms);
   _zernikeTerm.Dimension(nTerms,ny,nx);
   _zernikeTerm.Activate();
 
+  // now calculate the terms, in the Noll order
+  int iZ = -1;   // Zernike term counter
+  int n = -1;
+  Matrix radialTerm(nx,ny);
+  Matrix work1(nx,ny);
+  Matrix work2(nx,ny);
+  while (iZ < nTerms-1){
+    n = n + 1;
+    for (int m=0; m < n+1 ; m++){
+
+      if (((n-m) % 2)==0){
+
+	// radial term
+	radialPolynomial(n,m,rho,radialTerm,work1,work2);
+
+	Real coeff = sqrt(2.0*n+2.0);
+	if (m==0){
+	  coeff = coeff/sqrt(2.0);
+	} 
+	  
+	// even and odd terms
+	if (m==0){
+	  iZ = iZ + 1;
+	  if (iZ<nTerms){
+	    Matrix aZernikeTerm = _zernikeTerm[iZ];
+	    fillTerm(aZernikeTerm,coeff,radialTerm,theta,0,true);
+	  }
+	  
+	} else{   
+	  // convention in Noll is that iZ odd is sin, and iZ even is cos
+	  // but Noll also has iZ starting from 1, but we start at 0, so it is reversed!
+	  bool cosFirst = ((iZ+1) % 2)!=0;
+
+	  iZ = iZ + 1;
+	  if (iZ<nTerms){
+	    Matrix aZernikeTerm = _zernikeTerm[iZ];
+	    fillTerm(aZernikeTerm,coeff,radialTerm,theta,m,cosFirst);
+	  }
+	  iZ = iZ + 1;
+	  if (iZ<nTerms){
+	    Matrix aZernikeTerm = _zernikeTerm[iZ];
+	    fillTerm(aZernikeTerm,coeff,radialTerm,theta,m,!cosFirst);
+	  }
+
+	} // m not equal 0
+
+      } // n-m even
+
+    } // loop over m
+
+  } // loop over n
+
+}
+
+void Zernike::makeDescriptions(int nTerms){
+
   // fill the text descriptions
+  _zernikeDescription = new std::string[nTerms];
   std::string descriptions[37] =       {"Piston (Bias)          1",
                                    "Tilt X                 4^(1/2) (p) * COS (A)",
                                    "Tilt Y                 4^(1/2) (p) * SIN (A)",
@@ -81,178 +216,302 @@ void Zernike::init(Matrix& rho,Matrix& theta,int nTerms){
     }
   }
 
-  // now calculate the terms
+}
+
+bool Zernike::mapCache(const std::string& cacheFile, int nTerms, int nx, int ny){
+
+  // map the basis from the cache file, privately so that the pages are shared between processes
+  // until (if ever) they are written to.  Returns false if the file is missing or does not match.
+  int fd = open(cacheFile.c_str(),O_RDONLY);
+  if (fd<0){
+    return false;
+  }
+  size_t dataSize = (size_t) nTerms*nx*ny*sizeof(Real);
+  size_t fileSize = sizeof(ZernikeCacheHeader) + dataSize;
+  struct stat fileStat;
+  if (fstat(fd,&fileStat)!=0 || (size_t) fileStat.st_size!=fileSize){
+    close(fd);
+    return false;
+  }
+  void* address = mmap(0,fileSize,PROT_READ|PROT_WRITE,MAP_PRIVATE,fd,0);
+  close(fd);
+  if (address==MAP_FAILED){
+    return false;
+  }
+
+  ZernikeCacheHeader* header = (ZernikeCacheHeader*) address;
+  if (memcmp(header->magic,zernikeCacheMagic,8)!=0 || header->nTerms!=nTerms || header->nx!=nx || header->ny!=ny 
+      || header->realSize!=(int)sizeof(Real)){
+    munmap(address,fileSize);
+    return false;
+  }
+
+  _mapAddress = address;
+  _mapSize = fileSize;
+  _zernikeTerm.Dimension(nTerms,ny,nx,(Real*) ((char*) address + sizeof(ZernikeCacheHeader)));
+  return true;
+
+}
+
+bool Zernike::writeCache(const std::string& cacheFile){
+
+  // write to a temporary file and rename it, so that other processes never map a partial file
+  // (the name includes this object, engines built in several threads of a process may write at once)
+  ZernikeCacheHeader header;
+  memset(&header,0,sizeof(header));
+  memcpy(header.magic,zernikeCacheMagic,8);
+  header.nTerms = _zernikeTerm.Nx();
+  header.nx = _zernikeTerm.Nz();
+  header.ny = _zernikeTerm.Ny();
+  header.realSize = sizeof(Real);
+
+  std::ostringstream tempName;
+  tempName << cacheFile << ".tmp" << getpid() << "-" << this;
+  FILE* file = fopen(tempName.str().c_str(),"wb");
+  if (file==0){
+    return false;
+  }
+  size_t nData = _zernikeTerm.Nx()*_zernikeTerm.Ny()*_zernikeTerm.Nz();
+  bool ok = (fwrite(&header,sizeof(header),1,file)==1) && (fwrite(_zernikeTerm(),sizeof(Real),nData,file)==nData);
+  ok = (fclose(file)==0) && ok;
+  if (!ok || rename(tempName.str().c_str(),cacheFile.c_str())!=0){
+    remove(tempName.str().c_str());
+    return false;
+  }
+  return true;
+
+}
+
+void Zernike::radialPolynomial(int n, int m, Matrix& rho, Matrix& radial, Matrix& work1, Matrix& work2){
+
+  // Kintner's recurrence in n, at fixed m, starting from R_m^m = rho^m and R_m+2^m = (m+2) rho^(m+2) - (m+1) rho^m,
+  //   K1 R_n^m = (K2 rho^2 + K3) R_n-2^m + K4 R_n-4^m
+  // with K1 = (n+m)(n-m)(n-2)/2, K2 = 2n(n-1)(n-2), K3 = -m^2(n-1) - n(n-1)(n-2), K4 = -n(n+m-2)(n-m-2)/2.
+  // This avoids the large alternating factorial coefficients of the explicit sum, which lose precision at high order.
+  int nxy = rho.Nx()*rho.Ny();
+
+  // R_m^m in work2
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+  for (int i=0;i<nxy;i++){
+    Real rhoM = 1.0;
+    for (int k=0;k<m;k++){
+      rhoM = rhoM * rho(i);
+    }
+    work2(i) = rhoM;
+  }
+  if (n==m){
+    radial = work2;
+    return;
+  }
+
+  // R_m+2^m in work1
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+  for (int i=0;i<nxy;i++){
+    work1(i) = ((m+2)*rho(i)*rho(i) - (m+1)) * work2(i);
+  }
+
+  // recur, with R_k-2^m in work1 and R_k-4^m in work2
+  for (int k=m+4;k<=n;k=k+2){
+    Real K1 = 0.5*(k+m)*(k-m)*(k-2);
+    Real K2 = 2.0*k*(k-1)*(k-2);
+    Real K3 = -1.0*m*m*(k-1) - 1.0*k*(k-1)*(k-2);
+    Real K4 = -0.5*k*(k+m-2)*(k-m-2);
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0;i<nxy;i++){
+      Real next = ((K2*rho(i)*rho(i) + K3)*work1(i) + K4*work2(i)) / K1;
+      work2(i) = work1(i);
+      work1(i) = next;
+    }
+  }
+  radial = work1;
+
+}
 
-  // first figure out what nMax is for nTerms
-  int numZ = 0;
-  int nLast = -1;
+void Zernike::fillTerm(Matrix& aZernikeTerm, Real coeff, Matrix& radial, Matrix& theta, int m, bool useCos){
+  int nxy = radial.Nx()*radial.Ny();
+  if (m==0){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0; i<nxy ; i++){
+      aZernikeTerm(i) = coeff * radial(i);
+    } 
+  } else if (useCos){
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0; i<nxy ; i++){
+      aZernikeTerm(i) = coeff * radial(i) * cos(m*theta(i));
+    } 
+  } else {
+#pragma omp parallel for num_threads(_nThreads) schedule(static)
+    for (int i=0; i<nxy ; i++){
+      aZernikeTerm(i) = coeff * radial(i) * sin(m*theta(i));
+    } 
+  }
+}
 
-  while (numZ < nTerms){ 
-    nLast = nLast + 1;
-    for (int m=0;m < (nLast+1);m++){
-      if (((nLast-m) % 2)==0){
-	if (m==0) {
-	  numZ = numZ + 1;
+
+void Zernike::nollIndex(int iZ, int& n, int& m, bool& useCos){
+
+  // the same walk over n,m as in init
+  int jZ = -1;
+  n = -1;
+  while (jZ < iZ){
+    n = n + 1;
+    for (int mm=0; mm < n+1 ; mm++){
+      if (((n-mm) % 2)==0){
+	m = mm;
+	if (mm==0){
+	  jZ = jZ + 1;
+	  useCos = true;
+	  if (jZ==iZ) return;
 	} else {
-	  numZ = numZ + 2;
+	  bool cosFirst = ((jZ+1) % 2)!=0;
+	  jZ = jZ + 1;
+	  useCos = cosFirst;
+	  if (jZ==iZ) return;
+	  jZ = jZ + 1;
+	  useCos = !cosFirst;
+	  if (jZ==iZ) return;
 	}
       }
     }
   }
 
-  // set range n for  rho^n
-  int nRhoPowers = nLast + 1;
-  int nTrigTerms = nLast + 1;
-
-  // first fill rho^n terms, cos(n theta) and sin(n theta)
-
-  //
-  // indexing is rhoPowersArr[0] is r^0
-  //                              [1] is r^1  etc...
-  //
-  AofMatrix rhoNArr(nRhoPowers,nx,ny);
-
-  // set rho^0 = 1.
-  Matrix temp0 = rhoNArr[0];
-  temp0 = 1.0;
-
-  // set rho^1 = rho
-  Matrix temp1 = rhoNArr[1];
-  temp1 = rho;
-  
-  // set higher powers
-  for (int iPower=2; iPower < nRhoPowers; iPower++){
-    Matrix tempN = rhoNArr[iPower];
-    Matrix tempNminus1 = rhoNArr[iPower-1];
-    for (int i=0; i<nx*ny ; i++){
-      tempN(i) = tempNminus1(i) * rho(i);  
+}
+
+void Zernike::extendAperture(Real rhoMax){
+
+  // the aperture only grows, and then the terms built so far are dropped
+  if (rhoMax<=_apertureRho){
+    return;
+  }
+  _apertureRho = rhoMax;
+
+  int nxy = _rhoGrid.Nx()*_rhoGrid.Ny();
+  _apertureIndex.assign(nxy,-1);
+  int nAperture = 0;
+  for (int i=0;i<nxy;i++){
+    if (_rhoGrid(i)<=_apertureRho){
+      _apertureIndex[i] = nAperture;
+      nAperture++;
     }
   }
 
-  // now for cos,sin terms
-  AofMatrix cosNArr(nTrigTerms,nx,ny);
-  AofMatrix sinNArr(nTrigTerms,nx,ny);
-       
-  //
-  // self.cosTheta[0] = is just 1
-  // self.cosTheta[1] = cos(theta)
-  // self.cosTheta[2] = cos(2 theta)  etc...
-  //
-  cosNArr[0] = 1.0;
-  sinNArr[0] = 0.0;
-
-  for (int iTrigTerm=0; iTrigTerm<nTrigTerms; iTrigTerm++){
-    Matrix aCosTerm = cosNArr[iTrigTerm];
-    Matrix aSinTerm = sinNArr[iTrigTerm];
-    for  (int i=0; i<nx*ny ; i++){
-      aCosTerm(i) = cos( iTrigTerm * theta(i) );
-      aSinTerm(i) = sin( iTrigTerm * theta(i) );
+  _apertureRhoArr.Deallocate();
+  _apertureThetaArr.Deallocate();
+  _apertureRhoArr.Allocate((nAperture>0 ? nAperture : 1),1);
+  _apertureThetaArr.Allocate((nAperture>0 ? nAperture : 1),1);
+  _apertureRhoArr = 0.0;
+  _apertureThetaArr = 0.0;
+  for (int i=0;i<nxy;i++){
+    int k = _apertureIndex[i];
+    if (k>=0){
+      _apertureRhoArr(k) = _rhoGrid(i);
+      _apertureThetaArr(k) = _thetaGrid(i);
     }
-  }        
+  }
 
-  //
-  // now calculate the Zernike polynomials
-  //
-  int iZ = -1;   // Zernike term counter
-  for (int n=0; n<nRhoPowers; n++){
-    for (int m=0; m < n+1 ; m++){
+  for (unsigned int iZ=0;iZ<_compactTerm.size();iZ++){
+    std::vector<Real>().swap(_compactTerm[iZ]);
+    std::vector<float>().swap(_compactTermFloat[iZ]);
+  }
 
-      if (((n-m) % 2)==0){
+}
 
-	int nn = (n-m)/2;
-	int nm = (n+m)/2;
+void Zernike::buildTerm(int iZ){
 
-	// radial term
-	Matrix radialTerm(nx,ny);
-	radialTerm = 0.0;
-	for (int s=0; s < nn+1 ; s++){
-
-	  Real rcoeff = pow(-1.0,s) * factorial(n-s) / (  factorial(s) * factorial(nm-s) * factorial(nn-s)   );
-	  Matrix rhoNTerm = rhoNArr[n-2*s];
-	  for  (int i=0; i<nx*ny ; i++){
-	    radialTerm(i) = radialTerm(i) + rcoeff * rhoNTerm(i);
-	  }
-	}
+  int n,m;
+  bool useCos;
+  nollIndex(iZ,n,m,useCos);
 
-	Real coeff = sqrt(2.0*n+2.0);
-	if (m==0){
-	  coeff = coeff/sqrt(2.0);
-	} 
-	  
-	// even and odd terms
-	if (m==0){
-	  iZ = iZ + 1;
-	  if (iZ<nTerms){
-	    Matrix aZernikeTerm = _zernikeTerm[iZ];
-	    for  (int i=0; i<nx*ny ; i++){
-	      aZernikeTerm(i) = coeff * radialTerm(i);
-	    } 
-	    // std::cout << "zernike #"<<iZ<< "  n,m,coeff =" << n << " " << m << " " << coeff << std::endl; 
-	  }
-	  
-	} else{   
-	  // convention in Noll is that iZ odd is sin, and iZ even is cos
-	  // but Noll also has iZ starting from 1, but we start at 0, so it is reversed!
-	  
-	  iZ = iZ + 1;
-	  if ((iZ % 2)!=0){
-	    
-	    if (iZ<nTerms){
-	      Matrix aZernikeTerm = _zernikeTerm[iZ];
-	      Matrix aTrigTerm = cosNArr[m];
-	      for  (int i=0; i<nx*ny ; i++){
-		aZernikeTerm(i) = coeff * radialTerm(i) * aTrigTerm(i);
-	      } 
-	      // std::cout << "zernike #"<<iZ<< "  n,m,coeff =" << n << " " << m << " " << coeff << std::endl; 
-	      
-	    }
-	    
-	    iZ = iZ + 1;
-	    if (iZ<nTerms){
-	      Matrix aZernikeTerm = _zernikeTerm[iZ];
-	      Matrix aTrigTerm = sinNArr[m];
-	      for  (int i=0; i<nx*ny ; i++){
-		aZernikeTerm(i) = coeff * radialTerm(i) * aTrigTerm(i);
-	      }
-	      // std::cout << "zernike #"<<iZ<< "  n,m,coeff =" << n << " " << m  << " " << coeff << std::endl; 
-	      
-	    }
-	    
-	  } else {
-
-	    if (iZ<nTerms){
-	      Matrix aZernikeTerm = _zernikeTerm[iZ];
-	      Matrix aTrigTerm = sinNArr[m];
-	      for  (int i=0; i<nx*ny ; i++){
-		aZernikeTerm(i) = coeff * radialTerm(i) * aTrigTerm(i);
-	      }
-	      // std::cout << "zernike #"<<iZ<< "  n,m,coeff =" << n << " " << m  << " " << coeff << std::endl; 
- 
-	    }
-	      
-	    iZ = iZ + 1;
-	    if (iZ<nTerms){
-	      Matrix aZernikeTerm = _zernikeTerm[iZ];
-	      Matrix aTrigTerm = cosNArr[m];
-	      for  (int i=0; i<nx*ny ; i++){
-		aZernikeTerm(i) = coeff * radialTerm(i) * aTrigTerm(i);
-	      }
-	      // std::cout << "zernike #"<<iZ<< "  n,m,coeff =" << n << " " << m << " " << coeff << std::endl; 
- 
-	    }
-	      
-	  } //IZ even or odd
+  int nAperture = _apertureRhoArr.Nx();
+  Matrix radialTerm(nAperture,1);
+  Matrix work1(nAperture,1);
+  Matrix work2(nAperture,1);
+  Matrix term(nAperture,1);
+  radialPolynomial(n,m,_apertureRhoArr,radialTerm,work1,work2);
 
-	} // m not equal 0
+  Real coeff = sqrt(2.0*n+2.0);
+  if (m==0){
+    coeff = coeff/sqrt(2.0);
+  } 
+  fillTerm(term,coeff,radialTerm,_apertureThetaArr,m,useCos);
 
-      } // n-m even
+  if (_singlePrecision){
+    _compactTermFloat[iZ].assign(term(),term()+nAperture);
+  } else {
+    _compactTerm[iZ].assign(term(),term()+nAperture);
+  }
 
-    } // loop over m
+}
 
-  } // loop over n
+void Zernike::addTerm(int iZ, Real coeff, const std::vector<int>& bins, Real* out){
+
+  int nBins = bins.size();
+  if (_singlePrecision){
+    if (_compactTermFloat[iZ].empty()){
+      buildTerm(iZ);
+    }
+    const float* term = &_compactTermFloat[iZ][0];
+    for (int k=0;k<nBins;k++){
+      out[k] = out[k] + coeff * term[bins[k]];
+    }
+  } else {
+    if (_compactTerm[iZ].empty()){
+      buildTerm(iZ);
+    }
+    const Real* term = &_compactTerm[iZ][0];
+    for (int k=0;k<nBins;k++){
+      out[k] = out[k] + coeff * term[bins[k]];
+    }
+  }
 
 }
 
+void Zernike::gatherTerm(int iZ, const std::vector<int>& bins, Real* out){
+
+  int nBins = bins.size();
+  if (_singlePrecision){
+    if (_compactTermFloat[iZ].empty()){
+      buildTerm(iZ);
+    }
+    const float* term = &_compactTermFloat[iZ][0];
+    for (int k=0;k<nBins;k++){
+      out[k] = term[bins[k]];
+    }
+  } else {
+    if (_compactTerm[iZ].empty()){
+      buildTerm(iZ);
+    }
+    const Real* term = &_compactTerm[iZ][0];
+    for (int k=0;k<nBins;k++){
+      out[k] = term[bins[k]];
+    }
+  }
+
+}
+
+int Zernike::nTermsBuilt() const{
+  int nBuilt = 0;
+  for (unsigned int iZ=0;iZ<_compactTerm.size();iZ++){
+    if (!_compactTerm[iZ].empty() || !_compactTermFloat[iZ].empty()){
+      nBuilt++;
+    }
+  }
+  return nBuilt;
+}
+
+size_t Zernike::memoryBytes() const{
+
+  // the full basis (also when it is mapped from the cache file), or the compact terms built so far
+  size_t bytes = (size_t) _zernikeTerm.Nx()*_zernikeTerm.Ny()*_zernikeTerm.Nz()*sizeof(Real);
+  if (_compact){
+    bytes += _apertureIndex.size()*sizeof(int) + 2*_apertureRhoArr.Nx()*sizeof(Real);
+    for (unsigned int iZ=0;iZ<_compactTerm.size();iZ++){
+      bytes += _compactTerm[iZ].size()*sizeof(Real) + _compactTermFloat[iZ].size()*sizeof(float);
+    }
+  }
+  return bytes;
+
+}
     
 int Zernike::factorial(int ix){
   int answer(0);
@@ -6,19 +6,37 @@
 #ifndef ZERNIKE_HH
 #define ZERNIKE_HH
 
+#include <string>
+#include <vector>
 #include "ArrayTypes.h"
 
 class Zernike{
 
 public:
-  // constructor
-  Zernike(Matrix& rhoArr, Matrix& thetaArr,int nTerms);  
+  // constructor, with an optional cache file for the basis (see mapCache), terms are calculated with nThreads
+  Zernike(Matrix& rhoArr, Matrix& thetaArr,int nTerms, const std::string& cacheFile="", int nThreads=1);  
+  // constructor for the compact basis (see addTerm), with the terms stored as float if singlePrecision
+  Zernike(Matrix& rhoArr, Matrix& thetaArr,int nTerms, bool compact, bool singlePrecision, int nThreads=1);  
+  // constructor for a basis of nTerms nx by ny terms already calculated at terms, which is only viewed
+  Zernike(Real* terms, int nTerms, int nx, int ny);  
   // destructor
-  virtual ~Zernike() {delete _zernikeDescription;}
+  virtual ~Zernike();
 
   // methods
   void init(Matrix& rhoArr, Matrix& thetaArr, int nTerms);
   int factorial(int ix);
+  bool isMapped() const {return _mapAddress!=0;}
+  size_t memoryBytes() const;
+
+  // compact basis: _zernikeTerm is not filled, instead each term is calculated when it is first used,
+  // and stored only over the aperture, the bins with rho<=apertureRho (1.0 to start with).
+  // Bins are given by their index in the aperture, see apertureIndex.
+  bool isCompact() const {return _compact;}
+  void extendAperture(Real rhoMax);
+  int apertureIndex(int i) const {return _apertureIndex[i];}   // -1 outside of the aperture
+  void addTerm(int iZ, Real coeff, const std::vector<int>& bins, Real* out);  // out[k] += coeff*Z_iZ[bins[k]]
+  void gatherTerm(int iZ, const std::vector<int>& bins, Real* out);          // out[k] = Z_iZ[bins[k]]
+  int nTermsBuilt() const;
 
   // Public variables  
   AofMatrix _zernikeTerm;  
@@ -27,8 +45,33 @@ public:
 
 protected:
 
+  void makeDescriptions(int nTerms);
+  void radialPolynomial(int n, int m, Matrix& rho, Matrix& radial, Matrix& work1, Matrix& work2);
+  void fillTerm(Matrix& term, Real coeff, Matrix& radial, Matrix& theta, int m, bool useCos);
+  void nollIndex(int iZ, int& n, int& m, bool& useCos);
+  void buildTerm(int iZ);
+  bool mapCache(const std::string& cacheFile, int nTerms, int nx, int ny);
+  bool writeCache(const std::string& cacheFile);
+
   // input parameters  
   int _nTerms;
+  int _nThreads;    // OpenMP threads for the loops over bins
+
+  // memory mapped basis, if it came from the cache file
+  void* _mapAddress;
+  size_t _mapSize;
+
+  // compact basis, terms over the aperture in _compactTerm or _compactTermFloat, empty until built
+  bool _compact;
+  bool _singlePrecision;
+  Real _apertureRho;
+  Matrix _rhoGrid;     // views of rho and theta, which must outlive a compact Zernike
+  Matrix _thetaGrid;
+  std::vector<int> _apertureIndex;
+  Matrix _apertureRhoArr;
+  Matrix _apertureThetaArr;
+  std::vector< std::vector<Real> > _compactTerm;
+  std::vector< std::vector<float> > _compactTermFloat;
 
 };
 #endif